@@ -0,0 +1,34 @@
+from PyQt6.QtCore import QObject, pyqtSignal
+from compressStuff import analyze_compression_time, trial_analysis
+
+class CompressionAnalysisWorker(QObject):
+    progress = pyqtSignal(dict)  # The run context of the trial encodes reports to it, nothing listens
+    analyzed = pyqtSignal(dict)  # Signal with analyze_compression_time's result, before the trial starts
+    finished = pyqtSignal(dict)  # Signal with the analysis result, including the trial estimates; empty when stopped
+
+    def __init__(self, input_folder, video_compression_speed, selected_image_quality, image_format="keep", trial=True):
+        super().__init__()
+        self.input_folder = input_folder
+        self.video_compression_speed = video_compression_speed
+        self.selected_image_quality = selected_image_quality
+        self.image_format = image_format
+        self.trial = trial  # Without trial, only the folder is analyzed
+
+        self._is_running = True
+
+    def run(self):
+        # Scans and sniffs the folder, then trial-encodes a sample of its files with the selected settings (see trial_analysis)
+        analysis = analyze_compression_time(self.input_folder)
+        if self._is_running:
+            self.analyzed.emit(analysis)
+        result = {}
+        if self.trial and self._is_running:
+            result = trial_analysis(self.input_folder, analysis, speed=self.video_compression_speed,
+                                    image_quality=self.selected_image_quality, image_format=self.image_format,
+                                    worker=self)
+        # Emitted either way, so the thread quits; a stopped analysis' result is dropped
+        self.finished.emit({**analysis, **result} if self._is_running else {})
+
+    def stop(self):
+        """Stop the analysis and trial encodes, the result is dropped."""
+        self._is_running = False
@@ -1,34 +1,65 @@
+import errno
+import io
 import os
-import json
+import logging
 import sys
 import subprocess
-import shutil  # For copying files
 import signal  # For handling Ctrl+C signal
-from PIL import Image, UnidentifiedImageError, ExifTags
-import piexif
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image, UnidentifiedImageError
 import time
+from stage_timer import StageTimer
+from run_logging import logger, configure_logging, RateLimitedProgress
+from metrics_server import MetricsServer
+from run_stats import RunStats, RunContext, COUNTER_NAMES
+from progress_throttle import ProgressThrottle
+from exif_filter import filter_exif_and_orientation, ExifParseError
+from orientation import apply_orientation
+from image_codecs import (OUTPUT_FORMAT_KEEP, OUTPUT_FORMATS, check_output_format, LOSSLESS_FORMATS, FORMAT_EXTENSIONS, choose_output_format, output_path_for_format,
+                          encode_image, conversion_loss, page_count, bits_per_sample)
+from file_copy import FileCopier, COPY_METHODS
+from formats import (CATEGORY_IMAGE, CATEGORY_VIDEO, RAW, SIGNATURE_LENGTH, EXTENSION_FORMATS, detect_format,
+                     detect_format_from_bytes, route_category, extract_raw_preview)
+from pipeline_io import Prefetcher, WriteBehind, write_file_atomic, partial_path, DEFAULT_PREFETCH_FILES, DEFAULT_PREFETCH_BYTES
+from path_index import PathSet
+from job_store import JobStore, LEGACY_PROGRESS_FILE_NAME, STATE_QUARANTINED
+from scheduler import (ManifestEntry, RunBudget, FreeSpaceGate, order_manifest, check_schedule, parse_duration, parse_size,
+                       estimated_output_bytes, SCHEDULE_WALK, SCHEDULE_POLICIES, CATEGORY_COPY, DEFAULT_MIN_FREE_BYTES)
+from work_queue import WorkQueue, LeaseKeeper, WORK_QUEUE_FOLDER_NAME, IDLE_POLL_SECONDS, split_items, new_worker_id
+from sync_index import SyncIndex, ORPHANS_DELETE, ORPHAN_POLICIES, settings_hash
+from folder_watcher import FolderWatcher, DEFAULT_SETTLE_SECONDS
+from quality_search import QualitySearch, QUALITY_MODE_FIXED, QUALITY_MODES, camera_key_from_exif
+from verification import OutputVerifier, DEFAULT_SAMPLE_RATE, probe_media
+from sampling import RatioEstimate, choose_sample, combined_interval
+from in_place import InPlaceReplacer, IN_PLACE_FOLDER_NAME
+from failures import (VideoEncodeError, VerificationError, RETRY_ATTEMPTS, FAILURE_REPORT_FILE_NAME,
+                      FFMPEG_OUT_OF_SPACE_MESSAGE, is_transient, is_out_of_space, retry_delay, read_tail,
+                      write_failure_report, read_failure_report)
 
 
 # Constants for output folder name and progress file
+RAW_EXIF_READ_LENGTH = 1024 * 1024  # TIFF based RAW files keep their EXIF near the start
 OUTPUT_FOLDER_NAME = "output"
-PROGRESS_FILE_NAME = "saved-progress.json"
-
-# Global variables for tracking stats
-processed_images_count = 0
-processed_videos_count = 0
-skipped_videos_count = 0
-unsupported_files_count = 0
-failed_files = []  # To track files that fail
-unsupported_files = []  # To track unsupported files
-processed_files = set()
-
-# Sizes tracking
-total_original_images_size = 0
-total_final_images_size = 0
-total_original_videos_size = 0
-total_final_videos_size = 0
-total_unsupported_files_size = 0  # New: Track size of unsupported files
-total_skipped_videos_size = 0  # New: Track size of skipped videos
+RUN_REPORT_FILE_NAME = "run-report.json"
+SMALL_VIDEO_MB = 10  # Videos below this size are copied instead of compressed
+# ffmpeg encoders in the order they are tried, with the options that go before the input
+VIDEO_ENCODERS = (
+    ('h264_videotoolbox', ['-hwaccel', 'videotoolbox']),
+    ('libx264', []),  # Software fallback when the hardware encoder fails or isn't available
+)
+# Trial encodes of the compression analysis (--trial)
+DEFAULT_TRIAL_SAMPLES = 30  # Files sampled per category
+TRIAL_EXCERPT_SECONDS = 10  # Window from the middle of each sampled video that is encoded
+TRIAL_THREADS = max(2, min(4, os.cpu_count() or 2))
+
+# Stem counts of recently seen input folders, see shares_stem_with_sibling
+FOLDER_STEMS_CACHE_SIZE = 64
+_folder_stems = {}
+
+# Stats, settings and timings of the run in progress (replaced by every process_files call)
+current_run = RunContext(None, None, None, RunStats(), StageTimer())
+run_report_path = RUN_REPORT_FILE_NAME
 
 def format_size(size_in_bytes):
     """Returns size in MB or GB depending on the size."""
@@ -37,342 +68,1155 @@ def format_size(size_in_bytes):
     else:
         return f"{size_in_bytes / (1024 * 1024):.2f} MB"
 
-def save_progress(processed_files):
-    """Saves the processed files and size data to the progress file."""
-    data = {
-        'processed_files': list(processed_files),
-        'total_original_images_size': total_original_images_size,
-        'total_final_images_size': total_final_images_size,
-        'total_original_videos_size': total_original_videos_size,
-        'total_final_videos_size': total_final_videos_size,
-        'total_unsupported_files_size': total_unsupported_files_size,  # Save unsupported files size
-        'total_skipped_videos_size': total_skipped_videos_size  # Save skipped videos size
-    }
-    try:
-        with open(PROGRESS_FILE_NAME, 'w') as f:
-            json.dump(data, f)
-    except Exception as e:
-        print(f"An error occurred while saving file progress to the file: {e}")
-
-
-def load_progress():
-    """Loads the processed files and size data from the progress file."""
-    global total_original_images_size, total_final_images_size
-    global total_original_videos_size, total_final_videos_size
-    global total_unsupported_files_size, total_skipped_videos_size
-
-    if os.path.exists(PROGRESS_FILE_NAME):
-        with open(PROGRESS_FILE_NAME, 'r') as f:
-            data = json.load(f)
-            total_original_images_size = data.get('total_original_images_size', 0)
-            total_final_images_size = data.get('total_final_images_size', 0)
-            total_original_videos_size = data.get('total_original_videos_size', 0)
-            total_final_videos_size = data.get('total_final_videos_size', 0)
-            total_unsupported_files_size = data.get('total_unsupported_files_size', 0)  # Load unsupported size
-            total_skipped_videos_size = data.get('total_skipped_videos_size', 0)  # Load skipped videos size
-            print("Loaded progress successfully")
-            return set(data.get('processed_files', []))
-   
-    print("Error: " + PROGRESS_FILE_NAME + " not found. Loading progress failed.")
-    return set()
-
-def load_image(input_file):
-    """Loads an image from the input file and returns the image object."""
+def load_progress(jobs):
+    """Loads the processed files and the stats to continue from out of the job database."""
+    jobs.import_legacy_progress()
+    done_index = jobs.done_index()
+    if len(done_index):
+        logger.info("Loaded progress successfully (%d files done)", len(done_index))
+    else:
+        logger.warning("Error: no saved progress in %s. Loading progress failed.", jobs.path)
+    return PathSet(done_index), RunStats.from_checkpoint(jobs.checkpoint())
+
+def copy_file(input_file, output_file, ctx):
+    """Copies a file unchanged with the cheapest method available and counts the method used."""
+    with ctx.timer.stage("copy"):
+        method = ctx.copier.copy(input_file, output_file)
+    if ctx.verifier is not None:
+        with ctx.timer.stage("verify"):
+            ctx.verifier.verify_copy(input_file, output_file)
+    ctx.stats.add(**{f'copied_{method}_count': 1})
+    return method
+
+def load_image(input_file, ctx, media_format=None, data=None):
+    """Loads an image from the input file and returns the image object.
+
+    For RAW files the largest embedded JPEG preview is loaded instead.
+    data is the file's content when the prefetcher already read it.
+    """
     try:
-        return Image.open(input_file)
-    except UnidentifiedImageError:
-        print(f"\033[31mFailed to process image (corrupt) (Copying anyway...): {input_file}\033[0m")
-        failed_files.append(input_file)
+        with ctx.timer.stage("decode"):
+            if media_format is RAW:
+                img = extract_raw_preview(input_file, data)
+                if img is None:
+                    raise UnidentifiedImageError(f"No JPEG preview found in {input_file}")
+            else:
+                img = Image.open(io.BytesIO(data) if data is not None else input_file)
+                img.load()  # Image.open is lazy, force the decode so it is timed here
+        return img
+    except (UnidentifiedImageError, OSError):
+        logger.error("Failed to process image (corrupt) (Copying anyway...): %s", input_file)
+        ctx.stats.record_failed(input_file, "corrupt image")
         return None
 
-def filter_exif_data(exif_data, essential_tags=None):
-    """Filters EXIF data to retain only the essential tags."""
-    if essential_tags is None:
-        essential_tags = [ 
-            271, # Manufacturer of the camera used to capture the image.
-            272, # Model of the camera used to capture the image.
-            274, # Orientation of the image
-            36867, # Date and time when the photo was originally taken.
-            40962, # Image width in pixels.
-            40963, # Image height in pixels.
-            # 34853, # GPS data
-        ]
+def filter_exif_data(exif_data, include_gps=False):
+    """Filters EXIF data to retain only the essential tags (camera, date, dimensions and optionally GPS).
 
+    Returns (filtered exif, orientation). The orientation is reset to normal in the filtered data,
+    the caller has to apply it to the pixels.
+    """
     if not exif_data:
-        print("No exif found")
-        return None
+        logger.debug("No exif found")
+        return None, 1
 
     try:
-        exif_dict = piexif.load(exif_data)  # Load EXIF data into a dictionary
-        # Filter the EXIF dictionary to retain only essential tags
-        filtered_exif_dict = {
-            ifd: {tag: value for tag, value in exif_dict[ifd].items() if tag in essential_tags}
-            for ifd in exif_dict
-        }
-        return piexif.dump(filtered_exif_dict)  # Convert filtered EXIF dictionary back to bytes
-    except Exception as e:
-        print(f"\033[31mFailed to filter EXIF data: Error: {e}\033[0m")
-        return None  # Return None if filtering fails
+        return filter_exif_and_orientation(exif_data, include_gps=include_gps)
+    except ExifParseError as e:
+        logger.error("Failed to filter EXIF data: Error: %s", e)
+        return None, 1  # Return no EXIF if filtering fails
+
+def save_compressed_image(img, output_file, ctx, exif_data=None, output_format=None, progressive=False, original_file=None):
+    """Saves the image with compression and optional EXIF data, in the input's format unless output_format is given.
 
-def save_compressed_image(img, output_file, exif_data=None):
-    """Saves the image with compression and optional EXIF data."""
+    original_file: for lossless formats, the input is copied instead when re-encoding doesn't make it smaller.
+    Returns the size of the output. With write-behind the output is written in the background.
+    """
 
         
     quality = 20
-    if image_quality:
-        quality = image_quality
-        print("Compressing with quality: ", quality)
+    if ctx.image_quality:
+        quality = ctx.image_quality
+    output_format = output_format or img.format
     try:
-        if exif_data is None: 
-            img.save(output_file, optimize=True, quality=quality)
-        else:
-            print("Saving with exif data present")
-            img.save(output_file, optimize=True, quality=quality, exif=exif_data)
+        searched_data = None
+        if ctx.quality_search and output_format not in LOSSLESS_FORMATS:
+            with ctx.timer.stage("quality_search"):
+                quality, searched_data = ctx.quality_search.choose_quality(
+                    img, output_format, camera_key_from_exif(exif_data), progressive=progressive)
+        logger.debug("Compressing with quality: %s", quality)
+
+        # Encode into memory first so encoding and disk writes are timed separately
+        with ctx.timer.stage("encode"):
+            if exif_data is not None:
+                logger.debug("Saving with exif data present")
+            if searched_data is not None and exif_data is None:
+                data = searched_data  # The search already encoded the full image at this quality
+            else:
+                data = encode_image(img, output_format, quality, exif_data=exif_data, progressive=progressive)
+        if output_format in LOSSLESS_FORMATS and original_file and len(data) >= os.path.getsize(original_file):
+            logger.debug("Lossless re-encode is not smaller, keeping the original: %s", original_file)
+            copy_file(original_file, output_file, ctx)
+            return os.path.getsize(output_file)
     except Exception as e:
-        print(f"\033[31mError saving image: {output_file}. Error: {e}\033[0m")
+        logger.error("Error saving image: %s. Error: %s", output_file, e)
+        return None
+
+    if ctx.verifier is not None:
+        data = verify_encoded_image(img, data, output_file, ctx, output_format, quality)
+
+    def write():
+        while True:
+            try:
+                with ctx.timer.stage("write"):
+                    write_file_atomic(output_file, data)
+                if ctx.verifier is not None and os.path.getsize(output_file) != len(data):
+                    raise OSError(f"{os.path.getsize(output_file)} bytes on disk, {len(data)} written")
+                return
+            except OSError as e:
+                if is_out_of_space(e) and ctx.space is not None and ctx.space.wait_for_room(
+                        len(data), lambda: ctx.is_running, on_pause=lambda: pause_for_space(ctx),
+                        pause_first=True):
+                    continue  # Space freed up, write it again
+                logger.error("Error saving image: %s. Error: %s", output_file, e)
+                ctx.stats.record_failed(output_file, f"write failed: {e}")
+                return
+
+    if ctx.writer is not None:
+        ctx.writer.submit(write, len(data))
+    else:
+        write()
+    return len(data)
+
+def verify_encoded_image(img, data, output_file, ctx, output_format, quality):
+    """Checks the encoded image before it is written; when it doesn't decode, encodes it once more with
+    plain settings (no EXIF, baseline). Returns the data to write, raises VerificationError if both fail."""
+    expected = dict(expected_size=img.size, expected_pages=page_count(img), expected_bits=bits_per_sample(img))
+    try:
+        with ctx.timer.stage("verify"):
+            ctx.verifier.verify_image_data(data, output_file, **expected)
+        return data
+    except VerificationError as e:
+        logger.warning("Output of %s failed verification, encoding it again with plain settings: %s", output_file, e)
+    with ctx.timer.stage("encode"):
+        data = encode_image(img, output_format, quality)
+    with ctx.timer.stage("verify"):
+        ctx.verifier.verify_image_data(data, output_file, **expected)
+    return data
+
+def compress_image(input_file, output_file, ctx, media_format=None, data=None):
+    """Compresses an image, corrects orientation, and preserves essential EXIF data.
+
+    The extension of output_file is rewritten when the output format policy picks another format.
+    RAW files are written as their compressed preview, next to where the RAW would go (IMG_1.CR2 -> IMG_1.CR2.jpg).
+    Returns (path written, its size).
+    """
+    if media_format is None:
+        media_format = detect_format(input_file)
+    input_format = media_format.pillow_format if media_format and media_format.pillow_format else 'JPEG'
+    output_format, progressive = choose_output_format(input_format, ctx.image_format)
 
-def compress_image(input_file, output_file):
-    """Compresses an image, corrects orientation, and preserves essential EXIF data."""
     # Load the image
-    img = load_image(input_file)
+    copy_output_file = output_file  # Where the input goes when it can't be compressed
+    img = load_image(input_file, ctx, media_format, data)
     if img is None:
-        shutil.copy2(input_file, output_file)  # Copy the corrupt file if image loading fails
-        return
-
-    exif_data = img.getexif().tobytes()
+        copy_file(input_file, output_file, ctx)  # Copy the corrupt file if image loading fails
+        return output_file, os.path.getsize(output_file)
+    loss = conversion_loss(img, output_format)
+    if loss is not None:
+        # Multi-page scans and 16-bit TIFFs would come out as one clipped 8-bit page
+        logger.info("Keeping %s unchanged, %s would lose its %s", input_file, output_format, loss)
+        output_file = keep_unchanged(input_file, output_file, ctx)
+        return output_file, os.path.getsize(output_file)
+
+    # Raw EXIF straight from the file, parsed without building Pillow's Exif object
+    with ctx.timer.stage("exif"):
+        raw_exif = img.info.get('exif')
+        if raw_exif is None and media_format is RAW:
+            # Previews rarely carry EXIF, but TIFF based RAW files are an EXIF structure themselves
+            if data is not None:
+                raw_exif = data[:RAW_EXIF_READ_LENGTH]
+            else:
+                with open(input_file, 'rb') as f:
+                    raw_exif = f.read(RAW_EXIF_READ_LENGTH)
+        exif_data, orientation = filter_exif_data(raw_exif, include_gps=ctx.keep_gps)
 
-    if not exif_data:
-        print("No exif found")
+    if media_format is RAW:
+        output_file = output_file + FORMAT_EXTENSIONS['JPEG']
 
-    save_compressed_image(img, output_file, exif_data=exif_data)
+    # Rotate the pixels once here so viewers and thumbnailers don't each have to
+    if orientation != 1:
+        with ctx.timer.stage("orientation"):
+            img = apply_orientation(img, orientation)
 
-def compress_video(input_file, output_file, crf, worker):
-    """Compresses a video and saves it to the output file."""
+    output_file = output_path_for_format(output_file, output_format, keep_name=shares_stem_with_sibling(input_file))
+    try:
+        final_size = save_compressed_image(img, output_file, ctx, exif_data=exif_data, output_format=output_format,
+                                           progressive=progressive, original_file=input_file if orientation == 1 else None)
+        failure = "encode failed"
+    except VerificationError as e:
+        final_size, failure = None, f"verification failed: {e}"
+    if final_size is None:
+        # Encoding failed, keep the original instead of losing the file
+        ctx.stats.record_failed(input_file, failure)
+        output_file = copy_output_file
+        copy_file(input_file, output_file, ctx)
+        final_size = os.path.getsize(output_file)
+    return output_file, final_size
+
+def shares_stem_with_sibling(input_file):
+    """True when another file in the input's folder has the same name apart from the extension.
+
+    Their outputs could end up with the same name once the extension follows the output format
+    (x.jpg and x.png both as x.webp), so such inputs keep their whole name (see output_path_for_format).
+    Names are compared case-insensitively, like APFS does. The folder's listing is cached until it changes.
+    """
+    directory = os.path.dirname(input_file)
+    mtime_ns = os.stat(directory).st_mtime_ns
+    cached = _folder_stems.get(directory)
+    if cached is None or cached[0] != mtime_ns:
+        stems = {}
+        for name in os.listdir(directory):
+            stem = os.path.splitext(name)[0].lower()
+            stems[stem] = stems.get(stem, 0) + 1
+        if len(_folder_stems) >= FOLDER_STEMS_CACHE_SIZE:
+            _folder_stems.clear()
+        cached = _folder_stems[directory] = (mtime_ns, stems)
+    return cached[1].get(os.path.splitext(os.path.basename(input_file))[0].lower(), 0) > 1
+
+def compress_video(input_file, output_file, crf, ctx):
+    """Compresses a video and saves it to the output file.
+
+    The hardware encoder is tried first; when ffmpeg fails with it (or its output fails verification),
+    the video is encoded again with the software encoder. Returns True when the video was written, False when the run was stopped
+    during the encode. Raises VideoEncodeError, with the end of ffmpeg's output, when every encoder failed.
+    ffmpeg writes to a temporary name that is renamed to output_file once the video passed, so another
+    worker encoding the same file never writes into it.
+    """
 
-    image_quality
     speed = "fast"
-    if video_compression_speed:
-        speed = video_compression_speed
-        print("Compressing with speed: ", speed)
-
-    # cmd = [
-    #     'ffmpeg',
-    #     '-i', input_file,
-    #     '-movflags', 'use_metadata_tags',
-    #     '-map_metadata', '0',
-    #     '-c:v', 'libx264',
-    #     '-crf', str(crf),
-    #     '-preset', speed,
-    #     output_file
-    # ]
-
-
-    cmd = [
-        'ffmpeg',
-        '-hwaccel', 'videotoolbox',
+    if ctx.video_compression_speed:
+        speed = ctx.video_compression_speed
+        logger.debug("Compressing with speed: %s", speed)
+
+    # Probed while ffmpeg encodes, the output is compared with it afterwards
+    source_probe = ctx.verifier.probe_source(input_file) if ctx.verifier is not None else None
+    failure, stderr_tail = None, None
+    for encoder, input_options in VIDEO_ENCODERS:
+        encoded_file = partial_path(output_file)
+        cmd = video_command(input_file, encoded_file, crf, speed, encoder, input_options)
+        try:
+            with ctx.timer.stage("ffmpeg"):
+                returncode, stderr_tail = run_ffmpeg(cmd, ctx)
+        except OSError as e:
+            raise VideoEncodeError(f"Could not start ffmpeg: {e}") from e
+        if returncode is None:
+            remove_partial_output(encoded_file)
+            return False
+        if returncode == 0:
+            try:
+                if ctx.verifier is not None:
+                    with ctx.timer.stage("verify"):
+                        ctx.verifier.verify_video(source_probe, input_file, encoded_file, sample_path=output_file)
+                os.replace(encoded_file, output_file)
+                logger.debug("Finished processing %s", input_file)
+                return True
+            except VerificationError as e:
+                failure = f"verification failed: {e}"
+                logger.warning("Output of %s with %s failed verification: %s", input_file, encoder, e)
+        elif stderr_tail and FFMPEG_OUT_OF_SPACE_MESSAGE in stderr_tail:
+            remove_partial_output(encoded_file)
+            raise OSError(errno.ENOSPC, f"ffmpeg: {FFMPEG_OUT_OF_SPACE_MESSAGE}", output_file)
+        else:
+            failure = f"ffmpeg exited with {returncode}"
+            logger.warning("ffmpeg with %s failed on %s (exit code %s): %s", encoder, input_file, returncode,
+                           stderr_tail.splitlines()[-1] if stderr_tail else "no output")
+        remove_partial_output(encoded_file)
+    raise VideoEncodeError(failure, stderr_tail)
+
+def video_command(input_file, output_file, crf, speed, encoder, input_options, excerpt=None):
+    """Returns the ffmpeg command of a video encode; excerpt=(start, seconds) encodes only that window (trial encodes)."""
+    window = ['-ss', f"{excerpt[0]:.3f}", '-t', f"{excerpt[1]:.3f}"] if excerpt else []
+    return [
+        'ffmpeg', '-nostdin', '-y', '-loglevel', 'error',
+        *input_options,
+        *window,
         '-i', input_file,
         '-movflags', 'use_metadata_tags',
         '-map_metadata', '0',
-        '-c:v', 'h264_videotoolbox',
+        '-c:v', encoder,
         '-crf', str(crf),
         '-preset', speed,
         output_file
     ]
-    
-    # subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)  # Suppress FFmpeg output
-
-    # Run ffmpeg using Popen so we can terminate it if needed
-    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
 
+def run_ffmpeg(cmd, ctx):
+    """Runs ffmpeg until it exits or the run is stopped.
+
+    Returns (exit code, last lines of its stderr); the exit code is None when it was stopped.
+    stderr goes to a temporary file rather than a pipe, so a chatty ffmpeg can never block on a full pipe.
+    """
+    with tempfile.TemporaryFile() as stderr_file:
+        # Run ffmpeg using Popen so we can terminate it if needed
+        process = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=stderr_file)
+        try:
+            while process.poll() is None:  # While ffmpeg is running
+                if not ctx.is_running:  # If stop is requested
+                    logger.info("Stopping the ffmpeg process")
+                    process.terminate()  # Stop the ffmpeg process
+                    process.wait()  # Wait for it to terminate gracefully
+                    return None, read_tail(stderr_file)
+                ctx.progress.poll()  # Deliver progress that was held back by the throttle
+                try:
+                    process.wait(timeout=1)  # Returns as soon as ffmpeg exits, so encodes can be timed
+                except subprocess.TimeoutExpired:
+                    pass
+        except BaseException:
+            process.terminate()  # Ensure ffmpeg is stopped on error
+            process.wait()  # Ensure the process is cleaned up
+            raise
+        return process.returncode, read_tail(stderr_file)
+
+def remove_partial_output(output_file):
+    """Removes what a failed or stopped encode left behind, so it is never mistaken for a finished output."""
     try:
-        while process.poll() is None:  # While ffmpeg is running
-            if not worker._is_running:  # If stop is requested
-                print("Stopping the ffmpeg process")
-                process.terminate()  # Stop the ffmpeg process
-                process.wait()  # Wait for it to terminate gracefully
-                break
-            time.sleep(1)  # Sleep for a bit before checking again
-
-        if process.poll() is not None:  # Process finished
-            print(f"Finished processing {input_file}")
-
-    except Exception as e:
-        print(f"Error while processing: {e}")
-        process.terminate()  # Ensure ffmpeg is stopped on error
-        process.wait()  # Ensure the process is cleaned up
-    
-def get_total_size_from_list(file_list):
-    """Returns the total size of all files in the file_list."""
-    total_size = 0
-    for file_path in file_list:
-        if os.path.isfile(file_path):  # Check if the file exists and is a file
-            total_size += os.path.getsize(file_path)
-        else:
-            print(f"File not found or not a file: {file_path}")
-    return total_size
-
-
-def process_files(folder, outputFolder, shouldLoadProgress, worker, video_compression_speed_value, image_quality_value):
-    """Recursively processes files in the given folder."""
-    global processed_images_count, processed_videos_count, skipped_videos_count, unsupported_files_count
-    global total_original_images_size, total_final_images_size
-    global total_original_videos_size, total_final_videos_size
-    global total_unsupported_files_size, total_skipped_videos_size
-    global image_quality, video_compression_speed
+        os.remove(output_file)
+    except FileNotFoundError:
+        pass
+
+def process_files(folder, outputFolder, shouldLoadProgress, worker, video_compression_speed_value, image_quality_value, total_size=None, keep_gps=False, image_format=OUTPUT_FORMAT_KEEP,
+                  quality_mode=QUALITY_MODE_FIXED, quality_target=None, raw_previews=False,
+                  allow_hardlinks=False, mirror=False, orphan_policy=ORPHANS_DELETE,
+                  watch=False, watch_settle_seconds=DEFAULT_SETTLE_SECONDS, watch_polling=False,
+                  prefetch_files=DEFAULT_PREFETCH_FILES, prefetch_bytes=DEFAULT_PREFETCH_BYTES, schedule=SCHEDULE_WALK,
+                  max_duration=None, max_input_bytes=None, max_cpu_seconds=None, retry_failed=False,
+                  verify=False, verify_sample=DEFAULT_SAMPLE_RATE, in_place=False, trash_days=None,
+                  min_free=0):
+    """Recursively processes files in the given folder.
+
+    total_size: size of the input folder from analyze_compression_time, used for the progress percentage.
+    keep_gps: keep GPS location tags in the EXIF data of compressed images.
+    image_format: output format policy for images, one of image_codecs.OUTPUT_FORMATS.
+    quality_mode: 'fixed' uses image_quality_value, 'ssim' and 'bpp' search the quality per image
+        against quality_target (an SSIM score or bits per pixel, see quality_search).
+    raw_previews: compress the embedded JPEG preview of camera RAW files instead of copying them.
+    allow_hardlinks: files that are copied unchanged may be hardlinked to the input when reflinks don't work.
+    mirror: keep the output folder in sync with the input folder using the sync index in the output folder.
+        Only new or changed inputs (size, mtime or settings) are processed, and after a complete scan the
+        outputs of deleted inputs are handled according to orphan_policy (see sync_index.ORPHAN_POLICIES).
+        The sync index replaces the progress file, so resuming is implied.
+    watch: after the folder is processed, keep running and process files as they arrive, once they
+        haven't changed for watch_settle_seconds. Uses inotify on Linux, otherwise (or with
+        watch_polling) the folder is polled.
+    prefetch_files, prefetch_bytes: how many upcoming images (and bytes) are read ahead while the current
+        one is encoded, 0 files turns read-ahead off. Outputs are always written behind on a background thread.
+    schedule: order in which files are processed, one of scheduler.SCHEDULE_POLICIES. Every policy but
+        'walk' scans the whole folder into a manifest first and then sorts it.
+    max_duration, max_input_bytes, max_cpu_seconds: run budgets (seconds, bytes, CPU seconds). Files whose
+        estimated time doesn't fit into what is left are not started, and once a budget is used up (or
+        nothing fit for scheduler.MAX_DEFERRED_IN_A_ROW files) the run finishes the files in flight,
+        checkpoints and returns. Resuming continues with the remaining files.
+    retry_failed: only process the files listed in the failure report of the output folder (failed or
+        quarantined by earlier runs of the job), continuing the job's progress like a resume.
+    verify: check every output before its file is checkpointed (see verification.OutputVerifier), with a
+        full decode for the verify_sample share of the files. Outputs that fail are produced again.
+    in_place: replace the inputs with their outputs instead of writing an output folder, so no second
+        copy of the library is needed (see in_place.InPlaceReplacer). Only verified outputs that are
+        smaller than their input replace it, everything else keeps the original. trash_days keeps the
+        originals in a trash for that many days, None deletes them. Not combinable with mirror or raw_previews.
+    min_free: bytes the output volume keeps free, none unless asked for (the CLI's --min-free defaults to
+        scheduler.DEFAULT_MIN_FREE_BYTES). Files are only started while their estimated outputs fit above
+        it, otherwise the run pauses until space frees up or leaves the file for the next run.
+    """
+    global current_run, run_report_path
+
+    if in_place and mirror:
+        logger.error("In-place mode replaces the inputs, it can't mirror them into an output folder.")
+        return
+    if in_place and raw_previews:
+        logger.error("In-place mode would replace camera RAW files by their JPEG previews, it can't use RAW previews.")
+        return
+    if orphan_policy not in ORPHAN_POLICIES:
+        # Checked before the run, remove_orphans would only refuse it after the whole scan
+        raise ValueError(f"Unknown orphan policy {orphan_policy!r}, expected one of {', '.join(ORPHAN_POLICIES)}")
+    if schedule:
+        check_schedule(schedule)  # Before the scan, order_manifest would only refuse it afterwards
+
+    # The watcher reports absolute paths, the scan, the job database and the failure report must use the same ones
+    folder = os.path.abspath(folder)
+    jobs = JobStore()
+    retry_files = None
+    if retry_failed:
+        retry_files = read_failure_report(os.path.join(reports_folder_for(folder, outputFolder, in_place), FAILURE_REPORT_FILE_NAME))
+        logger.info("Retrying %d files from the failure report.", len(retry_files))
+        jobs.forget(retry_files)  # Their earlier results are replaced by this run's
+
+    # Load processed files if resuming, otherwise every counter starts from zero
+    if mirror:
+        logger.info("Mirror mode, skipping unchanged files using the sync index.")
+        jobs.reset()
+        processed_files, stats = PathSet(), RunStats()
+    elif shouldLoadProgress or retry_failed: 
+        processed_files, stats = load_progress(jobs)
+        # Sizes of files finished by earlier runs are only needed once, not per progress event
+        stats.add(already_processed_files_size=jobs.done_input_bytes())
+    else:
+        logger.info("Restarting without loading progress.")
+        processed_files, stats = PathSet(), RunStats()
+        jobs.reset()
+        if os.path.exists(LEGACY_PROGRESS_FILE_NAME):
+            os.remove(LEGACY_PROGRESS_FILE_NAME)
+            logger.info("%s has been removed. Fresh start...", LEGACY_PROGRESS_FILE_NAME)
+
+    ctx = create_run_context(folder, outputFolder, worker, stats, jobs, image_quality=image_quality_value,
+                             video_compression_speed=video_compression_speed_value, total_size=total_size,
+                             keep_gps=keep_gps, image_format=image_format, quality_mode=quality_mode,
+                             quality_target=quality_target, raw_previews=raw_previews, allow_hardlinks=allow_hardlinks,
+                             verify=verify or in_place, verify_sample=verify_sample, min_free=min_free)
+    if in_place:
+        ctx.in_place = InPlaceReplacer(folder, trash_days).open()
+        ctx.output_folder = ctx.in_place.staging_folder  # Outputs are staged next to the inputs, on the same volume
+        ctx.space.path = ctx.output_folder
+    output_folder = ctx.output_folder
+    # Read back by the UI when it starts, so a paused run can be continued
+    jobs.set_run_state(inputFolder=folder, outputFolder=outputFolder, settings=run_settings(ctx))
+    if total_size:
+        jobs.set_run_state(total_size=total_size)
+    ctx.processed_files = processed_files
+    current_run = ctx
+    progress_log = RateLimitedProgress()
 
-    # Load processed files if resuming
+    os.makedirs(output_folder, exist_ok=True)  # Create the output folder if it doesn't exist
+    logger.info("Output folder: %s", output_folder)
+    if mirror:
+        ctx.sync_index = SyncIndex(output_folder).load()
+    # Started before the scan so files arriving while it runs are not missed
+    watcher = FolderWatcher(folder, watch_settle_seconds, ignore_folder=ctx.in_place.root if in_place else output_folder,
+                            force_polling=watch_polling) if watch else None
+    watch_started_ns = time.time_ns()
+    run_report_path = os.path.join(reports_folder_for(folder, outputFolder, in_place), RUN_REPORT_FILE_NAME)
     
-    global processed_files
-    if shouldLoadProgress: 
-        processed_files = load_progress()
+    inputs = scan_inputs(folder, ctx) if retry_files is None else listed_inputs(retry_files, ctx)
+    if schedule and schedule != SCHEDULE_WALK:
+        manifest = order_manifest(build_manifest(inputs, ctx), schedule, manifest_estimate_seconds(ctx))
+        logger.info("Scheduled %d files with the %s policy", len(manifest), schedule)
+        inputs = [entry.path for entry in manifest]
+    budget = RunBudget(manifest_estimate_seconds(ctx), max_duration, max_input_bytes, max_cpu_seconds)
+    if prefetch_files:
+        # Read the next images on I/O threads while the current one is encoded, unless they are left
+        # for the next run anyway
+        inputs = Prefetcher(inputs, lambda path: not budget.deferring and should_prefetch(path, ctx),
+                            max_files=prefetch_files, max_bytes=prefetch_bytes)
     else:
-        print("\n\n\n\nRestarting without loading progress.****")
-        total_original_images_size = 0
-        total_original_videos_size = 0
-        processed_files = set()
-        if os.path.exists(PROGRESS_FILE_NAME):
-            os.remove(PROGRESS_FILE_NAME)
-            print(f"{PROGRESS_FILE_NAME} has been removed. Fresh start...")
-
-    if video_compression_speed_value:
-        video_compression_speed = video_compression_speed_value
-    if image_quality_value:
-        image_quality = image_quality_value
-    
+        inputs = ((input_file, None) for input_file in inputs)
+    for input_file, data in inputs:
+        if not ctx.is_running:
+            break
+        if not budget.limited:
+            process_input(input_file, ctx, progress_log, data)
+            continue
+
+        ctx.budget_stop_reason = budget.exhausted()
+        if ctx.budget_stop_reason:
+            logger.warning("The %s budget is used up, stopping. Resume with -R to continue.", ctx.budget_stop_reason)
+            break
+        size = len(data) if data is not None else os.path.getsize(input_file)
+        category = manifest_category(input_file, size, ctx)
+        if not budget.admit(category, size):
+            logger.debug("Left for the next run, not expected to finish within the budget: %s", input_file)
+            stats.add(deferred_files_count=1)
+            continue
+        started = time.perf_counter()
+        process_input(input_file, ctx, progress_log, data)
+        budget.observe(category, size, time.perf_counter() - started)
+
+    ctx.writer.drain()
+    ctx.progress.flush()
+
+    if ctx.sync_index is not None:
+        if ctx.is_running and retry_files is None and not ctx.budget_stop_reason and not stats.get('deferred_files_count'):
+            # Only a complete scan tells which inputs are gone
+            stats.add(orphaned_outputs_count=ctx.sync_index.remove_orphans(orphan_policy))
+        ctx.sync_index.save()
 
+    try:
+        if watcher is not None and not ctx.budget_stop_reason:
+            watch_folder(ctx, watcher, watch_started_ns, progress_log)
+    finally:
+        if watcher is not None:
+            watcher.close()
+        ctx.writer.close()
+        if ctx.verifier is not None:
+            ctx.verifier.close()
+        if ctx.in_place is not None:
+            ctx.in_place.close()
+        if ctx.sync_index is not None:
+            ctx.sync_index.save()
+        processed_files.close()
+        write_job_failure_report()  # The last use of the job database
+        jobs.close()
+        ctx.jobs = None
+
+    snapshot = stats.snapshot()
+    logger.info("Processed %d images with total original size: %s and total final size: %s.",
+                snapshot['processed_images_count'], format_size(snapshot['total_original_images_size']),
+                format_size(snapshot['total_final_images_size']))
+    logger.info("Processed %d videos with total original size: %s and total final size: %s.",
+                snapshot['processed_videos_count'], format_size(snapshot['total_original_videos_size']),
+                format_size(snapshot['total_final_videos_size']))
+    write_run_report()
+
+def output_folder_for(folder, outputFolder):
+    """Returns the folder the outputs of a run over folder are written to."""
     if outputFolder:
         # Create the output folder inside the given outputFolder path
-        output_folder = os.path.join(outputFolder, OUTPUT_FOLDER_NAME)
+        return os.path.join(outputFolder, OUTPUT_FOLDER_NAME)
+    # Create the output folder as a sibling directory
+    return os.path.join(os.path.dirname(folder), OUTPUT_FOLDER_NAME)
+
+def reports_folder_for(folder, outputFolder, in_place=False):
+    """Returns the folder the run and failure reports of a run over folder are written to."""
+    if in_place:
+        return os.path.join(folder, IN_PLACE_FOLDER_NAME)
+    return output_folder_for(folder, outputFolder)
+
+def create_run_context(folder, outputFolder, worker, stats, jobs, image_quality=None, video_compression_speed=None,
+                       total_size=None, keep_gps=False, image_format=OUTPUT_FORMAT_KEEP, quality_mode=QUALITY_MODE_FIXED,
+                       quality_target=None, raw_previews=False, allow_hardlinks=False, verify=False,
+                       verify_sample=DEFAULT_SAMPLE_RATE, min_free=0):
+    """Builds the RunContext of a run, or of a queue worker, from its settings (see process_files)."""
+    check_output_format(image_format or OUTPUT_FORMAT_KEEP)  # Before any file, every image would fail on it
+    ctx = RunContext(folder, output_folder_for(folder, outputFolder), worker, stats, StageTimer(),
+                     image_quality=image_quality, video_compression_speed=video_compression_speed,
+                     requested_output_folder=outputFolder, total_size=total_size,
+                     progress=ProgressThrottle(worker.progress.emit), keep_gps=keep_gps,
+                     image_format=image_format or OUTPUT_FORMAT_KEEP,
+                     copier=FileCopier(allow_hardlinks=allow_hardlinks))
+    ctx.raw_previews = raw_previews
+    ctx.writer = WriteBehind()
+    ctx.jobs = jobs
+    if quality_mode and quality_mode != QUALITY_MODE_FIXED:
+        ctx.quality_search = QualitySearch(quality_mode, quality_target)
+    ctx.space = FreeSpaceGate(ctx.output_folder, min_free)
+    if verify:
+        ctx.verifier = OutputVerifier(verify_sample)
+    ctx.settings_hash = settings_hash(run_settings(ctx))
+    return ctx
+
+def run_coordinator(folder, outputFolder, worker, resume=False, local_workers=0, schedule=SCHEDULE_WALK, **settings):
+    """Splits the folder into work items in a queue on shared storage and waits for queue workers to finish them.
+
+    Workers on any machine that sees the same storage join with --worker. local_workers starts that many
+    worker processes on this machine. The workers' results are added up into this run's summary.
+    settings are the keyword settings of create_run_context, every worker uses them.
+    """
+    global current_run, run_report_path
+    check_schedule(schedule)
+    folder = os.path.abspath(folder)  # Like process_files, so failure reports name the same paths
+    ctx = create_run_context(folder, outputFolder, worker, RunStats(), JobStore(":memory:"), **settings)
+    current_run = ctx
+    os.makedirs(ctx.output_folder, exist_ok=True)
+    run_report_path = os.path.join(ctx.output_folder, RUN_REPORT_FILE_NAME)
+    queue = WorkQueue(os.path.join(ctx.output_folder, WORK_QUEUE_FOLDER_NAME))
+
+    if resume and queue.exists():
+        logger.info("Continuing the work queue in %s", queue.folder)
     else:
-        # Create the output folder as a sibling directory
-        output_folder = os.path.join(os.path.dirname(folder), OUTPUT_FOLDER_NAME)
+        manifest = order_manifest(build_manifest(scan_inputs(folder, ctx), ctx), schedule, manifest_estimate_seconds(ctx))
+        items = split_items([(os.path.relpath(entry.path, folder), entry.size) for entry in manifest])
+        queue.create(items, {'input_folder': folder, 'settings': settings})
+        logger.info("Queued %d files in %d work items in %s", len(manifest), len(items), queue.folder)
+    item_count = queue.manifest()['item_count']
 
-    os.makedirs(output_folder, exist_ok=True)  # Create the output folder if it doesn't exist
-    print(f"Output folder: {output_folder}")  # Print the output folder location
-    
-    for dirpath, _, filenames in os.walk(folder):
-        if not worker._is_running:
-            print("Processing stopped by user (Outer loop).")
+    worker_command = [sys.executable, os.path.abspath(__file__), folder, '--worker']
+    if outputFolder:
+        worker_command += ['-o', outputFolder]
+    worker_command += [flag for flag in ('--verbose', '--quiet') if flag in sys.argv]
+    processes = [subprocess.Popen(worker_command) for _ in range(local_workers)]
+
+    progress_log = RateLimitedProgress()
+    while ctx.is_running:
+        done = queue.done_count()
+        progress_log.log("Work items done: %d of %d", done, item_count)
+        if done >= item_count:
             break
-        for filename in filenames:
-            if not worker._is_running:
-                print("Processing stopped by user (Inner Loop).")
+        if processes and all(process.poll() is not None for process in processes):
+            logger.warning("All local workers exited with %d work items left", item_count - done)
+            break
+        time.sleep(1)
+    for process in processes:
+        process.wait()
+
+    # One summary for all workers
+    failures = []
+    for result in queue.results():
+        ctx.stats.add(**{name: result.get(name, 0) for name in COUNTER_NAMES if name != 'in_flight_count'})
+        for path in result.get('failed_files', []):
+            ctx.stats.record_failed(path)
+        for failure in result.get('failures', []):
+            ctx.stats.record_failed(failure['path'], failure['error'], failure['detail'])
+            if failure['state'] == STATE_QUARANTINED:
+                ctx.stats.record_quarantined(failure['path'])
+        for path in result.get('unsupported_files', []):
+            ctx.stats.record_unsupported(path)
+        failures += result.get('failures', [])
+    ctx.writer.close()
+    if ctx.verifier is not None:
+        ctx.verifier.close()
+    write_run_report()
+    write_failure_report(failure_report_path(), folder, failures)
+
+def run_queue_worker(folder, outputFolder, worker):
+    """Claims work items from the queue in the output folder and processes them until every item is done.
+
+    folder is where this machine sees the input folder; the queue stores paths relative to it.
+    """
+    global current_run
+    folder = os.path.abspath(folder)
+    queue = WorkQueue(os.path.join(output_folder_for(folder, outputFolder), WORK_QUEUE_FOLDER_NAME))
+    if not queue.exists():
+        logger.error("No work queue in %s, start a coordinator first", queue.folder)
+        return
+    manifest = queue.manifest()
+    worker_id = new_worker_id()
+    ctx = create_run_context(folder, outputFolder, worker, RunStats(), JobStore(":memory:"), **manifest['settings'])
+    current_run = ctx
+    logger.info("Worker %s joined the queue in %s", worker_id, queue.folder)
+
+    while ctx.is_running:
+        item_id = queue.claim(worker_id)
+        if item_id is None:
+            if queue.done_count() >= manifest['item_count']:
                 break
+            time.sleep(IDLE_POLL_SECONDS)  # The rest is leased, one of them may expire
+            continue
+
+        ctx.stats = RunStats()  # Each item reports only its own counters and failures
+        ctx.jobs = JobStore(":memory:")
+        with LeaseKeeper(queue, item_id, worker_id) as lease:
+            ctx.lease = lease  # Losing it stops the file in flight, see RunContext.is_running
+            try:
+                for relative_path in queue.item_paths(item_id):
+                    if not ctx.is_running:
+                        break
+                    input_file = os.path.join(folder, relative_path)
+                    if os.path.isfile(input_file):  # Removed since it was queued
+                        process_file(input_file, ctx)
+                ctx.writer.drain()
+            finally:
+                ctx.lease = None
+        if lease.lost:
+            continue
+        if not ctx.is_running:
+            queue.release(item_id, worker_id)
+            break
+        result = {name: value for name, value in ctx.stats.snapshot().items() if name in COUNTER_NAMES}
+        result['failed_files'] = ctx.stats.failed_files
+        result['unsupported_files'] = ctx.stats.unsupported_files
+        result['failures'] = ctx.jobs.failures()
+        queue.complete(item_id, worker_id, result)
+        logger.info("Finished work item %d (%d files)", item_id, result['files_done_count'])
+    ctx.writer.close()
+    if ctx.verifier is not None:
+        ctx.verifier.close()
+
+def scan_inputs(folder, ctx):
+    """Yields the input files of the folder that still need processing, until the run is stopped."""
+    stats = ctx.stats
+    for dirpath, dirnames, filenames in timed_walk(folder, ctx):
+        if not ctx.is_running:
+            logger.info("Processing stopped by user (Outer loop).")
+            return
+        if IN_PLACE_FOLDER_NAME in dirnames:
+            dirnames.remove(IN_PLACE_FOLDER_NAME)  # Staged outputs and the trash of in-place runs
+        stats.add(files_discovered_count=len(filenames))
+        for filename in filenames:
+            if not ctx.is_running:
+                logger.info("Processing stopped by user (Inner Loop).")
+                return
             input_file = os.path.join(dirpath, filename)
-            relative_path = os.path.relpath(input_file, folder)
-            output_file = os.path.join(output_folder, relative_path)  # Update to use the sibling output folder
-
-            # Create the output directory if it doesn't exist
-            os.makedirs(os.path.dirname(output_file), exist_ok=True)
 
             # Skip files that have already been processed
-            if input_file in processed_files:
+            if input_file in ctx.processed_files or is_replaced_in_place(input_file, ctx):
+                stats.add(files_done_count=1)
                 continue
-            
-            notify_data = {
-                "processed_images_count": 0,
-                "processed_videos_count": 0,
-                "total_original_images_size": 0,
-                "total_original_videos_size": 0
-            }   
-            
-            # Process based on file type
-            if filename.lower().endswith(('.jpg', '.jpeg', '.png', '.gif')):
-                print(f"\033[32mCompressing image: {input_file}\033[0m")
-                original_size = os.path.getsize(input_file)
-                total_original_images_size += original_size
-
-                start_time = time.time()  # Record the start time
-                compress_image(input_file, output_file)
-                end_time = time.time()  # Record the end time
-                elapsed_time = end_time - start_time
-
-                print(f"Compression finished in {elapsed_time:.4f} seconds.") 
-
-                final_size = os.path.getsize(output_file)
-                total_final_images_size += final_size
-                
-                processed_images_count += 1
-                notify_data['processed_images_count'] = processed_images_count
-                notify_data['total_original_images_size'] = total_original_images_size
-                notify_data['processed_videos_count'] = processed_videos_count
-                notify_data['total_original_videos_size'] = total_original_videos_size
-                notify_data['already_processed_files_size'] = get_total_size_from_list(processed_files)
-
-                worker.progress.emit(notify_data)
-                print(f"Processed {input_file}: {format_size(original_size)} -> {format_size(final_size)} , (Decrease: {calculate_percentage_decrease(original_size, final_size):.2f} %)")
-
-            elif filename.lower().endswith(('.mp4', '.mkv', '.mov')):
-                input_size = os.path.getsize(input_file)
-                input_size_mb = input_size / (1024 * 1024)
-                crf = 47  # Default CRF value
-
-                # Determine CRF based on file size
-                if input_size_mb < 10:
-                    print(f"Copying video (too small ({input_size_mb} MB)): {input_file}")
-                    # Copy the file instead of compressing
-                    shutil.copy2(input_file, output_file)
-                    skipped_videos_count += 1
-                    total_skipped_videos_size += input_size  # Track skipped video size
-                else:
-                    if 10 <= input_size_mb < 20:
-                        crf = 34
-                    elif 20 <= input_size_mb < 50:
-                        crf = 35
-                    elif 50 <= input_size_mb < 150:
-                        crf = 38
-                    elif 150 <= input_size_mb < 300:
-                        crf = 39
-                    elif 300 <= input_size_mb < 500:
-                        crf = 40
-                    elif 500 <= input_size_mb < 1024:
-                        crf = 41
-                    else:
-                        crf = 42
-
-                    original_size = os.path.getsize(input_file)
-                    print(f"\033[33mCompressing video (Size= {format_size(original_size)} ) (CRF {crf}): {input_file}\033[0m")
-                   
-                    total_original_videos_size += original_size
-                    compress_video(input_file, output_file, crf, worker)
-
-                    final_size = os.path.getsize(output_file)
-                    total_final_videos_size += final_size
-
-                    processed_videos_count += 1
-
-                    notify_data['processed_images_count'] = processed_images_count
-                    notify_data['total_original_images_size'] = total_original_images_size
-                    notify_data['processed_videos_count'] = processed_videos_count
-                    notify_data['total_original_videos_size'] = total_original_videos_size
-                    notify_data['already_processed_files_size'] = get_total_size_from_list(processed_files)
-
-                    worker.progress.emit(notify_data)
-
-                    percentage_decrease = 100 * (original_size - final_size) / original_size if original_size > 0 else 0
-                    print(f"Processed {input_file}: {format_size(original_size)} -> {format_size(final_size)} (Decrease: {percentage_decrease:.2f}%)")
-                processed_videos_count += 1  # Count copied video as processed
+            yield input_file
 
-            else:
-                # Unsupported file type, copy it directly and log it
-                print(f"\033[33mCopying unsupported file: {input_file}\033[0m")
-                file_size = os.path.getsize(input_file)
-                total_unsupported_files_size += file_size  # Track unsupported file size
-                shutil.copy2(input_file, output_file)
-                unsupported_files.append(input_file)
-                unsupported_files_count += 1
+def is_replaced_in_place(input_file, ctx):
+    """True for outputs of earlier in-place runs, which must not be compressed again."""
+    if ctx.in_place is None:
+        return False
+    try:
+        return ctx.in_place.is_replaced(input_file, os.stat(input_file))
+    except FileNotFoundError:
+        return False
+
+def listed_inputs(paths, ctx):
+    """Yields the listed input files that still exist, in place of a scan (see retry_failed)."""
+    for input_file in paths:
+        if not ctx.is_running:
+            return
+        if os.path.isfile(input_file):
+            ctx.stats.add(files_discovered_count=1)
+            yield input_file
+        else:
+            logger.warning("Not retrying %s, it no longer exists", input_file)
+
+def manifest_category(input_file, size, ctx):
+    """Guesses from the extension which pipeline a file will take, without reading it."""
+    media_format = EXTENSION_FORMATS.get(os.path.splitext(input_file)[1].lower())
+    category = route_category(media_format, raw_previews=ctx.raw_previews)
+    if category == CATEGORY_VIDEO and size < SMALL_VIDEO_MB * 1024 * 1024:
+        return CATEGORY_COPY  # Small videos are copied
+    return category or CATEGORY_COPY
+
+def build_manifest(inputs, ctx):
+    """Stats every input into a list of ManifestEntry for the scheduler."""
+    manifest = []
+    for input_file in inputs:
+        try:
+            size = os.path.getsize(input_file)
+        except OSError:
+            continue  # Removed since the scan listed it
+        manifest.append(ManifestEntry(input_file, size, manifest_category(input_file, size, ctx)))
+    return manifest
+
+def manifest_estimate_seconds(ctx):
+    """Time model for the scheduler, the same estimate the compression analysis shows."""
+    speed = ctx.video_compression_speed or 'fast'
+    return lambda category, size: 60 * estimate_compression_time(size / (1024 * 1024 * 1024), speed, category)
+
+def should_prefetch(input_file, ctx):
+    """Prefetch files that look like images; videos are read by ffmpeg and copies don't need the bytes."""
+    media_format = EXTENSION_FORMATS.get(os.path.splitext(input_file)[1].lower())
+    return route_category(media_format, raw_previews=ctx.raw_previews) == CATEGORY_IMAGE
+
+def process_input(input_file, ctx, progress_log, data=None):
+    """Processes one input found by the scan or the watcher, unless mirror mode knows it is unchanged."""
+    stats = ctx.stats
+    if ctx.sync_index is not None:
+        # Stat before processing, so a file that changes while it is processed is picked up next time
+        stat_result = os.stat(input_file)
+        relative_path = os.path.relpath(input_file, ctx.folder)
+        if ctx.sync_index.is_unchanged(relative_path, stat_result, ctx.settings_hash):
+            stats.add(files_done_count=1, unchanged_files_count=1, already_processed_files_size=stat_result.st_size)
+            return
+
+    on_done = None
+    if ctx.sync_index is not None:
+        def on_done(output_file):
+            ctx.sync_index.record(relative_path, stat_result, ctx.settings_hash, output_file)
+
+    process_file(input_file, ctx, data, on_done)
+
+    snapshot = stats.snapshot()
+    progress_log.log("Progress: %d files done (%d images, %d videos, %d %s)",
+                     snapshot['files_done_count'], snapshot['processed_images_count'],
+                     snapshot['processed_videos_count'], snapshot['unsupported_files_count'],
+                     "kept" if ctx.in_place is not None else "copied")
+
+def watch_folder(ctx, watcher, watch_started_ns, progress_log):
+    """Processes files handed out by the watcher until the run is stopped."""
+    logger.info("Waiting for new files, stop with Ctrl+C.")
+    while ctx.is_running:
+        for input_file in watcher.wait_ready():
+            if not ctx.is_running:
+                break
+            try:
+                stat_result = os.stat(input_file)
+            except FileNotFoundError:
+                continue
+            # The scan already did files that existed before watching started, rewritten files are done again
+            if input_file in ctx.processed_files and stat_result.st_ctime_ns < watch_started_ns:
+                continue
+            if ctx.in_place is not None and ctx.in_place.is_replaced(input_file, stat_result):
+                continue  # Put there by this run
+            logger.info("New file: %s", input_file)
+            ctx.stats.add(files_discovered_count=1)
+            process_input(input_file, ctx, progress_log)
+        ctx.writer.drain()
+        ctx.progress.flush()
+
+def run_settings(ctx):
+    """Settings that change what is written for an input, a changed value makes mirror mode redo the file."""
+    return {
+        'image_quality': ctx.image_quality,
+        'video_compression_speed': ctx.video_compression_speed,
+        'keep_gps': ctx.keep_gps,
+        'image_format': ctx.image_format,
+        'quality_mode': ctx.quality_search.mode if ctx.quality_search else None,
+        'quality_target': ctx.quality_search.target if ctx.quality_search else None,
+        'raw_previews': ctx.raw_previews,
+    }
+
+def get_video_crf(input_size_mb):
+    """Returns the CRF to compress a video with, based on its size."""
+    if 10 <= input_size_mb < 20:
+        return 34
+    elif 20 <= input_size_mb < 50:
+        return 35
+    elif 50 <= input_size_mb < 150:
+        return 38
+    elif 150 <= input_size_mb < 300:
+        return 39
+    elif 300 <= input_size_mb < 500:
+        return 40
+    elif 500 <= input_size_mb < 1024:
+        return 41
+    return 42
+
+def progress_percentage(ctx, snapshot=None):
+    """Returns how much of the input folder is done in percent, or None if its size is unknown."""
+    if not ctx.total_size:
+        return None
+    if snapshot is None:
+        snapshot = ctx.stats.snapshot()
+    done = snapshot['already_processed_files_size'] + snapshot['processed_input_bytes']
+    return min(100 * done / ctx.total_size, 100)
+
+def emit_progress(ctx):
+    """Queues the current counters for the worker's progress signal, coalesced by the throttle."""
+    snapshot = ctx.stats.snapshot()
+    notify_data = {
+        'processed_images_count': snapshot['processed_images_count'],
+        'total_original_images_size': snapshot['total_original_images_size'],
+        'processed_videos_count': snapshot['processed_videos_count'],
+        'total_original_videos_size': snapshot['total_original_videos_size'],
+        'already_processed_files_size': snapshot['already_processed_files_size'],
+        'progress': progress_percentage(ctx, snapshot),
+        'waiting_for_space': ctx.space is not None and ctx.space.waiting,
+        'min_free': ctx.space.min_free if ctx.space is not None else 0,
+    }
+    ctx.progress.update(notify_data)
+
+def process_file(input_file, ctx, data=None, on_done=None):
+    """Compresses or copies a single input file and checkpoints it as processed.
+
+    data: the file's content if the prefetcher already read it.
+    on_done: called with the output path once the output is written and checkpointed.
+    Transient errors (flaky storage) are retried; a file that still fails is quarantined: it gets no
+    output, is listed in the failure report and is skipped when the job is resumed.
+    The file is only started once the output volume has room for its estimated output (see
+    scheduler.FreeSpaceGate); running out of space pauses the file until there is room again. A file
+    that gets no room within the gate's max_wait is left for the next run, like files over the budget.
+    Returns the path of the output file, or None when the file was quarantined, left for the next run
+    or the run was stopped.
+    """
+    stats = ctx.stats
+    reserved_bytes = reserve_output_space(input_file, data, ctx)
+    if reserved_bytes is None:
+        return None  # Stopped while waiting for space, or left for the next run
+    stats.add(in_flight_count=1)
+    started = time.perf_counter()
+    ctx.jobs.file_started(input_file, ctx.settings_hash)
+
+    attempt = 1
+    while True:
+        try:
+            result = convert_file(input_file, ctx, data)
+            break
+        except Exception as e:
+            if is_out_of_space(e) and ctx.space is not None:
+                # Not the file's fault: wait for space and redo it, without using up an attempt
+                logger.warning("Output volume full while processing %s", input_file)
+                if ctx.space.wait_for_room(0, lambda: ctx.is_running, on_pause=lambda: pause_for_space(ctx),
+                                           pause_first=True):
+                    data = None
+                    continue
+                if ctx.is_running:
+                    stats.add(space_deferred_files_count=1)  # Not checkpointed, the next run does it again
+                stats.add(in_flight_count=-1)
+                ctx.space.release(reserved_bytes)
+                return None
+            if is_transient(e) and attempt < RETRY_ATTEMPTS and ctx.is_running:
+                logger.warning("Attempt %d of %d failed for %s, retrying: %s", attempt, RETRY_ATTEMPTS, input_file, e)
+                stats.add(retries_count=1)
+                time.sleep(retry_delay(attempt))
+                attempt += 1
+                data = None  # Read the file again, the prefetched content may be what was bad
+                continue
+            quarantine_file(input_file, ctx, e, attempt, started)
+            ctx.space.release(reserved_bytes)
+            return None
+
+    if result is None:
+        # Stopped in the middle of the file, it is done again when the run is resumed
+        stats.add(in_flight_count=-1)
+        ctx.space.release(reserved_bytes)
+        return None
+    job_category, output_file, final_size = result
+    input_size = os.path.getsize(input_file)
+
+    def finish():
+        output_path = output_file
+        if ctx.in_place is not None:
+            output_path = replace_in_place(input_file, output_file, input_size, final_size, ctx)
+        # Save progress after each file
+        stats.add(processed_input_bytes=input_size)
+        ctx.mark_processed(input_file)
+        failed_path = input_file if stats.failure_reason(input_file) else output_file
+        with ctx.timer.stage("checkpoint"):
+            ctx.jobs.file_finished(input_file, job_category, input_size, output_path, final_size,
+                                   time.perf_counter() - started, stats.failure_reason(failed_path),
+                                   stats.failure_detail(failed_path), attempt)
+        stats.file_finished()
+        ctx.space.release(reserved_bytes)  # The output is on disk now, the volume's free space shows it
+        emit_progress(ctx)
+        if on_done is not None:
+            on_done(output_path)
+
+    # With write-behind the checkpoint waits for the file's output to be written
+    if ctx.writer is not None:
+        ctx.writer.submit(finish)
+    else:
+        finish()
+    return output_file
+
+def reserve_output_space(input_file, data, ctx):
+    """Waits until the output volume has room for the file's estimated output and reserves it.
+
+    Returns the reserved bytes, or None when the run was stopped while waiting or the file got no room
+    in time; it is then counted as deferred and processed by the next run.
+    """
+    size = len(data) if data is not None else os.path.getsize(input_file)
+    nbytes = estimated_output_bytes(manifest_category(input_file, size, ctx), size, in_place=ctx.in_place is not None)
+    if not ctx.space.wait_for_room(nbytes, lambda: ctx.is_running, on_pause=lambda: pause_for_space(ctx)):
+        if ctx.is_running:
+            logger.warning("Left for the next run, no room on the output volume: %s", input_file)
+            ctx.stats.add(space_deferred_files_count=1)
+        return None
+    ctx.space.reserve(nbytes)
+    return nbytes
+
+def pause_for_space(ctx):
+    """Counts a pause for free space and tells the UI right away, the next file may take a while."""
+    ctx.stats.add(space_pauses_count=1)
+    emit_progress(ctx)
+    ctx.progress.flush()
+
+def convert_file(input_file, ctx, data=None):
+    """Writes the output of one input file, by its detected category.
+
+    Returns (job category, output path, output size), or None when the run was stopped during the file.
+    """
+    stats = ctx.stats
+    relative_path = os.path.relpath(input_file, ctx.folder)
+    output_file = os.path.join(ctx.output_folder, relative_path)  # Update to use the sibling output folder
+
+    # Create the output directory if it doesn't exist
+    os.makedirs(os.path.dirname(output_file), exist_ok=True)
+
+    # Route by the file's signature, not its extension
+    with ctx.timer.stage("detect"):
+        if data:
+            media_format = detect_format_from_bytes(data[:SIGNATURE_LENGTH], os.path.splitext(input_file)[1])
+        else:
+            media_format = detect_format(input_file)
+    category = route_category(media_format, raw_previews=ctx.raw_previews)
+    
+    # Process based on file type
+    if category == CATEGORY_IMAGE:
+        logger.debug("Compressing image: %s", input_file)
+        original_size = os.path.getsize(input_file)
+
+        output_file, final_size = compress_image(input_file, output_file, ctx, media_format, data)
+        job_category = 'image'
+
+        stats.add(processed_images_count=1, total_original_images_size=original_size, total_final_images_size=final_size)
+
+        log_processed_file(input_file, original_size, final_size)
+
+    elif category == CATEGORY_VIDEO:
+        input_size = os.path.getsize(input_file)
+        input_size_mb = input_size / (1024 * 1024)
+
+        # Determine CRF based on file size
+        if input_size_mb < SMALL_VIDEO_MB:
+            logger.debug("Copying video (too small (%.2f MB)): %s", input_size_mb, input_file)
+            # Copy the file instead of compressing
+            output_file = keep_unchanged(input_file, output_file, ctx)
+            job_category, final_size = 'skipped_video', input_size
+            # Copied videos count as processed too
+            stats.add(skipped_videos_count=1, total_skipped_videos_size=input_size, processed_videos_count=1)
+        else:
+            crf = get_video_crf(input_size_mb)
+            logger.debug("Compressing video (Size= %s ) (CRF %s): %s", format_size(input_size), crf, input_file)
 
-            # Save progress after each file
-            processed_files.add(input_file)
-            save_progress(processed_files)
+            try:
+                if not compress_video(input_file, output_file, crf, ctx):
+                    return None
+            except VideoEncodeError as e:
+                # Keep the original instead of losing the file, like images that can't be encoded
+                logger.error("Failed to compress video (Copying anyway...): %s: %s", input_file, e)
+                stats.record_failed(input_file, str(e), e.stderr_tail)
+                copy_file(input_file, output_file, ctx)
 
-    print(f"\nProcessed {processed_images_count} images with total original size: {format_size(total_original_images_size)} and total final size: {format_size(total_final_images_size)}.")
-    print(f"Processed {processed_videos_count} videos with total original size: {format_size(total_original_videos_size)} and total final size: {format_size(total_final_videos_size)}.")
+            final_size = os.path.getsize(output_file)
+            job_category = 'video'
+            stats.add(processed_videos_count=1, total_original_videos_size=input_size, total_final_videos_size=final_size)
+
+            log_processed_file(input_file, input_size, final_size)
+
+    else:
+        # Unsupported file type, copy it directly (in place: keep it) and log it
+        logger.debug("%s unsupported file: %s", "Keeping" if ctx.in_place is not None else "Copying", input_file)
+        file_size = os.path.getsize(input_file)
+        output_file = keep_unchanged(input_file, output_file, ctx)
+        job_category, final_size = 'unsupported', file_size
+        stats.record_unsupported(input_file)
+        stats.add(unsupported_files_count=1, total_unsupported_files_size=file_size)
+
+    return job_category, output_file, final_size
+
+def keep_unchanged(input_file, output_file, ctx):
+    """Copies a file that isn't compressed to the output, returns where it ends up.
+
+    In-place runs leave it where it is: a copy would only be thrown away again.
+    """
+    if ctx.in_place is not None:
+        return input_file
+    copy_file(input_file, output_file, ctx)
+    return output_file
+
+def replace_in_place(input_file, output_file, input_size, final_size, ctx):
+    """Moves a staged output over its input, if it is smaller and nothing failed. Returns where the file now is."""
+    stats = ctx.stats
+    if output_file == input_file:
+        ctx.in_place.keep(input_file)  # Nothing was staged
+        return input_file
+    final_file = ctx.in_place.final_path(output_file)
+    if stats.failure_reason(input_file) or stats.failure_reason(output_file):
+        ctx.in_place.discard(output_file)  # Tried again by the next run
+        return input_file
+    if final_size >= input_size:
+        ctx.in_place.discard(output_file)
+        ctx.in_place.keep(input_file)
+        return input_file
+    if final_file != input_file and os.path.exists(final_file):
+        logger.warning("Keeping %s, %s already exists", input_file, final_file)
+        ctx.in_place.discard(output_file)
+        return input_file
+    try:
+        with ctx.timer.stage("replace"):
+            ctx.in_place.replace(input_file, output_file, final_file)
+    except OSError as e:
+        # The journal lets the next run finish what was started, the original is never lost
+        logger.error("Could not replace %s: %s", input_file, e)
+        stats.record_failed(input_file, f"replace failed: {e}")
+        ctx.in_place.discard(output_file)
+        return input_file
+    stats.add(replaced_in_place_count=1, reclaimed_bytes=input_size - final_size)
+    return final_file
+
+def quarantine_file(input_file, ctx, error, attempts, started):
+    """Records a file that failed every attempt, so it neither stops the run nor is retried on resume."""
+    logger.error("Giving up on %s after %d attempt(s), quarantined: %s", input_file, attempts, error)
+    stats = ctx.stats
+    reason = f"{type(error).__name__}: {error}"
+    stats.record_failed(input_file, reason)
+    stats.record_quarantined(input_file)
+    stats.add(quarantined_files_count=1)
+    try:
+        input_size = os.path.getsize(input_file)
+    except OSError:
+        input_size = 0
+    ctx.mark_processed(input_file)
+    ctx.jobs.file_quarantined(input_file, input_size, time.perf_counter() - started, reason, attempts=attempts)
+    stats.file_finished()
+    emit_progress(ctx)
+
+def log_processed_file(input_file, original_size, final_size):
+    """Logs the size change of one processed file (skipped entirely when debug output is off)."""
+    if not logger.isEnabledFor(logging.DEBUG):
+        return
+    logger.debug("Processed %s: %s -> %s (Decrease: %.2f%%)",
+                 input_file, format_size(original_size), format_size(final_size),
+                 calculate_percentage_decrease(original_size, final_size),
+                 extra={'fields': {'file': input_file, 'original_size': original_size, 'final_size': final_size}})
+
+def timed_walk(folder, ctx):
+    """os.walk that records the time spent listing each directory as the scan stage."""
+    walker = os.walk(folder)
+    while True:
+        with ctx.timer.stage("scan"):
+            entry = next(walker, None)
+        if entry is None:
+            return
+        yield entry
+
+def collect_metrics():
+    """Returns the live counters of the current run in the format expected by MetricsServer."""
+    snapshot = current_run.stats.snapshot()
+    elapsed = max(time.time() - snapshot['started_at'], 1e-9)
+    original_sizes = {
+        'image': snapshot['total_original_images_size'],
+        'video': snapshot['total_original_videos_size'],
+        'unsupported': snapshot['total_unsupported_files_size'],
+        'skipped_video': snapshot['total_skipped_videos_size'],
+    }
+    final_sizes = {
+        'image': snapshot['total_final_images_size'],
+        'video': snapshot['total_final_videos_size'],
+    }
+    file_counts = {
+        'image': snapshot['processed_images_count'],
+        'video': snapshot['processed_videos_count'],
+        'unsupported': snapshot['unsupported_files_count'],
+        'skipped_video': snapshot['skipped_videos_count'],
+    }
+    return [
+        ('compressor_processed_files_total', 'counter', 'Files processed by category.',
+         [({'category': category}, count) for category, count in file_counts.items()]),
+        ('compressor_original_bytes_total', 'counter', 'Input bytes handled by category.',
+         [({'category': category}, size) for category, size in original_sizes.items()]),
+        ('compressor_final_bytes_total', 'counter', 'Output bytes written by category.',
+         [({'category': category}, size) for category, size in final_sizes.items()]),
+        ('compressor_throughput_bytes_per_second', 'gauge', 'Average input throughput since the run started by category.',
+         [({'category': category}, size / elapsed) for category, size in original_sizes.items()]),
+        ('compressor_copied_files_total', 'counter', 'Files copied unchanged by copy method.',
+         [({'method': method}, snapshot[f'copied_{method}_count']) for method in COPY_METHODS]),
+        ('compressor_failed_files_total', 'counter', 'Files that failed to process.', snapshot['failed_files_count']),
+        ('compressor_quarantined_files_total', 'counter', 'Files that failed every attempt and were left without an output.',
+         snapshot['quarantined_files_count']),
+        ('compressor_retries_total', 'counter', 'Attempts retried after a transient error.', snapshot['retries_count']),
+        ('compressor_space_pauses_total', 'counter', 'Times the run paused for free space on the output volume.',
+         snapshot['space_pauses_count']),
+        ('compressor_space_deferred_files_total', 'counter', 'Files left for the next run because the output volume had no room.',
+         snapshot['space_deferred_files_count']),
+        ('compressor_output_free_bytes', 'gauge', 'Free space of the output volume minus the outputs still being written.',
+         current_run.space.free_bytes() if current_run.space is not None else 0),
+        ('compressor_in_flight_jobs', 'gauge', 'Files currently being processed.', snapshot['in_flight_count']),
+        ('compressor_queue_depth', 'gauge', 'Files found by the scan that are not processed yet.',
+         max(snapshot['files_discovered_count'] - snapshot['files_done_count'] - snapshot['in_flight_count'], 0)),
+        ('compressor_files_discovered_total', 'counter', 'Files found by the scan so far.', snapshot['files_discovered_count']),
+        ('compressor_run_start_timestamp_seconds', 'gauge', 'Unix time the current run started.', snapshot['started_at']),
+        ('compressor_last_file_finished_timestamp_seconds', 'gauge', 'Unix time the last file finished, use it to spot stalls.',
+         snapshot['last_file_finished_at'] or 0),
+    ]
+
+def write_run_report():
+    """Writes the per-stage timings and the summary of the current run as JSON."""
+    current_run.timer.write_report(run_report_path, summary=current_run.stats.snapshot())
+
+def failure_report_path():
+    return os.path.join(os.path.dirname(run_report_path), FAILURE_REPORT_FILE_NAME)
+
+def write_job_failure_report():
+    """Writes the files of the job that failed, from the job database, next to the run report."""
+    write_failure_report(failure_report_path(), current_run.folder, current_run.jobs.failures())
 
 # Signal handler for Ctrl+C
 def signal_handler(sig, frame):
-    print("\n\n\033[33mGracefully exiting on Ctrl+C...\033[0m")
+    logger.warning("Gracefully exiting on Ctrl+C...")
+    if current_run.writer is not None:
+        current_run.writer.drain()  # Outputs already encoded are still written and checkpointed
+    if current_run.jobs is not None:
+        current_run.jobs.commit()
     print_summary()
+    write_run_report()
+    if current_run.jobs is not None:
+        write_job_failure_report()
+    if current_run.sync_index is not None:
+        current_run.sync_index.save()
     sys.exit(0)
 
 def calculate_percentage_decrease(original_size, final_size):
@@ -383,34 +1227,100 @@ def calculate_percentage_decrease(original_size, final_size):
 
 def print_summary():
     """Prints a summary of processed files with percentage decrease."""
-    global processed_images_count, processed_videos_count, skipped_videos_count, unsupported_files_count
+    stats = current_run.stats
+    snapshot = stats.snapshot()
+    failed_files = stats.failed_files
+    unsupported_files = stats.unsupported_files
 
     # Calculate percentage decrease for images and videos
-    image_decrease_percentage = calculate_percentage_decrease(total_original_images_size, total_final_images_size)
-    video_decrease_percentage = calculate_percentage_decrease(total_original_videos_size, total_final_videos_size)
+    image_decrease_percentage = calculate_percentage_decrease(snapshot['total_original_images_size'], snapshot['total_final_images_size'])
+    video_decrease_percentage = calculate_percentage_decrease(snapshot['total_original_videos_size'], snapshot['total_final_videos_size'])
 
     print("\n\033[34mSummary\033[0m")
-    print(f"Processed {processed_images_count} images with total size: {format_size(total_original_images_size)} -> {format_size(total_final_images_size)}. ({image_decrease_percentage:.2f}% file size decrease)")
-    print(f"Processed {processed_videos_count} videos with total size: {format_size(total_original_videos_size)} -> {format_size(total_final_videos_size)}. ({video_decrease_percentage:.2f}% file size decrease)")
-    print(f"Skipped {skipped_videos_count} videos (too small to compress). (Total Size: {format_size(total_skipped_videos_size)})")  # Skipped videos size
-    print(f"Copied {unsupported_files_count} unsupported files. (Total Size: {format_size(total_unsupported_files_size)})")  # Unsupported files size
+    print(f"Processed {snapshot['processed_images_count']} images with total size: {format_size(snapshot['total_original_images_size'])} -> {format_size(snapshot['total_final_images_size'])}. ({image_decrease_percentage:.2f}% file size decrease)")
+    print(f"Processed {snapshot['processed_videos_count']} videos with total size: {format_size(snapshot['total_original_videos_size'])} -> {format_size(snapshot['total_final_videos_size'])}. ({video_decrease_percentage:.2f}% file size decrease)")
+    print(f"Skipped {snapshot['skipped_videos_count']} videos (too small to compress). (Total Size: {format_size(snapshot['total_skipped_videos_size'])})")  # Skipped videos size
+    # In-place runs leave unsupported files where they are (see keep_unchanged)
+    unsupported_action = "Kept" if current_run.in_place is not None else "Copied"
+    print(f"{unsupported_action} {snapshot['unsupported_files_count']} unsupported files. (Total Size: {format_size(snapshot['total_unsupported_files_size'])})")  # Unsupported files size
+    if current_run.budget_stop_reason or snapshot['deferred_files_count'] or snapshot['space_deferred_files_count']:
+        if current_run.budget_stop_reason:
+            print(f"\033[33mStopped because the {current_run.budget_stop_reason} budget was used up.\033[0m")
+        if snapshot['deferred_files_count']:
+            print(f"\033[33m{snapshot['deferred_files_count']} files did not fit into the run budget.\033[0m")
+        if snapshot['space_deferred_files_count']:
+            print(f"\033[33m{snapshot['space_deferred_files_count']} files got no room on the output volume.\033[0m")
+        print("\033[33mResume with -R to process the rest.\033[0m")
+    if snapshot['unchanged_files_count'] or snapshot['orphaned_outputs_count']:
+        print(f"Skipped {snapshot['unchanged_files_count']} unchanged files, handled {snapshot['orphaned_outputs_count']} orphaned outputs.")
+    if snapshot['space_pauses_count']:
+        print(f"\033[33mPaused {snapshot['space_pauses_count']} times until the output volume had free space again.\033[0m")
+    if snapshot['replaced_in_place_count']:
+        print(f"Replaced {snapshot['replaced_in_place_count']} files in place, reclaiming {format_size(snapshot['reclaimed_bytes'])}.")
+    copy_counts = [f"{method} {snapshot[f'copied_{method}_count']}" for method in COPY_METHODS if snapshot[f'copied_{method}_count']]
+    if copy_counts:
+        print(f"Copy methods used: {', '.join(copy_counts)}")
 
     if failed_files:
-        print(f"\033[31mFailed to process {len(failed_files)} files (copied instead):\033[0m")
+        quarantined_files = set(stats.quarantined_files)
+        outcome = f"{len(quarantined_files)} quarantined, the rest copied instead" if quarantined_files else "copied instead"
+        print(f"\033[31mFailed to process {len(failed_files)} files ({outcome}):\033[0m")
         for f in failed_files:
-            print(f" - {f}")
+            reason = stats.failure_reason(f)
+            print(f" - {f}" + (f" ({reason})" if reason else "") + (" [quarantined]" if f in quarantined_files else ""))
+        print(f"Details are in {failure_report_path()}, retry these files with --retry-failed.")
+    if snapshot['retries_count']:
+        print(f"Retried {snapshot['retries_count']} attempts after transient errors.")
     
     if unsupported_files:
-        print(f"\033[33mCopied {unsupported_files_count} unsupported files:\033[0m")
+        print(f"\033[33m{unsupported_action} {len(unsupported_files)} unsupported files:\033[0m")
         for f in unsupported_files:
             print(f" - {f}")
 
+class CliProgress:
+    """Stand-in for the worker's Qt progress signal when running from the command line."""
+    def emit(self, data):
+        pass
+
+class CliWorker:
+    """Minimal worker used by the command line, mirrors what process_files needs from FileProcessingWorker."""
+    def __init__(self):
+        self._is_running = True
+        self.progress = CliProgress()
+
+def get_option_value(name, default=None, choices=None, parse=None):
+    """Returns the value following `name` in sys.argv, or default if the option is missing.
+
+    With choices, any other value is an error that ends the program. With parse (e.g. int, parse_size),
+    the value is converted by it, and a value it can't convert ends the program the same way.
+    """
+    value = default
+    if name in sys.argv:
+        index = sys.argv.index(name) + 1
+        if index < len(sys.argv):
+            value = sys.argv[index]
+        else:
+            print(f"Error: No value provided after '{name}'.")
+    if choices is not None and value not in choices:
+        print(f"Error: '{value}' is not a valid value for '{name}', use one of: {', '.join(choices)}.")
+        sys.exit(2)
+    if parse is not None and value is not None:
+        try:
+            return parse(value)
+        except ValueError:
+            print(f"Error: '{value}' is not a valid value for '{name}'.")
+            sys.exit(2)
+    return value
+
 def main():
     """Main function to execute the script."""
     signal.signal(signal.SIGINT, signal_handler)  # Handle Ctrl+C
     if len(sys.argv) < 2:
-        print("Usage: python compressStuff.py <folder_path> [--compression-analysis] [-R]")
+        print("Usage: python compressStuff.py <folder_path> [--compression-analysis [--trial [--trial-samples <n>]]] [-speed <speed>] [-o <output_folder>] [--quiet | --verbose] [--log-json <file>] [--metrics-port <port>] [--keep-gps] [--image-format keep|progressive-jpeg|webp|avif] [--quality-search fixed|ssim|bpp] [--quality-target <value>] [--raw-previews] [--hardlink] [--mirror [--orphans delete|quarantine|keep]] [--watch [--watch-settle <seconds>] [--watch-poll]] [--prefetch <files>] [--prefetch-mb <MB>] [--schedule walk|savings|smallest|images-first|round-robin] [--max-duration <time>] [--max-input-bytes <size>] [--max-cpu-seconds <time>] [--retry-failed] [--verify [--verify-sample <percent>]] [--in-place [--trash-days <days>]] [--min-free <size>] [--coordinator [--local-workers <n>] | --worker]")
         return
+
+    configure_logging(verbose='--verbose' in sys.argv, quiet='--quiet' in sys.argv,
+                      json_path=get_option_value('--log-json'))
     
     folder = sys.argv[1]
     if not os.path.exists(folder):
@@ -418,19 +1328,77 @@ def main():
         return
 
     if '--compression-analysis' in sys.argv:
+        trial_options = dict(trial='--trial' in sys.argv,
+                             image_format=get_option_value('--image-format', OUTPUT_FORMAT_KEEP, choices=OUTPUT_FORMATS),
+                             trial_samples=get_option_value('--trial-samples', DEFAULT_TRIAL_SAMPLES, parse=int))
         # Check if a specific speed option is provided
         if '-speed' in sys.argv:
             speed_index = sys.argv.index('-speed') + 1
             if speed_index < len(sys.argv):
                 speed_option = sys.argv[speed_index]
-                analyze_compression_time(folder, speed=speed_option)
+                analyze_compression_time(folder, speed=speed_option, raw_previews='--raw-previews' in sys.argv,
+                                         **trial_options)
             else:
                 print("Error: No speed option provided after '-speed'.")
         else:
-            analyze_compression_time(folder)  # Default to 'fast'
+            analyze_compression_time(folder, raw_previews='--raw-previews' in sys.argv, **trial_options)  # Default to 'fast'
     else:
+        if '--in-place' in sys.argv and '--raw-previews' in sys.argv:
+            # The preview is a small lossy JPEG, replacing the RAW with it is not a compression
+            print("Error: '--in-place' can't be combined with '--raw-previews', RAW originals would be deleted.")
+            sys.exit(2)
+        metrics_port = get_option_value('--metrics-port', parse=int)
+        quality_target = get_option_value('--quality-target', parse=float)
+        max_duration = get_option_value('--max-duration', parse=parse_duration)
+        max_input_bytes = get_option_value('--max-input-bytes', parse=parse_size)
+        max_cpu_seconds = get_option_value('--max-cpu-seconds', parse=parse_duration)
+        trash_days = get_option_value('--trash-days', parse=int)
+        min_free = get_option_value('--min-free', str(DEFAULT_MIN_FREE_BYTES), parse=parse_size)
+        verify_sample = get_option_value('--verify-sample', DEFAULT_SAMPLE_RATE * 100, parse=float) / 100
+        metrics_server = MetricsServer(metrics_port, collect_metrics).start() if metrics_port else None
+
         # Start processing files
-        process_files(folder)
+        try:
+            if '--worker' in sys.argv:
+                run_queue_worker(folder, get_option_value('-o'), CliWorker())
+                return
+            if '--coordinator' in sys.argv:
+                run_coordinator(folder, get_option_value('-o'), CliWorker(), resume='-R' in sys.argv,
+                                local_workers=get_option_value('--local-workers', 0, parse=int),
+                                schedule=get_option_value('--schedule', SCHEDULE_WALK, choices=SCHEDULE_POLICIES),
+                                video_compression_speed=get_option_value('-speed'), keep_gps='--keep-gps' in sys.argv,
+                                image_format=get_option_value('--image-format', OUTPUT_FORMAT_KEEP, choices=OUTPUT_FORMATS),
+                                quality_mode=get_option_value('--quality-search', QUALITY_MODE_FIXED, choices=QUALITY_MODES),
+                                quality_target=quality_target,
+                                raw_previews='--raw-previews' in sys.argv, allow_hardlinks='--hardlink' in sys.argv,
+                                verify='--verify' in sys.argv, verify_sample=verify_sample, min_free=min_free)
+                print_summary()
+                return
+            process_files(folder, get_option_value('-o'), '-R' in sys.argv, CliWorker(),
+                          get_option_value('-speed'), None, keep_gps='--keep-gps' in sys.argv,
+                          image_format=get_option_value('--image-format', OUTPUT_FORMAT_KEEP, choices=OUTPUT_FORMATS),
+                          quality_mode=get_option_value('--quality-search', QUALITY_MODE_FIXED, choices=QUALITY_MODES),
+                          quality_target=quality_target,
+                          raw_previews='--raw-previews' in sys.argv,
+                          allow_hardlinks='--hardlink' in sys.argv,
+                          mirror='--mirror' in sys.argv,
+                          orphan_policy=get_option_value('--orphans', ORPHANS_DELETE, choices=ORPHAN_POLICIES),
+                          watch='--watch' in sys.argv,
+                          watch_settle_seconds=get_option_value('--watch-settle', DEFAULT_SETTLE_SECONDS, parse=float),
+                          watch_polling='--watch-poll' in sys.argv,
+                          prefetch_files=get_option_value('--prefetch', DEFAULT_PREFETCH_FILES, parse=int),
+                          prefetch_bytes=get_option_value('--prefetch-mb', DEFAULT_PREFETCH_BYTES // (1024 * 1024), parse=int) * 1024 * 1024,
+                          schedule=get_option_value('--schedule', SCHEDULE_WALK, choices=SCHEDULE_POLICIES),
+                          max_duration=max_duration, max_input_bytes=max_input_bytes, max_cpu_seconds=max_cpu_seconds,
+                          retry_failed='--retry-failed' in sys.argv,
+                          verify='--verify' in sys.argv, verify_sample=verify_sample,
+                          in_place='--in-place' in sys.argv,
+                          trash_days=trash_days,
+                          min_free=min_free)
+        finally:
+            if metrics_server:
+                metrics_server.stop()
+        print_summary()
 
 def format_time(minutes):
     """Convert time in minutes to hours and minutes if necessary, and round it."""
@@ -470,8 +1438,153 @@ def estimate_compression_time(size_in_gb, speed, file_type):
         estimated_time = size_in_gb * base_time * multiplier
     return estimated_time
 
-def analyze_compression_time(folder, speed='fast'):
-    """Analyzes the folder for compression stats and estimated time."""
+def trial_encode_image(input_file, name, ctx):
+    """Compresses a sampled image with the run's settings; returns (output bytes, seconds), None when stopped."""
+    if not ctx.is_running:
+        return None
+    output_file = os.path.join(ctx.output_folder, name, os.path.basename(input_file))
+    os.makedirs(os.path.dirname(output_file))
+    started = time.perf_counter()
+    final_size = compress_image(input_file, output_file, ctx)[1]
+    return final_size, time.perf_counter() - started
+
+def trial_encode_video(input_file, name, ctx):
+    """Encodes a window from the middle of a sampled video and scales its output and time to the whole video.
+
+    Returns (output bytes, seconds), or None when the duration is unknown or the run was stopped.
+    """
+    if not ctx.is_running:
+        return None
+    duration = probe_media(input_file)[0]
+    if not duration:
+        return None
+    window = min(TRIAL_EXCERPT_SECONDS, duration)
+    scale = duration / window
+    output_file = os.path.join(ctx.output_folder, name + os.path.splitext(input_file)[1])
+    crf = get_video_crf(os.path.getsize(input_file) / (1024 * 1024))
+    seconds = 0
+    for encoder, input_options in VIDEO_ENCODERS:
+        cmd = video_command(input_file, output_file, crf, ctx.video_compression_speed, encoder, input_options,
+                            excerpt=((duration - window) / 2, window))
+        started = time.perf_counter()
+        returncode = run_ffmpeg(cmd, ctx)[0]
+        seconds += time.perf_counter() - started
+        if returncode is None:
+            return None
+        if returncode == 0:
+            return os.path.getsize(output_file) * scale, seconds * scale
+    return os.path.getsize(input_file), seconds * scale  # A run copies videos that don't encode
+
+def trial_encode_analysis(folder, images, videos, speed='fast', image_quality=None, image_format=OUTPUT_FORMAT_KEEP,
+                          raw_previews=False, samples=DEFAULT_TRIAL_SAMPLES, worker=None):
+    """Trial-encodes a random sample of the images and of the videos that a run would compress.
+
+    images and videos are lists of (path, size). Sampled images are compressed completely, sampled videos
+    as a TRIAL_EXCERPT_SECONDS window, TRIAL_THREADS at a time into a temporary folder. The sample's
+    output/input ratios extrapolate to the whole category, with a 95% interval (see sampling.RatioEstimate).
+    Returns {category: (output bytes estimate, seconds estimate) or a string saying why there is none}.
+    """
+    worker = worker or CliWorker()
+    estimates = {}
+    with tempfile.TemporaryDirectory(prefix="compress-trial-") as trial_folder:
+        ctx = create_run_context(folder, trial_folder, worker, RunStats(), None, image_quality=image_quality,
+                                 video_compression_speed=speed, image_format=image_format, raw_previews=raw_previews)
+        ctx.writer.close()
+        ctx.writer = None  # Outputs are written before their encode is timed
+        os.makedirs(ctx.output_folder)
+        with ThreadPoolExecutor(max_workers=TRIAL_THREADS, thread_name_prefix="trial") as executor:
+            pending = {}
+            for category, files, encode in (('image', images, trial_encode_image), ('video', videos, trial_encode_video)):
+                sample = choose_sample(files, samples, seed=folder)  # The same folder samples the same files
+                pending[category] = [(size, executor.submit(encode, path, f"{category}-{index}", ctx))
+                                     for index, (path, size) in enumerate(sample)]
+
+            for category, files in (('image', images), ('video', videos)):
+                input_sizes, output_sizes, seconds, missing_tool = [], [], [], False
+                for size, future in pending[category]:
+                    try:
+                        result = future.result()
+                    except FileNotFoundError as e:
+                        missing_tool = e.filename in ('ffmpeg', 'ffprobe')
+                        if not missing_tool:
+                            logger.warning("Trial encode failed: %s", e)
+                        continue
+                    except (OSError, VerificationError, VideoEncodeError) as e:
+                        logger.warning("Trial encode failed: %s", e)
+                        continue
+                    if result is not None:
+                        input_sizes.append(size)
+                        output_sizes.append(result[0])
+                        seconds.append(result[1])
+
+                total = sum(size for _, size in files)
+                if not files:
+                    estimates[category] = "no files"
+                elif missing_tool and not input_sizes:
+                    estimates[category] = "ffmpeg is not installed"
+                elif len(input_sizes) < min(2, len(files)):
+                    estimates[category] = "too few samples could be encoded"
+                else:
+                    estimates[category] = (RatioEstimate(input_sizes, output_sizes, len(files), total),
+                                           RatioEstimate(input_sizes, seconds, len(files), total))
+    return estimates
+
+def format_size_range(estimate, low, high):
+    return f"{format_size(estimate)} ({format_size(low)} - {format_size(high)})"
+
+def format_time_range(estimate, low, high):
+    """Like format_time, for an estimate in minutes and its interval."""
+    return f"{format_time(estimate)} ({format_time(low)} - {format_time(high)})"
+
+def trial_analysis_report(estimates, total_size, copied_size, copy_minutes):
+    """Prints the trial estimates and returns them for the analysis result (see trial_analysis)."""
+    report = {'expected_output_size': None, 'expected_output_size_str': None, 'expected_savings_str': None,
+              'trial_estimated_time': None, 'trial_estimated_time_str': None,
+              'expected_image_size_str': None, 'expected_video_size_str': None}
+    print(f"\nTrial Encodes (95% intervals):")
+    size_estimates, time_estimates, unavailable = [], [], []
+    for category, label in (('image', "Images"), ('video', "Videos")):
+        estimate = estimates[category]
+        if estimate == "no files":
+            continue
+        if isinstance(estimate, str):
+            unavailable.append(estimate)
+            print(f"  - {label}: not estimated, {estimate}")
+            continue
+        output, seconds = estimate
+        size_estimates.append(output)
+        time_estimates.append(seconds)
+        report[f'expected_{category}_size_str'] = format_size_range(output.estimate, output.low, output.high)
+        print(f"  - {label}: {report[f'expected_{category}_size_str']} from {output.sample_count} of "
+              f"{output.population_count} files, {format_time_range(seconds.estimate / 60, seconds.low / 60, seconds.high / 60)}")
+
+    if unavailable:
+        report['expected_output_size_str'] = f"not available ({unavailable[0]})"
+        print(f"  - Expected output: {report['expected_output_size_str']}")
+        return report
+    output, low, high = combined_interval(size_estimates, exact_total=copied_size)
+    seconds, seconds_low, seconds_high = combined_interval(time_estimates)
+    report['expected_output_size'] = output
+    report['expected_output_size_str'] = format_size_range(output, low, high)
+    if total_size:
+        savings = [100 * (1 - size / total_size) for size in (output, high, low)]
+        report['expected_savings_str'] = "{:.0f}% ({:.0f}% - {:.0f}%)".format(*savings)
+    report['trial_estimated_time'] = seconds / 60 + copy_minutes
+    report['trial_estimated_time_str'] = format_time_range(report['trial_estimated_time'], seconds_low / 60 + copy_minutes,
+                                                           seconds_high / 60 + copy_minutes)
+    print(f"  - Expected output: {report['expected_output_size_str']}, saving {report['expected_savings_str']}")
+    print(f"  - Total time: {report['trial_estimated_time_str']}")
+    return report
+
+def analyze_compression_time(folder, speed='fast', raw_previews=False, trial=False, image_quality=None,
+                             image_format=OUTPUT_FORMAT_KEEP, trial_samples=DEFAULT_TRIAL_SAMPLES, worker=None):
+    """Analyzes the folder for compression stats and estimated time.
+
+    Files are categorized with the same signature based format registry that process_files routes with.
+    With trial, a sample of the files is encoded with the given settings to estimate the output size and
+    a measured encode time (see trial_analysis). The result keeps the files the trial samples from, so a
+    trial can also run later on it without scanning the folder again.
+    """
     total_files_count = 0
     total_size = 0
     image_files_count = 0
@@ -484,24 +1597,32 @@ def analyze_compression_time(folder, speed='fast'):
     image_filetypes = set()
     video_filetypes = set()
     unsupported_filetypes = set()
+    image_files, compressed_video_files = [], []  # (path, size) of the files trial encodes sample from
 
     # Walk through the directory to analyze file types
-    for dirpath, _, filenames in os.walk(folder):
+    for dirpath, dirnames, filenames in os.walk(folder):
+        if IN_PLACE_FOLDER_NAME in dirnames:
+            dirnames.remove(IN_PLACE_FOLDER_NAME)
         for filename in filenames:
             input_file = os.path.join(dirpath, filename)
             file_size = os.path.getsize(input_file)
             total_files_count += 1
             total_size += file_size
 
-            # Categorize files based on extension
-            if filename.lower().endswith(('.jpg', '.jpeg', '.png', '.gif')):
+            # Categorize files based on their signature
+            media_format = detect_format(input_file)
+            category = route_category(media_format, raw_previews=raw_previews)
+            if category == CATEGORY_IMAGE:
                 image_files_count += 1
                 total_image_size += file_size
-                image_filetypes.add(filename.split('.')[-1].lower())
-            elif filename.lower().endswith(('.mp4', '.mkv', '.mov')):
+                image_filetypes.add(media_format.name)
+                image_files.append((input_file, file_size))
+            elif category == CATEGORY_VIDEO:
                 video_files_count += 1
                 total_video_size += file_size
-                video_filetypes.add(filename.split('.')[-1].lower())
+                video_filetypes.add(media_format.name)
+                if file_size >= SMALL_VIDEO_MB * 1024 * 1024:
+                    compressed_video_files.append((input_file, file_size))
             else:
                 unsupported_files_count += 1
                 total_unsupported_size += file_size
@@ -543,7 +1664,7 @@ def analyze_compression_time(folder, speed='fast'):
     print(f"  - Videos: {estimated_video_time_str}")
     print(f"  - Unsupported files (copying): {estimated_unsupported_time_str}")
     print(f"  - Total: {total_estimated_time_str}")
-    return {
+    result = {
         'total_estimated_time': total_estimated_time,
         'total_estimated_time_str': total_estimated_time_str,
         'total_files_count': total_files_count.__str__(),
@@ -554,8 +1675,29 @@ def analyze_compression_time(folder, speed='fast'):
         'video_files_count': video_files_count.__str__(),
         'formatted_video_size': formatted_video_size,
         'unsupported_files_count': unsupported_files_count.__str__(),
-        'formatted_unsupported_size': formatted_unsupported_size
+        'formatted_unsupported_size': formatted_unsupported_size,
+        'total_image_size': total_image_size,
+        'image_files': image_files,
+        'compressed_video_files': compressed_video_files,
     }
+    if trial:
+        result.update(trial_analysis(folder, result, speed=speed, image_quality=image_quality, image_format=image_format,
+                                     raw_previews=raw_previews, trial_samples=trial_samples, worker=worker))
+    return result
+
+def trial_analysis(folder, analysis, speed='fast', image_quality=None, image_format=OUTPUT_FORMAT_KEEP,
+                   raw_previews=False, trial_samples=DEFAULT_TRIAL_SAMPLES, worker=None):
+    """Trial-encodes a sample of the files of an analyze_compression_time result; returns the trial estimates."""
+    image_files, compressed_video_files = analysis['image_files'], analysis['compressed_video_files']
+    print(f"\nTrial-encoding up to {trial_samples} images and {trial_samples} videos...")
+    estimates = trial_encode_analysis(folder, image_files, compressed_video_files, speed=speed,
+                                      image_quality=image_quality, image_format=image_format,
+                                      raw_previews=raw_previews, samples=trial_samples, worker=worker)
+    # Small videos are copied like unsupported files, their output size is known
+    total_size = analysis['total_size']
+    copied_size = total_size - analysis['total_image_size'] - sum(size for _, size in compressed_video_files)
+    copy_minutes = estimate_compression_time(copied_size / (1024 * 1024 * 1024), speed, 'copy')
+    return trial_analysis_report(estimates, total_size, copied_size, copy_minutes)
 
 
 
@@ -0,0 +1,202 @@
+import struct
+
+# Raw EXIF as stored in a JPEG APP1 segment starts with this marker, followed by a TIFF structure
+EXIF_HEADER = b"Exif\x00\x00"
+
+# Tags kept from IFD0
+IFD0_TAGS = frozenset({
+    271,  # Manufacturer of the camera used to capture the image.
+    272,  # Model of the camera used to capture the image.
+    274,  # Orientation of the image
+})
+
+# Tags kept from the Exif sub-IFD
+EXIF_IFD_TAGS = frozenset({
+    36867,  # Date and time when the photo was originally taken.
+    40962,  # Image width in pixels.
+    40963,  # Image height in pixels.
+})
+
+EXIF_IFD_POINTER = 34665
+GPS_IFD_POINTER = 34853
+ORIENTATION_TAG = 274
+PIXEL_X_DIMENSION_TAG = 40962
+PIXEL_Y_DIMENSION_TAG = 40963
+
+# Orientations that swap width and height when applied
+TRANSPOSING_ORIENTATIONS = frozenset({5, 6, 7, 8})
+
+# Byte size of one value for each TIFF field type
+TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 6: 1, 7: 1, 8: 2, 9: 4, 10: 8, 11: 4, 12: 8}
+
+SHORT_TYPE = 3
+LONG_TYPE = 4
+
+
+class ExifParseError(ValueError):
+    """Raised when the EXIF blob is not a TIFF structure we can read."""
+
+
+def _read_ifd(tiff, offset, endian, wanted=None):
+    """Reads the entries of the IFD at offset as {tag: (type, count, raw value bytes)}.
+
+    Only tags in `wanted` are kept (all of them when wanted is None). Unknown types are skipped.
+    The next-IFD link is not followed, so IFD1 and its embedded thumbnail are never read.
+    """
+    if offset + 2 > len(tiff):
+        raise ExifParseError("IFD offset out of range")
+    (count,) = struct.unpack_from(endian + "H", tiff, offset)
+    entries = {}
+    position = offset + 2
+    for _ in range(count):
+        if position + 12 > len(tiff):
+            raise ExifParseError("Truncated IFD")
+        tag, field_type, value_count = struct.unpack_from(endian + "HHI", tiff, position)
+        if (wanted is None or tag in wanted) and field_type in TYPE_SIZES:
+            size = TYPE_SIZES[field_type] * value_count
+            if size <= 4:
+                raw = tiff[position + 8:position + 8 + size]
+            else:
+                (value_offset,) = struct.unpack_from(endian + "I", tiff, position + 8)
+                if value_offset + size > len(tiff):
+                    raise ExifParseError("Value out of range")
+                raw = tiff[value_offset:value_offset + size]
+            entries[tag] = (field_type, value_count, raw)
+        position += 12
+    return entries
+
+
+def _read_pointer(entry, endian):
+    """Offset of a sub-IFD from its pointer entry in IFD0, which must be a single LONG (or SHORT)."""
+    field_type, value_count, raw = entry
+    if value_count != 1 or field_type not in (LONG_TYPE, SHORT_TYPE):
+        raise ExifParseError(f"Sub-IFD pointer has type {field_type} and count {value_count}")
+    (offset,) = struct.unpack(endian + ("I" if field_type == LONG_TYPE else "H"), raw)
+    return offset
+
+
+def parse_essential_exif(exif_data, include_gps=False):
+    """Extracts only the whitelisted tags from a raw EXIF blob.
+
+    Returns (endian, ifd0, exif_ifd, gps_ifd) where each IFD is {tag: (type, count, raw)}.
+    """
+    tiff = exif_data[len(EXIF_HEADER):] if exif_data.startswith(EXIF_HEADER) else exif_data
+    if len(tiff) < 8:
+        raise ExifParseError("EXIF data too short")
+    if tiff[:2] == b"II":
+        endian = "<"
+    elif tiff[:2] == b"MM":
+        endian = ">"
+    else:
+        raise ExifParseError("Unknown byte order")
+    magic, ifd0_offset = struct.unpack_from(endian + "HI", tiff, 2)
+    if magic != 42:
+        raise ExifParseError("Not a TIFF structure")
+
+    pointers = {EXIF_IFD_POINTER, GPS_IFD_POINTER} if include_gps else {EXIF_IFD_POINTER}
+    ifd0 = _read_ifd(tiff, ifd0_offset, endian, IFD0_TAGS | pointers)
+
+    exif_ifd = {}
+    if EXIF_IFD_POINTER in ifd0:
+        exif_ifd = _read_ifd(tiff, _read_pointer(ifd0.pop(EXIF_IFD_POINTER), endian), endian, EXIF_IFD_TAGS)
+
+    gps_ifd = {}
+    if GPS_IFD_POINTER in ifd0:
+        gps_ifd = _read_ifd(tiff, _read_pointer(ifd0.pop(GPS_IFD_POINTER), endian), endian)
+
+    return endian, ifd0, exif_ifd, gps_ifd
+
+
+def _ifd_size(entries):
+    """Size in bytes of an IFD with its out-of-line values (word aligned)."""
+    size = 2 + 12 * len(entries) + 4
+    for _, _, raw in entries.values():
+        if len(raw) > 4:
+            size += len(raw) + (len(raw) & 1)
+    return size
+
+
+def _write_ifd(entries, offset, endian):
+    """Serializes an IFD placed at offset, values that don't fit inline follow the entry table."""
+    table = struct.pack(endian + "H", len(entries))
+    data = b""
+    data_offset = offset + 2 + 12 * len(entries) + 4
+    for tag in sorted(entries):
+        field_type, value_count, raw = entries[tag]
+        if len(raw) <= 4:
+            value = raw.ljust(4, b"\x00")
+        else:
+            value = struct.pack(endian + "I", data_offset + len(data))
+            data += raw + (b"\x00" if len(raw) & 1 else b"")
+        table += struct.pack(endian + "HHI", tag, field_type, value_count) + value
+    return table + struct.pack(endian + "I", 0) + data
+
+
+def build_exif(endian, ifd0, exif_ifd, gps_ifd):
+    """Builds a raw EXIF blob (with the Exif header) containing only the given IFDs."""
+    ifd0 = dict(ifd0)
+    pointer = (LONG_TYPE, 1, b"\x00\x00\x00\x00")
+    # Reserve the pointer entries first so the IFD0 size is final before offsets are known
+    if exif_ifd:
+        ifd0[EXIF_IFD_POINTER] = pointer
+    if gps_ifd:
+        ifd0[GPS_IFD_POINTER] = pointer
+
+    exif_offset = 8 + _ifd_size(ifd0)
+    gps_offset = exif_offset + (_ifd_size(exif_ifd) if exif_ifd else 0)
+    if exif_ifd:
+        ifd0[EXIF_IFD_POINTER] = (LONG_TYPE, 1, struct.pack(endian + "I", exif_offset))
+    if gps_ifd:
+        ifd0[GPS_IFD_POINTER] = (LONG_TYPE, 1, struct.pack(endian + "I", gps_offset))
+
+    byte_order = b"II" if endian == "<" else b"MM"
+    tiff = byte_order + struct.pack(endian + "HI", 42, 8) + _write_ifd(ifd0, 8, endian)
+    if exif_ifd:
+        tiff += _write_ifd(exif_ifd, exif_offset, endian)
+    if gps_ifd:
+        tiff += _write_ifd(gps_ifd, gps_offset, endian)
+    return EXIF_HEADER + tiff
+
+
+def filter_exif(exif_data, include_gps=False):
+    """Returns a minimal EXIF blob with only the essential tags, or None if there is nothing to keep.
+
+    Maker notes, the IFD1 thumbnail and every other tag are dropped.
+    Raises ExifParseError for data that is not valid EXIF.
+    """
+    if not exif_data:
+        return None
+    endian, ifd0, exif_ifd, gps_ifd = parse_essential_exif(exif_data, include_gps)
+    if not (ifd0 or exif_ifd or gps_ifd):
+        return None
+    return build_exif(endian, ifd0, exif_ifd, gps_ifd)
+
+
+def read_orientation(endian, ifd0):
+    """Returns the orientation value (1-8) from a parsed IFD0, 1 when missing or invalid."""
+    entry = ifd0.get(ORIENTATION_TAG)
+    if entry is None or entry[0] != SHORT_TYPE or len(entry[2]) < 2:
+        return 1
+    (orientation,) = struct.unpack(endian + "H", entry[2][:2])
+    return orientation if 1 <= orientation <= 8 else 1
+
+
+def filter_exif_and_orientation(exif_data, include_gps=False):
+    """Like filter_exif, but also returns the orientation and resets it in the blob.
+
+    Returns (blob, orientation). The caller is expected to apply the orientation to the
+    pixels; the blob then says "normal" (1) and, for rotations by 90 degrees, carries
+    swapped pixel dimensions, so viewers don't rotate the image a second time.
+    """
+    if not exif_data:
+        return None, 1
+    endian, ifd0, exif_ifd, gps_ifd = parse_essential_exif(exif_data, include_gps)
+    orientation = read_orientation(endian, ifd0)
+    if orientation != 1:
+        ifd0[ORIENTATION_TAG] = (SHORT_TYPE, 1, struct.pack(endian + "H", 1))
+        if orientation in TRANSPOSING_ORIENTATIONS and PIXEL_X_DIMENSION_TAG in exif_ifd and PIXEL_Y_DIMENSION_TAG in exif_ifd:
+            exif_ifd[PIXEL_X_DIMENSION_TAG], exif_ifd[PIXEL_Y_DIMENSION_TAG] = (
+                exif_ifd[PIXEL_Y_DIMENSION_TAG], exif_ifd[PIXEL_X_DIMENSION_TAG])
+    if not (ifd0 or exif_ifd or gps_ifd):
+        return None, orientation
+    return build_exif(endian, ifd0, exif_ifd, gps_ifd), orientation
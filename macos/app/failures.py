@@ -0,0 +1,85 @@
+import errno
+import json
+import os
+import time
+
+# In-run retries of a file whose processing raised a transient error
+RETRY_ATTEMPTS = 3
+RETRY_BACKOFF_SECONDS = 1.0  # Doubles after every attempt
+
+# Errors of flaky storage (network shares, USB drives) that are worth another try
+TRANSIENT_ERRNOS = {errno.EAGAIN, errno.EBUSY, errno.EINTR, errno.EIO, errno.ETIMEDOUT, errno.ESTALE,
+                    errno.ECONNRESET, errno.ECONNABORTED, errno.EHOSTDOWN}
+
+# The output volume is full: waiting for space, not retrying or quarantining, is the way out
+OUT_OF_SPACE_ERRNOS = {errno.ENOSPC, errno.EDQUOT}
+FFMPEG_OUT_OF_SPACE_MESSAGE = "No space left on device"
+
+# Lines of ffmpeg's stderr that are kept with a failure
+STDERR_TAIL_LINES = 20
+STDERR_TAIL_BYTES = 8 * 1024
+
+# Written into the output folder after every run with failures, --retry-failed processes the files listed in it
+FAILURE_REPORT_FILE_NAME = "failure-report.json"
+
+
+class VideoEncodeError(Exception):
+    """ffmpeg failed with every encoder it was tried with."""
+
+    def __init__(self, message, stderr_tail=None):
+        super().__init__(message)
+        self.stderr_tail = stderr_tail
+
+
+class VerificationError(Exception):
+    """An output doesn't match what was written or can't be decoded (see verification)."""
+
+
+def is_transient(error):
+    """True for errors that may go away when the same file is tried again.
+
+    A failed verification counts as transient: the output is produced again on the next attempt.
+    """
+    if isinstance(error, VerificationError):
+        return True
+    return isinstance(error, OSError) and error.errno in TRANSIENT_ERRNOS
+
+
+def is_out_of_space(error):
+    return isinstance(error, OSError) and error.errno in OUT_OF_SPACE_ERRNOS
+
+
+def retry_delay(attempt):
+    """Seconds to wait after the given failed attempt (1-based) before the next one."""
+    return RETRY_BACKOFF_SECONDS * 2 ** (attempt - 1)
+
+
+def read_tail(f, max_lines=STDERR_TAIL_LINES, max_bytes=STDERR_TAIL_BYTES):
+    """Returns the last lines of an open binary file, e.g. the temporary file ffmpeg's stderr went to."""
+    f.seek(0, os.SEEK_END)
+    f.seek(max(f.tell() - max_bytes, 0))
+    text = f.read().decode('utf-8', errors='replace').replace('\r', '\n')
+    lines = [line for line in text.splitlines() if line.strip()]
+    return "\n".join(lines[-max_lines:])
+
+
+def write_failure_report(path, input_folder, failures):
+    """Writes the failed files of the job (see JobStore.failures) as JSON, or removes an old report when none failed."""
+    if not failures:
+        if os.path.exists(path):
+            os.remove(path)
+        return
+    report = {'input_folder': input_folder, 'written_at': time.time(), 'failures': failures}
+    temporary_path = path + ".partial"
+    with open(temporary_path, 'w') as f:
+        json.dump(report, f, indent=2)
+    os.replace(temporary_path, path)
+
+
+def read_failure_report(path):
+    """Returns the input paths listed in a failure report, or an empty list when there is none."""
+    try:
+        with open(path, 'r') as f:
+            return [failure['path'] for failure in json.load(f)['failures']]
+    except FileNotFoundError:
+        return []
@@ -0,0 +1,142 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+import shutil
+import sys
+
+# Copy methods, cheapest first
+COPY_METHOD_REFLINK = "reflink"  # Copy-on-write clone, only metadata is written (APFS, btrfs, XFS)
+COPY_METHOD_HARDLINK = "hardlink"  # Second name for the same file, only when the user opts in
+COPY_METHOD_COPY_FILE_RANGE = "copy_file_range"  # In-kernel copy, may be offloaded by the filesystem (Linux)
+COPY_METHOD_SENDFILE = "sendfile"  # In-kernel copy without going through user space (Linux)
+COPY_METHOD_BUFFERED = "buffered"  # Plain read/write copy
+COPY_METHODS = (COPY_METHOD_REFLINK, COPY_METHOD_HARDLINK, COPY_METHOD_COPY_FILE_RANGE,
+                COPY_METHOD_SENDFILE, COPY_METHOD_BUFFERED)
+
+# ioctl number of FICLONE from linux/fs.h
+FICLONE = 0x40049409
+
+# Errors that mean "this method doesn't work here", the next method is tried
+UNSUPPORTED_ERRNOS = frozenset({
+    errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP, errno.ENOTTY, errno.EPERM, errno.EBADF,
+    getattr(errno, 'ENOTSUP', errno.EOPNOTSUPP),
+})
+
+# Bytes per in-kernel copy call
+KERNEL_COPY_CHUNK = 64 * 1024 * 1024
+
+_clonefile = None
+
+
+def _load_clonefile():
+    """Returns libc's clonefile on macOS, or None."""
+    global _clonefile
+    if _clonefile is None:
+        _clonefile = False
+        if sys.platform == 'darwin':
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            if hasattr(libc, 'clonefile'):
+                _clonefile = libc.clonefile
+                _clonefile.argtypes = (ctypes.c_char_p, ctypes.c_char_p, ctypes.c_int)
+                _clonefile.restype = ctypes.c_int
+    return _clonefile or None
+
+
+def _remove_existing(dst):
+    """Removes what is at dst before it is written.
+
+    An existing dst may be a hardlink to the input (from a --hardlink run), so opening it for
+    writing would truncate the input. clonefile and link also refuse to replace a file.
+    """
+    try:
+        os.unlink(dst)
+    except FileNotFoundError:
+        pass
+
+
+def _reflink(src, dst):
+    clonefile = _load_clonefile()
+    if clonefile is not None:
+        if clonefile(os.fsencode(src), os.fsencode(dst), 0) != 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error), dst)
+        return
+    if not sys.platform.startswith('linux'):
+        raise OSError(errno.ENOTSUP, "Reflinks are not supported on this platform", dst)
+
+    import fcntl
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+
+
+def _hardlink(src, dst):
+    os.link(src, dst)
+
+
+def _kernel_copy(src, dst, copy_chunk):
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        remaining = os.fstat(fsrc.fileno()).st_size
+        offset = 0
+        while remaining > 0:
+            copied = copy_chunk(fsrc.fileno(), fdst.fileno(), offset, min(remaining, KERNEL_COPY_CHUNK))
+            if copied == 0:
+                break  # The file shrank while copying
+            offset += copied
+            remaining -= copied
+
+
+def _copy_file_range(src, dst):
+    if not hasattr(os, 'copy_file_range'):
+        raise OSError(errno.ENOSYS, "copy_file_range is not available", dst)
+    _kernel_copy(src, dst, lambda fd_in, fd_out, offset, count: os.copy_file_range(fd_in, fd_out, count, offset, offset))
+
+
+def _sendfile(src, dst):
+    if not sys.platform.startswith('linux'):
+        raise OSError(errno.ENOSYS, "sendfile to a file is only supported on Linux", dst)
+    # sendfile writes at the current position of the output file, which advances with each call
+    _kernel_copy(src, dst, lambda fd_in, fd_out, offset, count: os.sendfile(fd_out, fd_in, offset, count))
+
+
+def _buffered(src, dst):
+    shutil.copyfile(src, dst)
+
+
+COPY_FUNCTIONS = {
+    COPY_METHOD_REFLINK: _reflink,
+    COPY_METHOD_HARDLINK: _hardlink,
+    COPY_METHOD_COPY_FILE_RANGE: _copy_file_range,
+    COPY_METHOD_SENDFILE: _sendfile,
+    COPY_METHOD_BUFFERED: _buffered,
+}
+
+
+class FileCopier:
+    """Copies files with the cheapest method that works, remembering methods that failed.
+
+    Reflinks and hardlinks only work within one filesystem and not on every filesystem, so a
+    method that fails as unsupported is skipped for the rest of the run. Hardlinks share the
+    file with the input (changing one changes the other), they are only used when allowed.
+    """
+
+    def __init__(self, allow_hardlinks=False):
+        self.methods = [method for method in COPY_METHODS if allow_hardlinks or method != COPY_METHOD_HARDLINK]
+        self._unsupported = set()
+
+    def copy(self, src, dst):
+        """Copies src to dst with its timestamps and permissions, returns the method used."""
+        for method in self.methods:
+            if method in self._unsupported:
+                continue
+            try:
+                _remove_existing(dst)  # Each method writes a new file, never an inode dst shares with the input
+                COPY_FUNCTIONS[method](src, dst)
+            except OSError as e:
+                if method == COPY_METHOD_BUFFERED or e.errno not in UNSUPPORTED_ERRNOS:
+                    raise
+                self._unsupported.add(method)
+                continue
+            if method != COPY_METHOD_HARDLINK:
+                shutil.copystat(src, dst)  # Same metadata as shutil.copy2
+            return method
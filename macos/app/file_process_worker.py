@@ -4,19 +4,21 @@ from compressStuff import process_files
 class FileProcessingWorker(QObject):
     progress = pyqtSignal(dict)  # Signal to emit progress as a dictionary
 
-    def __init__(self, input_folder, output_folder, load_progress, video_compression_speed, selected_image_quality):
+    def __init__(self, input_folder, output_folder, load_progress, video_compression_speed, selected_image_quality, total_size=None, image_format="keep"):
         super().__init__()
         self.input_folder = input_folder
         self.output_folder = output_folder
         self.load_progress = load_progress
         self.video_compression_speed = video_compression_speed
         self.selected_image_quality = selected_image_quality
+        self.total_size = total_size  # Size of the input folder, used to compute the progress percentage
+        self.image_format = image_format  # Output format policy for images, see image_codecs
         
         self._is_running = True
 
     def run(self):
         # Call the process_files function and pass the worker itself to handle signaling
-        process_files(self.input_folder, self.output_folder, self.load_progress, self, self.video_compression_speed, self.selected_image_quality )
+        process_files(self.input_folder, self.output_folder, self.load_progress, self, self.video_compression_speed, self.selected_image_quality, self.total_size, image_format=self.image_format)
 
     def stop(self):
         """Stop the file processing."""
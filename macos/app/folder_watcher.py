@@ -0,0 +1,229 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import time
+from run_logging import logger
+
+# A file is handed out once its size and mtime haven't changed for this many seconds
+DEFAULT_SETTLE_SECONDS = 2.0
+# How often the polling backend walks the folder
+DEFAULT_POLL_INTERVAL = 5.0
+
+# Names of files that are still being written by common upload/sync tools. They are renamed
+# to their final name when complete, which is seen as a new file.
+IGNORED_SUFFIXES = ('.part', '.partial', '.crdownload', '.download', '.tmp', '.temp')
+
+# inotify constants from sys/inotify.h
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+EVENT_HEADER = struct.Struct("iIII")  # wd, mask, cookie, name length
+READ_SIZE = 64 * 1024
+
+
+def is_ignored(path):
+    name = os.path.basename(path)
+    return name.startswith('.') or name.lower().endswith(IGNORED_SUFFIXES)
+
+
+def _walk_files(folder, ignore_folder=None):
+    for dirpath, dirnames, filenames in os.walk(folder):
+        if ignore_folder is not None:
+            dirnames[:] = [d for d in dirnames if os.path.join(dirpath, d) != ignore_folder]
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            if not is_ignored(path):
+                yield path
+
+
+class PollingBackend:
+    """Finds new and changed files by walking the folder every poll_interval seconds.
+
+    Works everywhere (including network shares, where change notifications often don't arrive),
+    but each poll stats the whole tree.
+    """
+
+    name = "polling"
+
+    def __init__(self, folder, ignore_folder=None, poll_interval=DEFAULT_POLL_INTERVAL):
+        self.folder = folder
+        self.ignore_folder = ignore_folder
+        self.poll_interval = poll_interval
+        self._previous = self._scan()  # Files that exist when watching starts are not new
+        self._next_poll = time.monotonic() + poll_interval
+
+    def _scan(self):
+        state = {}
+        for path in _walk_files(self.folder, self.ignore_folder):
+            try:
+                stat_result = os.stat(path)
+            except OSError:
+                continue  # Removed while scanning
+            state[path] = (stat_result.st_size, stat_result.st_mtime_ns)
+        return state
+
+    def wait(self, timeout):
+        """Returns the paths that appeared or changed, waiting at most timeout seconds."""
+        delay = self._next_poll - time.monotonic()
+        if delay > timeout:
+            time.sleep(timeout)
+            return set()
+        time.sleep(max(delay, 0))
+        self._next_poll = time.monotonic() + self.poll_interval
+        current = self._scan()
+        changed = {path for path, state in current.items() if self._previous.get(path) != state}
+        self._previous = current
+        return changed
+
+    def close(self):
+        pass
+
+
+class InotifyBackend:
+    """Linux change notifications: only touched files are looked at, the tree is never rescanned
+    unless the kernel's event queue overflows."""
+
+    name = "inotify"
+
+    def __init__(self, folder, ignore_folder=None):
+        self.folder = folder
+        self.ignore_folder = ignore_folder
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        self._directories = {}  # wd -> directory path
+        self._started_at_ns = time.time_ns()
+        self._add_tree(folder)
+
+    @staticmethod
+    def available():
+        if not sys.platform.startswith('linux'):
+            return False
+        library = ctypes.util.find_library('c')
+        return library is not None and hasattr(ctypes.CDLL(library), 'inotify_init1')
+
+    def _add_watch(self, directory):
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(directory), WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            logger.warning("Cannot watch %s: %s", directory, os.strerror(error))
+            return
+        self._directories[wd] = directory
+
+    def _add_tree(self, folder):
+        """Watches folder and every directory below it, returns the files found in them."""
+        files = set()
+        for dirpath, dirnames, filenames in os.walk(folder):
+            if self.ignore_folder is not None:
+                dirnames[:] = [d for d in dirnames if os.path.join(dirpath, d) != self.ignore_folder]
+            self._add_watch(dirpath)
+            files.update(os.path.join(dirpath, filename) for filename in filenames)
+        return {path for path in files if not is_ignored(path)}
+
+    def _rescan_recent(self):
+        """After a queue overflow events are lost, pick up files created or changed since watching started."""
+        logger.warning("Too many file events at once, rescanning %s", self.folder)
+        changed = set()
+        for path in _walk_files(self.folder, self.ignore_folder):
+            try:
+                if os.stat(path).st_ctime_ns >= self._started_at_ns:
+                    changed.add(path)
+            except OSError:
+                continue
+        return changed
+
+    def wait(self, timeout):
+        """Returns the paths that appeared or changed, waiting at most timeout seconds."""
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return set()
+        try:
+            data = os.read(self._fd, READ_SIZE)
+        except BlockingIOError:
+            return set()
+
+        changed = set()
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            wd, mask, _, name_length = EVENT_HEADER.unpack_from(data, offset)
+            name = data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + name_length].rstrip(b"\x00")
+            offset += EVENT_HEADER.size + name_length
+
+            if mask & IN_Q_OVERFLOW:
+                changed.update(self._rescan_recent())
+                continue
+            if mask & IN_IGNORED:
+                self._directories.pop(wd, None)  # The directory was removed
+                continue
+            directory = self._directories.get(wd)
+            if directory is None or not name:
+                continue
+            path = os.path.join(directory, os.fsdecode(name))
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO) and path != self.ignore_folder:
+                    # Files can land in a new directory before its watch exists, take what is already there
+                    changed.update(self._add_tree(path))
+            elif not is_ignored(path):
+                changed.add(path)
+        return changed
+
+    def close(self):
+        os.close(self._fd)
+
+
+class FolderWatcher:
+    """Watches a folder tree and hands out new or changed files once they are completely written.
+
+    A file counts as complete when its size and mtime stayed the same for settle_seconds, so
+    files that are still being uploaded or copied are not picked up half written.
+    """
+
+    def __init__(self, folder, settle_seconds=DEFAULT_SETTLE_SECONDS, ignore_folder=None,
+                 force_polling=False, poll_interval=DEFAULT_POLL_INTERVAL):
+        self.settle_seconds = settle_seconds
+        ignore_folder = os.path.abspath(ignore_folder) if ignore_folder else None
+        folder = os.path.abspath(folder)
+        if not force_polling and InotifyBackend.available():
+            self.backend = InotifyBackend(folder, ignore_folder)
+        else:
+            self.backend = PollingBackend(folder, ignore_folder, poll_interval)
+        self._pending = {}  # path -> ((size, mtime_ns), monotonic time it last changed)
+        logger.info("Watching %s for new files (%s)", folder, self.backend.name)
+
+    def _settle(self, now):
+        """Returns the pending files that stopped changing, drops the ones that disappeared."""
+        ready = []
+        for path, (state, changed_at) in list(self._pending.items()):
+            try:
+                stat_result = os.stat(path)
+            except OSError:
+                del self._pending[path]  # Removed or renamed before it settled
+                continue
+            current = (stat_result.st_size, stat_result.st_mtime_ns)
+            if current != state:
+                self._pending[path] = (current, now)
+            elif now - changed_at >= self.settle_seconds:
+                del self._pending[path]
+                ready.append(path)
+        return sorted(ready)
+
+    def wait_ready(self, timeout=1.0):
+        """Waits up to timeout seconds and returns the files that are ready to process."""
+        for path in self.backend.wait(timeout):
+            self._pending[path] = (None, time.monotonic())  # (re)starts the settle time
+        return self._settle(time.monotonic())
+
+    def close(self):
+        self.backend.close()
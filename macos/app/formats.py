@@ -0,0 +1,182 @@
+import io
+import os
+from PIL import Image
+from run_logging import logger
+
+try:
+    # HEIC/HEIF support for Pillow is a separate package
+    from pillow_heif import register_heif_opener
+    register_heif_opener()
+    HEIF_SUPPORTED = True
+except ImportError:
+    HEIF_SUPPORTED = False
+
+# Categories a file can be routed to
+CATEGORY_IMAGE = "image"
+CATEGORY_VIDEO = "video"
+CATEGORY_RAW = "raw"  # Camera RAW, only its embedded JPEG preview can be compressed
+
+# Bytes read from the start of every file for signature detection
+SIGNATURE_LENGTH = 32
+
+# Bytes handed to Pillow when probing a JPEG header inside a RAW file (enough for the APP segments)
+RAW_PREVIEW_PROBE_LENGTH = 1024 * 1024
+
+# Marker bytes that can follow FF D8 FF at the start of a real JPEG (APPn, DQT, DHT, COM)
+JPEG_FOURTH_BYTES = frozenset(range(0xE0, 0xF0)) | {0xDB, 0xC4, 0xFE}
+
+
+class MediaFormat:
+    """A file format the compressor knows about."""
+
+    def __init__(self, name, category, extensions, pillow_format=None, available=True):
+        self.name = name
+        self.category = category
+        self.extensions = extensions
+        self.pillow_format = pillow_format  # Format name Pillow reports when opening it, for images
+        self.available = available  # False when a needed optional package is missing
+
+    def __repr__(self):
+        return f"MediaFormat({self.name!r}, {self.category!r})"
+
+
+JPEG = MediaFormat("jpeg", CATEGORY_IMAGE, ('.jpg', '.jpeg', '.jpe'), 'JPEG')
+PNG = MediaFormat("png", CATEGORY_IMAGE, ('.png',), 'PNG')
+GIF = MediaFormat("gif", CATEGORY_IMAGE, ('.gif',), 'GIF')
+WEBP = MediaFormat("webp", CATEGORY_IMAGE, ('.webp',), 'WEBP')
+TIFF = MediaFormat("tiff", CATEGORY_IMAGE, ('.tif', '.tiff'), 'TIFF')
+BMP = MediaFormat("bmp", CATEGORY_IMAGE, ('.bmp',), 'BMP')
+HEIF = MediaFormat("heif", CATEGORY_IMAGE, ('.heic', '.heif'), 'HEIF', available=HEIF_SUPPORTED)
+MP4 = MediaFormat("mp4", CATEGORY_VIDEO, ('.mp4', '.m4v'))
+MOV = MediaFormat("mov", CATEGORY_VIDEO, ('.mov', '.qt'))
+THREE_GP = MediaFormat("3gp", CATEGORY_VIDEO, ('.3gp', '.3g2'))
+MATROSKA = MediaFormat("matroska", CATEGORY_VIDEO, ('.mkv', '.webm'))
+AVI = MediaFormat("avi", CATEGORY_VIDEO, ('.avi',))
+RAW = MediaFormat("raw", CATEGORY_RAW, ('.cr2', '.cr3', '.nef', '.nrw', '.arw', '.dng', '.orf', '.rw2', '.raf', '.pef', '.srw'))
+
+FORMATS = (JPEG, PNG, GIF, WEBP, TIFF, BMP, HEIF, MP4, MOV, THREE_GP, MATROSKA, AVI, RAW)
+
+EXTENSION_FORMATS = {extension: media_format for media_format in FORMATS for extension in media_format.extensions}
+
+# ISO base media (ftyp box) major brands
+FTYP_BRANDS = {
+    b'heic': HEIF, b'heix': HEIF, b'hevc': HEIF, b'hevx': HEIF, b'heim': HEIF, b'heis': HEIF,
+    b'mif1': HEIF, b'msf1': HEIF,
+    b'crx ': RAW,
+    b'qt  ': MOV,
+    b'3gp4': THREE_GP, b'3gp5': THREE_GP, b'3gp6': THREE_GP, b'3g2a': THREE_GP,
+}
+
+# Fixed signatures: (offset, magic bytes, format)
+SIGNATURES = (
+    (0, b'\xff\xd8\xff', JPEG),
+    (0, b'\x89PNG\r\n\x1a\n', PNG),
+    (0, b'GIF87a', GIF),
+    (0, b'GIF89a', GIF),
+    (0, b'\x1a\x45\xdf\xa3', MATROSKA),
+    (0, b'FUJIFILMCCD-RAW', RAW),
+    (0, b'IIRO', RAW),  # Olympus ORF
+    (0, b'IIRS', RAW),  # Olympus ORF
+    (0, b'IIU\x00', RAW),  # Panasonic RW2
+)
+
+TIFF_SIGNATURES = (b'II*\x00', b'MM\x00*')
+
+
+def detect_format_from_bytes(head, extension=""):
+    """Returns the MediaFormat for the first bytes of a file, or None if unknown.
+
+    The extension only breaks ties between containers that share a signature
+    (e.g. RAW files are TIFF structures).
+    """
+    extension = extension.lower()
+    for offset, magic, media_format in SIGNATURES:
+        if head[offset:offset + len(magic)] == magic:
+            return media_format
+
+    # BMP: "BM" followed by the file size and two reserved fields that are always zero
+    if head[:2] == b'BM' and head[6:10] == b'\x00\x00\x00\x00':
+        return BMP
+
+    if head[:4] in TIFF_SIGNATURES:
+        # Most RAW formats are TIFF based, CR2 also has a marker at offset 8
+        if head[8:10] == b'CR' or EXTENSION_FORMATS.get(extension) is RAW:
+            return RAW
+        return TIFF
+
+    if head[:4] == b'RIFF':
+        if head[8:12] == b'WEBP':
+            return WEBP
+        if head[8:12] == b'AVI ':
+            return AVI
+
+    if head[4:8] == b'ftyp':
+        brand = head[8:12]
+        if brand in FTYP_BRANDS:
+            return FTYP_BRANDS[brand]
+        if brand in (b'avif', b'avis'):
+            return None  # AVIF input is already a modern codec, leave it alone
+        if brand in (b'M4A ', b'M4B ', b'M4P '):
+            return None  # Audio only
+        # isom, mp41, mp42, M4V, dash, ... are all plain MP4
+        return MP4
+
+    return None
+
+
+def detect_format(path):
+    """Detects the format of a file by its magic bytes, falling back to its extension."""
+    extension = os.path.splitext(path)[1]
+    try:
+        with open(path, 'rb') as f:
+            head = f.read(SIGNATURE_LENGTH)
+    except OSError as e:
+        logger.warning("Could not read %s for format detection: %s", path, e)
+        head = b''
+    media_format = detect_format_from_bytes(head, extension)
+    if media_format is None and not head:
+        # Empty or unreadable files are only known by their name
+        media_format = EXTENSION_FORMATS.get(extension.lower())
+    return media_format
+
+
+def route_category(media_format, raw_previews=False):
+    """Returns the pipeline ('image', 'video') a format goes to, or None when it is copied as is."""
+    if media_format is None or not media_format.available:
+        return None
+    if media_format.category == CATEGORY_RAW:
+        return CATEGORY_IMAGE if raw_previews else None
+    return media_format.category
+
+
+def extract_raw_preview(path, data=None):
+    """Returns the largest JPEG preview embedded in a RAW file as an opened Image, or None.
+
+    RAW containers differ per vendor, but all of them embed one or more baseline JPEG
+    previews, so the file is searched for JPEG start markers and each candidate header
+    is read (without decoding) to find the biggest one. data is the file's content, if already read.
+    """
+    if data is None:
+        with open(path, 'rb') as f:
+            data = f.read()
+
+    best_position = None
+    best_pixels = 0
+    position = data.find(b'\xff\xd8\xff')
+    while position != -1:
+        if position + 3 < len(data) and data[position + 3] in JPEG_FOURTH_BYTES:
+            try:
+                # Only the header is parsed here, nothing is decoded
+                candidate = Image.open(io.BytesIO(data[position:position + RAW_PREVIEW_PROBE_LENGTH]))
+                pixels = candidate.width * candidate.height
+                if candidate.format == 'JPEG' and pixels > best_pixels:
+                    best_position, best_pixels = position, pixels
+            except Exception:
+                pass  # Not a real JPEG start, keep searching
+        position = data.find(b'\xff\xd8\xff', position + 3)
+
+    if best_position is None:
+        return None
+    preview = Image.open(io.BytesIO(data[best_position:]))
+    preview.load()
+    return preview
@@ -0,0 +1,228 @@
+import io
+import os
+from PIL import Image, ImageChops
+from run_logging import logger
+from formats import EXTENSION_FORMATS
+
+# Output format policies, selectable in the UI and with --image-format
+OUTPUT_FORMAT_KEEP = "keep"  # Same format as the input
+OUTPUT_FORMAT_PROGRESSIVE_JPEG = "progressive-jpeg"
+OUTPUT_FORMAT_WEBP = "webp"
+OUTPUT_FORMAT_AVIF = "avif"
+OUTPUT_FORMATS = (OUTPUT_FORMAT_KEEP, OUTPUT_FORMAT_PROGRESSIVE_JPEG, OUTPUT_FORMAT_WEBP, OUTPUT_FORMAT_AVIF)
+
+# Extension written for each output format
+FORMAT_EXTENSIONS = {
+    'JPEG': '.jpg',
+    'PNG': '.png',
+    'GIF': '.gif',
+    'WEBP': '.webp',
+    'AVIF': '.avif',
+}
+
+# Input formats that a policy converts, everything else keeps its format
+# (PNGs and GIFs that are kept go through the lossless path, GIFs become animated WebP with the webp policy)
+POLICY_INPUT_FORMATS = {
+    OUTPUT_FORMAT_PROGRESSIVE_JPEG: {'JPEG', 'TIFF', 'HEIF'},
+    OUTPUT_FORMAT_WEBP: {'JPEG', 'PNG', 'GIF', 'WEBP', 'TIFF', 'BMP', 'HEIF'},
+    OUTPUT_FORMAT_AVIF: {'JPEG', 'PNG', 'WEBP', 'TIFF', 'BMP', 'HEIF'},
+}
+
+# Input formats that are not written back as themselves, even when keeping the format:
+# TIFF scans and HEIC photos become JPEG, BMPs become (lossless) PNG
+KEEP_CONVERSIONS = {
+    'TIFF': 'JPEG',
+    'HEIF': 'JPEG',
+    'BMP': 'PNG',
+}
+
+# Formats written losslessly, their output is only used when it is smaller than the input
+LOSSLESS_FORMATS = frozenset({'PNG', 'GIF'})
+
+# Pixel modes that can be turned into an exact palette image
+PALETTE_CANDIDATE_MODES = frozenset({'RGB', 'RGBA', 'L', 'LA'})
+
+# Pixel modes with more than 8 bits per sample, and the formats that are written with them
+HIGH_BIT_DEPTH_MODES = {'I;16': 16, 'I;16L': 16, 'I;16B': 16, 'I;16N': 16, 'I': 32, 'F': 32}
+HIGH_BIT_DEPTH_FORMATS = frozenset({'PNG'})
+
+# TIFF tag with the bits per sample of each channel
+TIFF_BITS_PER_SAMPLE_TAG = 258
+
+_avif_supported = None
+
+
+def avif_supported():
+    """Returns True if the installed Pillow can write AVIF (natively or through a plugin)."""
+    global _avif_supported
+    if _avif_supported is None:
+        Image.init()
+        _avif_supported = 'AVIF' in Image.SAVE
+    return _avif_supported
+
+
+def available_output_formats():
+    """Returns the output format policies that work with the installed Pillow."""
+    return tuple(policy for policy in OUTPUT_FORMATS if policy != OUTPUT_FORMAT_AVIF or avif_supported())
+
+
+def check_output_format(policy):
+    """Raises ValueError for a policy that isn't one of OUTPUT_FORMATS."""
+    if policy not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown image output format {policy!r}, expected one of {', '.join(OUTPUT_FORMATS)}")
+
+
+def choose_output_format(input_format, policy):
+    """Returns (Pillow format, progressive) to encode an input of the given Pillow format under a policy."""
+    check_output_format(policy)
+    if input_format not in POLICY_INPUT_FORMATS.get(policy, ()):
+        return KEEP_CONVERSIONS.get(input_format, input_format), False
+    if policy == OUTPUT_FORMAT_PROGRESSIVE_JPEG:
+        return 'JPEG', True
+    if policy == OUTPUT_FORMAT_AVIF:
+        if avif_supported():
+            return 'AVIF', False
+        logger.warning("AVIF is not supported by the installed Pillow, writing WebP instead")
+        return 'WEBP', False
+    return 'WEBP', False
+
+
+def output_path_for_format(output_file, output_format, keep_name=False):
+    """Rewrites the extension of output_file to match the output format, if it differs.
+
+    keep_name appends the new extension instead (x.png -> x.png.webp), for inputs whose rewritten
+    name could be another input's output.
+    """
+    root, extension = os.path.splitext(output_file)
+    media_format = EXTENSION_FORMATS.get(extension.lower())
+    if media_format is not None and media_format.pillow_format == output_format:
+        return output_file
+    return (output_file if keep_name else root) + FORMAT_EXTENSIONS[output_format]
+
+
+def _has_alpha(img):
+    return 'A' in img.getbands() or 'transparency' in img.info
+
+
+def prepare_mode(img, output_format):
+    """Converts the image to a pixel mode the output encoder accepts."""
+    if output_format == 'JPEG':
+        if img.mode not in ('RGB', 'L', 'CMYK'):
+            return img.convert('RGB')
+    elif output_format in ('WEBP', 'AVIF'):
+        if img.mode not in ('RGB', 'RGBA'):
+            return img.convert('RGBA' if _has_alpha(img) else 'RGB')
+    return img
+
+
+def is_animated(img):
+    return getattr(img, 'is_animated', False) and getattr(img, 'n_frames', 1) > 1
+
+
+def page_count(img):
+    """Frames or pages of the image; an MPO's second frame is a preview, not part of the photo."""
+    if img.format == 'MPO':
+        return 1
+    return getattr(img, 'n_frames', 1)
+
+
+def bits_per_sample(img):
+    """Bits per channel of the source, from the TIFF header when there is one (Pillow loads 16-bit RGB as 8-bit)."""
+    bits = getattr(img, 'tag_v2', {}).get(TIFF_BITS_PER_SAMPLE_TAG)
+    if bits:
+        return max(bits) if isinstance(bits, tuple) else bits
+    return HIGH_BIT_DEPTH_MODES.get(img.mode, 8)
+
+
+def conversion_loss(img, output_format):
+    """Says what encoding the image as output_format would lose besides quality, or None.
+
+    Only GIF and WebP write more than one frame, and a plain convert() clips 16-bit samples
+    instead of scaling them. Such inputs are kept as they are.
+    """
+    pages = page_count(img)
+    if pages > 1 and not (output_format in ('GIF', 'WEBP') and img.format in ('GIF', 'WEBP')):
+        return f"{pages} pages"
+    bits = bits_per_sample(img)
+    if bits > 8 and output_format not in HIGH_BIT_DEPTH_FORMATS:
+        return f"{bits} bits per sample"
+    return None
+
+
+def exact_palette(img):
+    """Returns a palette ('P') version of the image if it has at most 256 colors and the
+    conversion loses nothing, otherwise None."""
+    if img.mode not in PALETTE_CANDIDATE_MODES:
+        return None
+    colors = img.getcolors(256)
+    if colors is None:
+        return None
+    source = img.convert('RGBA') if 'A' in img.mode else img.convert('RGB')
+    method = Image.Quantize.FASTOCTREE if source.mode == 'RGBA' else Image.Quantize.MEDIANCUT
+    palette_img = source.quantize(colors=len(colors), method=method, dither=Image.Dither.NONE)
+    if ImageChops.difference(palette_img.convert(source.mode), source).getbbox() is not None:
+        return None
+    return palette_img
+
+
+def encode_png_lossless(img, exif_data=None):
+    """Encodes a PNG losslessly, trying an exact palette version next to the original
+    pixels at the highest zlib level, and returns the smallest result."""
+    options = {'optimize': True}  # optimize implies zlib level 9
+    if exif_data is not None:
+        options['exif'] = exif_data
+
+    candidates = [img]
+    palette_img = exact_palette(img)
+    if palette_img is not None:
+        candidates.append(palette_img)
+
+    best = None
+    for candidate in candidates:
+        buffer = io.BytesIO()
+        candidate.save(buffer, format='PNG', **options)
+        if best is None or buffer.tell() < len(best):
+            best = buffer.getvalue()
+    return best
+
+
+def encode_gif(img):
+    """Re-encodes a GIF with Pillow's palette optimization, keeping every frame of animations."""
+    buffer = io.BytesIO()
+    if is_animated(img):
+        # Frame durations, loop count and disposal are carried over from the source by Pillow
+        img.save(buffer, format='GIF', save_all=True, optimize=True)
+    else:
+        img.save(buffer, format='GIF', optimize=True)
+    return buffer.getvalue()
+
+
+def encode_image(img, output_format, quality, exif_data=None, progressive=False):
+    """Encodes the image in memory and returns the encoded bytes."""
+    if output_format == 'PNG':
+        return encode_png_lossless(img, exif_data)
+    if output_format == 'GIF':
+        return encode_gif(img)
+
+    animated = is_animated(img) and output_format == 'WEBP'
+    if not animated:
+        # Animated WebP converts every frame itself, converting here would keep only the first
+        img = prepare_mode(img, output_format)
+    options = {}
+    if exif_data is not None:
+        options['exif'] = exif_data
+    if animated:
+        options['save_all'] = True
+
+    if output_format == 'JPEG':
+        options.update(optimize=True, quality=quality, progressive=progressive)
+    elif output_format == 'WEBP':
+        options.update(quality=quality, method=4)
+    elif output_format == 'AVIF':
+        options.update(quality=quality, speed=6)
+    else:
+        options.update(optimize=True)
+
+    buffer = io.BytesIO()
+    img.save(buffer, format=output_format, **options)
+    return buffer.getvalue()
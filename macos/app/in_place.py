@@ -0,0 +1,187 @@
+import datetime
+import json
+import os
+import shutil
+import threading
+from run_logging import logger
+
+# Folder inside the input folder with the journal, the staged outputs and the trash of in-place runs
+IN_PLACE_FOLDER_NAME = ".compress-in-place"
+JOURNAL_FILE_NAME = "journal.jsonl"
+STAGING_FOLDER_NAME = "staging"
+TRASH_FOLDER_NAME = "trash"
+
+# Journal operations
+OP_REPLACE = "replace"  # A verified output is about to replace its input
+OP_DONE = "done"  # The replacement is complete
+
+
+def fsync_path(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def fsync_directory(path):
+    """Makes renames in a directory durable; not every platform can open a directory for that."""
+    try:
+        fsync_path(path)
+    except OSError:
+        pass
+
+
+class InPlaceReplacer:
+    """Replaces inputs with their compressed outputs inside the input folder.
+
+    Outputs are written to a staging folder on the same volume. Once an output is complete and
+    verified, its replacement is journaled and the output is renamed over the input (or next to it
+    when the extension changes, then the input is removed). With a trash, the original is first
+    hardlinked into trash/<date>/ and dropped after trash_days.
+
+    Every step can be repeated, so a journal entry without its 'done' record is rolled forward when
+    the next run opens the folder: if the staged output still exists, the input was not touched yet.
+    No original is removed before its replacement is on disk.
+    """
+
+    def __init__(self, folder, trash_days=None):
+        self.folder = folder
+        self.root = os.path.join(folder, IN_PLACE_FOLDER_NAME)
+        self.staging_folder = os.path.join(self.root, STAGING_FOLDER_NAME)
+        self.trash_folder = os.path.join(self.root, TRASH_FOLDER_NAME)
+        self.journal_path = os.path.join(self.root, JOURNAL_FILE_NAME)
+        self.trash_days = trash_days  # None deletes originals right away
+        self._replaced = {}  # path of a finished file (replaced or kept) -> (size, mtime_ns) when it was finished
+        self._lock = threading.Lock()
+        self._journal = None
+
+    def open(self):
+        """Finishes replacements an interrupted run left behind, clears the staging folder and purges the trash."""
+        os.makedirs(self.root, exist_ok=True)
+        pending = {}
+        for entry in self._read_journal():
+            if entry['op'] == OP_REPLACE:
+                pending[entry['input']] = entry
+            elif entry['op'] == OP_DONE:
+                pending.pop(entry['input'], None)
+                self._replaced[entry['final']] = (entry['size'], entry['mtime_ns'])
+        for entry in pending.values():
+            logger.warning("Finishing the interrupted replacement of %s", entry['input'])
+            self._complete(entry)
+            self._record_done(entry, write=False)
+
+        # Staged files without a journal entry were never complete, their inputs are untouched
+        shutil.rmtree(self.staging_folder, ignore_errors=True)
+        os.makedirs(self.staging_folder)
+        self._compact_journal()
+        self._journal = open(self.journal_path, 'a')
+        self.purge_trash()
+        return self
+
+    def close(self):
+        with self._lock:
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+
+    def _read_journal(self):
+        if not os.path.exists(self.journal_path):
+            return []
+        entries = []
+        with open(self.journal_path, 'r') as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    break  # Torn last line of a crash, its replacement never started
+        return entries
+
+    def _compact_journal(self):
+        """Rewrites the journal with one 'done' record per replaced file."""
+        temporary_path = self.journal_path + ".partial"
+        with open(temporary_path, 'w') as f:
+            for path, (size, mtime_ns) in self._replaced.items():
+                f.write(json.dumps({'op': OP_DONE, 'input': path, 'final': path, 'size': size, 'mtime_ns': mtime_ns}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary_path, self.journal_path)
+
+    def _append(self, entry, durable):
+        self._journal.write(json.dumps(entry) + "\n")
+        self._journal.flush()
+        if durable:
+            os.fsync(self._journal.fileno())
+
+    def is_replaced(self, path, stat_result):
+        """True if an in-place run already replaced (or decided to keep) path and it hasn't changed since,
+        so it isn't compressed twice."""
+        with self._lock:
+            return self._replaced.get(path) == (stat_result.st_size, stat_result.st_mtime_ns)
+
+    def final_path(self, staged_file):
+        """Where a staged output goes in the input folder."""
+        return os.path.join(self.folder, os.path.relpath(staged_file, self.staging_folder))
+
+    def trash_path(self, input_file):
+        return os.path.join(self.trash_folder, datetime.date.today().isoformat(), os.path.relpath(input_file, self.folder))
+
+    def replace(self, input_file, staged_file, final_file):
+        """Replaces input_file with the complete staged output, which ends up at final_file."""
+        fsync_path(staged_file)  # The output must be on disk before the original can go
+        entry = {'op': OP_REPLACE, 'input': input_file, 'staged': staged_file, 'final': final_file,
+                 'trash': self.trash_path(input_file) if self.trash_days is not None else None}
+        with self._lock:
+            self._append(entry, durable=True)
+            self._complete(entry)
+            self._record_done(entry)
+
+    def keep(self, input_file):
+        """Records an input that stays as it is (its output wasn't smaller, or it isn't compressed)."""
+        with self._lock:
+            self._record_done({'input': input_file, 'final': input_file})
+
+    def discard(self, staged_file):
+        """Drops a staged output that won't replace its input."""
+        try:
+            os.remove(staged_file)
+        except FileNotFoundError:
+            pass
+
+    def _complete(self, entry):
+        input_file, staged_file, final_file, trash_file = entry['input'], entry['staged'], entry['final'], entry['trash']
+        if os.path.exists(staged_file):
+            if trash_file and os.path.exists(input_file) and not os.path.exists(trash_file):
+                os.makedirs(os.path.dirname(trash_file), exist_ok=True)
+                try:
+                    os.link(input_file, trash_file)  # The original stays in place until it is replaced
+                except OSError:
+                    shutil.copy2(input_file, trash_file)
+            os.replace(staged_file, final_file)
+            fsync_directory(os.path.dirname(final_file))
+        if final_file != input_file and os.path.exists(final_file) and os.path.exists(input_file):
+            os.remove(input_file)
+
+    def _record_done(self, entry, write=True):
+        try:
+            stat_result = os.stat(entry['final'])
+        except FileNotFoundError:
+            return  # The staged output was lost before it was moved, the input is still there
+        self._replaced[entry['final']] = (stat_result.st_size, stat_result.st_mtime_ns)
+        if write:
+            self._append({'op': OP_DONE, 'input': entry['input'], 'final': entry['final'],
+                          'size': stat_result.st_size, 'mtime_ns': stat_result.st_mtime_ns}, durable=False)
+
+    def purge_trash(self):
+        """Deletes the trash folders of days that are older than trash_days."""
+        if self.trash_days is None or not os.path.isdir(self.trash_folder):
+            return
+        cutoff = datetime.date.today() - datetime.timedelta(days=self.trash_days)
+        for name in os.listdir(self.trash_folder):
+            try:
+                day = datetime.date.fromisoformat(name)
+            except ValueError:
+                continue
+            if day < cutoff:
+                logger.info("Emptying the trash of %s", name)
+                shutil.rmtree(os.path.join(self.trash_folder, name), ignore_errors=True)
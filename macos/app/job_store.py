@@ -0,0 +1,277 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from run_logging import logger
+from path_index import PathIndex, PathTable, path_key, write_index
+
+JOB_DB_FILE_NAME = "compression-jobs.sqlite3"
+# Progress file of older versions, imported once when resuming
+LEGACY_PROGRESS_FILE_NAME = "saved-progress.json"
+# Memory-mapped index of the finished files next to the database, rebuilt when a job is resumed (see done_index)
+DONE_INDEX_SUFFIX = ".done-index"
+
+# Records are committed in batches: after this many changes or this many seconds, whichever comes first.
+# An interrupted run redoes at most the files of the last batch.
+COMMIT_BATCH_SIZE = 50
+COMMIT_INTERVAL = 2.0
+
+# File states
+STATE_RUNNING = "running"
+STATE_DONE = "done"
+STATE_QUARANTINED = "quarantined"  # Failed even after retries, skipped when resuming
+FINISHED_STATES = (STATE_DONE, STATE_QUARANTINED)
+# States as stored in the state column of the done index
+STATE_CODES = {STATE_DONE: 1, STATE_QUARANTINED: 2}
+
+# Categories of finished files, with the RunStats counters they add up to
+CATEGORY_COUNTERS = {
+    'image': ('processed_images_count', 'total_original_images_size', 'total_final_images_size'),
+    'video': ('processed_videos_count', 'total_original_videos_size', 'total_final_videos_size'),
+    'skipped_video': ('skipped_videos_count', 'total_skipped_videos_size', None),
+    'unsupported': ('unsupported_files_count', 'total_unsupported_files_size', None),
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    state TEXT NOT NULL,
+    category TEXT,
+    settings TEXT,
+    input_size INTEGER,
+    output_path TEXT,
+    output_size INTEGER,
+    started_at REAL,
+    finished_at REAL,
+    duration REAL,
+    error TEXT,
+    detail TEXT,
+    attempts INTEGER
+);
+CREATE INDEX IF NOT EXISTS files_state_category ON files (state, category);
+CREATE INDEX IF NOT EXISTS files_error ON files (error) WHERE error IS NOT NULL;
+CREATE TABLE IF NOT EXISTS run_state (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+# Columns added after the first version of the schema, added to older databases when they are opened
+ADDED_COLUMNS = (
+    ('detail', 'TEXT'),  # More about the error, e.g. the last lines ffmpeg printed
+    ('attempts', 'INTEGER'),
+    # 128-bit hash of the path (see path_index.path_key), the sort order of the done index
+    ('path_hi', 'INTEGER'),
+    ('path_lo', 'INTEGER'),
+)
+
+
+class JobStore:
+    """SQLite database with the state of every file of the current job and the job's settings.
+
+    Replaces saved-progress.json: resuming, the UI's percentage and the summary are answered
+    with indexed queries instead of rewriting and re-reading a JSON list per file. The
+    database is in WAL mode, so the UI can read while a run writes.
+    """
+
+    def __init__(self, path=JOB_DB_FILE_NAME):
+        self.path = path
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")  # Durable at each commit in WAL mode, without an fsync per write
+        self._connection.executescript(SCHEMA)
+        self._add_missing_columns()
+        self._lock = threading.Lock()
+        self._uncommitted = 0
+        self._last_commit = time.monotonic()
+
+    def _add_missing_columns(self):
+        columns = {row[1] for row in self._connection.execute("PRAGMA table_info(files)")}
+        for name, column_type in ADDED_COLUMNS:
+            if name not in columns:
+                self._connection.execute(f"ALTER TABLE files ADD COLUMN {name} {column_type}")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS files_path_key ON files (path_hi, path_lo)")
+        # Rows written before the key columns existed get their keys once
+        self._connection.create_function("path_hi", 1, lambda path: path_key(path)[0], deterministic=True)
+        self._connection.create_function("path_lo", 1, lambda path: path_key(path)[1], deterministic=True)
+        self._connection.execute("UPDATE files SET path_hi = path_hi(path), path_lo = path_lo(path) WHERE path_hi IS NULL")
+        self._connection.commit()
+
+    def _changed(self):
+        """Counts one change and commits the batch when it is due. Called with the lock held."""
+        self._uncommitted += 1
+        if self._uncommitted >= COMMIT_BATCH_SIZE or time.monotonic() - self._last_commit >= COMMIT_INTERVAL:
+            self._commit()
+
+    def _commit(self):
+        self._connection.commit()
+        self._uncommitted = 0
+        self._last_commit = time.monotonic()
+
+    def commit(self):
+        with self._lock:
+            self._commit()
+
+    def close(self):
+        with self._lock:
+            self._commit()
+            self._connection.close()
+
+    def reset(self):
+        """Forgets everything, for a fresh start."""
+        with self._lock:
+            self._connection.execute("DELETE FROM files")
+            self._connection.execute("DELETE FROM run_state")
+            self._commit()
+        if os.path.exists(self.path + DONE_INDEX_SUFFIX):
+            os.remove(self.path + DONE_INDEX_SUFFIX)
+
+    def set_run_state(self, **values):
+        with self._lock:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO run_state (key, value) VALUES (?, ?)",
+                [(key, json.dumps(value)) for key, value in values.items()])
+            self._commit()
+
+    def get_run_state(self, key, default=None):
+        with self._lock:
+            row = self._connection.execute("SELECT value FROM run_state WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def file_started(self, path, settings):
+        key_hi, key_lo = path_key(path)
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO files (path, state, settings, started_at, path_hi, path_lo) VALUES (?, ?, ?, ?, ?, ?)",
+                (path, STATE_RUNNING, settings, time.time(), key_hi, key_lo))
+            self._changed()
+
+    def file_finished(self, path, category, input_size, output_path, output_size, duration, error=None,
+                      detail=None, attempts=1):
+        with self._lock:
+            self._connection.execute(
+                "UPDATE files SET state = ?, category = ?, input_size = ?, output_path = ?, output_size = ?,"
+                " finished_at = ?, duration = ?, error = ?, detail = ?, attempts = ? WHERE path = ?",
+                (STATE_DONE, category, input_size, output_path, output_size, time.time(), duration, error, detail,
+                 attempts, path))
+            self._changed()
+
+    def file_quarantined(self, path, input_size, duration, error, detail=None, attempts=1):
+        """Records a file that failed every attempt. It has no output and resuming skips it."""
+        with self._lock:
+            self._connection.execute(
+                "UPDATE files SET state = ?, input_size = ?, output_path = NULL, output_size = NULL, finished_at = ?,"
+                " duration = ?, error = ?, detail = ?, attempts = ? WHERE path = ?",
+                (STATE_QUARANTINED, input_size, time.time(), duration, error, detail, attempts, path))
+            self._changed()
+
+    def forget(self, paths):
+        """Drops the records of the given files, so they are processed (and counted) again."""
+        with self._lock:
+            self._connection.executemany("DELETE FROM files WHERE path = ?", [(path,) for path in paths])
+            self._commit()
+
+    def failures(self):
+        """Files that failed, with what happened to them, for the failure report."""
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT path, state, category, error, detail, attempts, output_path FROM files"
+                " WHERE error IS NOT NULL ORDER BY path").fetchall()
+        return [{'path': path, 'state': state, 'category': category, 'error': error, 'detail': detail,
+                 'attempts': attempts or 1, 'output_path': output_path}
+                for path, state, category, error, detail, attempts, output_path in rows]
+
+    def done_index(self):
+        """Writes the files finished (or quarantined) by earlier runs, the resume set, into an index file and maps it.
+
+        The rows stream out of the database in key order, so the set is never held in memory as strings.
+        """
+        index_path = self.path + DONE_INDEX_SUFFIX
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT path_hi, path_lo, COALESCE(input_size, 0), state FROM files WHERE state IN (?, ?)"
+                " ORDER BY path_hi, path_lo", FINISHED_STATES)
+            write_index(index_path, ((key_hi, key_lo, size, STATE_CODES[state]) for key_hi, key_lo, size, state in rows))
+        return PathIndex(index_path)
+
+    def done_input_bytes(self):
+        """Input bytes of every finished file, including the ones imported from an old progress file."""
+        with self._lock:
+            (total,) = self._connection.execute(
+                "SELECT COALESCE(SUM(input_size), 0) FROM files WHERE state IN (?, ?)", FINISHED_STATES).fetchone()
+        return total + self.get_run_state('legacy_done_bytes', 0)
+
+    def progress_percentage(self):
+        """How much of the input folder is done, or None when the folder size is unknown."""
+        total_size = self.get_run_state('total_size')
+        if not total_size:
+            return None
+        return min(100 * self.done_input_bytes() / total_size, 100)
+
+    def checkpoint(self):
+        """Counters and file lists of the finished files, in the shape RunStats.from_checkpoint takes."""
+        data = dict(self.get_run_state('legacy_counters', {}))
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT category, COUNT(*), COALESCE(SUM(input_size), 0), COALESCE(SUM(output_size), 0)"
+                " FROM files WHERE state = ? GROUP BY category", (STATE_DONE,)).fetchall()
+            failures = self._connection.execute("SELECT path, error, state FROM files WHERE error IS NOT NULL").fetchall()
+            # Every unsupported file, so kept compact (see PathTable)
+            unsupported_files = PathTable(data.get('unsupported_files', []))
+            for (path,) in self._connection.execute(
+                    "SELECT path FROM files WHERE state = ? AND category = 'unsupported'", (STATE_DONE,)):
+                unsupported_files.append(path)
+        for category, count, input_size, output_size in rows:
+            if category not in CATEGORY_COUNTERS:
+                continue
+            count_name, input_name, output_name = CATEGORY_COUNTERS[category]
+            data[count_name] = data.get(count_name, 0) + count
+            data[input_name] = data.get(input_name, 0) + input_size
+            if output_name:
+                data[output_name] = data.get(output_name, 0) + output_size
+            if category == 'skipped_video':
+                data['processed_videos_count'] = data.get('processed_videos_count', 0) + count  # Copied videos count as processed too
+        data['failed_files'] = data.get('failed_files', []) + [path for path, _, _ in failures]
+        data['failure_reasons'] = {path: error for path, error, _ in failures}
+        data['quarantined_files'] = [path for path, _, state in failures if state == STATE_QUARANTINED]
+        data['unsupported_files'] = unsupported_files
+        return data
+
+    def import_legacy_progress(self, path=LEGACY_PROGRESS_FILE_NAME):
+        """Takes over the progress of a saved-progress.json written by older versions, then renames it."""
+        if not os.path.exists(path):
+            return False
+        try:
+            with open(path, 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning("Could not read %s, ignoring it: %s", path, e)
+            return False
+        processed_files = data.pop('processed_files', [])
+        legacy_done_bytes = sum(os.path.getsize(p) for p in processed_files if os.path.isfile(p))
+        with self._lock:
+            self._connection.executemany(
+                "INSERT OR IGNORE INTO files (path, state, path_hi, path_lo) VALUES (?, ?, ?, ?)",
+                [(p, STATE_DONE, *path_key(p)) for p in processed_files])
+            self._commit()
+        self.set_run_state(inputFolder=data.pop('inputFolder', None), outputFolder=data.pop('outputFolder', None),
+                           legacy_counters=data, legacy_done_bytes=legacy_done_bytes)
+        os.replace(path, path + ".imported")
+        logger.info("Imported %d processed files from %s", len(processed_files), path)
+        return True
+
+
+def read_saved_job(path=JOB_DB_FILE_NAME):
+    """Returns (input folder, output folder, progress percentage) of the saved job, for the UI.
+
+    Missing values are '' (folders) and 0 (progress).
+    """
+    if not os.path.exists(path):
+        return '', '', 0
+    store = JobStore(path)
+    try:
+        return (store.get_run_state('inputFolder') or '', store.get_run_state('outputFolder') or '',
+                store.progress_percentage() or 0)
+    finally:
+        store.close()
@@ -1,8 +1,10 @@
 import sys
 from PyQt6.QtWidgets import QApplication
 from ui.main_window import MainWindow
+from run_logging import configure_logging
 
 def main():
+    configure_logging(verbose='--verbose' in sys.argv, quiet='--quiet' in sys.argv)
     app = QApplication(sys.argv)
     window = MainWindow()
     window.show()
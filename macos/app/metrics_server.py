@@ -0,0 +1,91 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from run_logging import logger
+
+
+def format_labels(labels):
+    """Formats a label dict as {key="value",...} in Prometheus text format."""
+    if not labels:
+        return ""
+    parts = []
+    for key, value in sorted(labels.items()):
+        escaped = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        parts.append(f'{key}="{escaped}"')
+    return "{" + ",".join(parts) + "}"
+
+
+def format_value(value):
+    """Formats a sample value without losing precision on large byte counts."""
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
+
+
+def render_metrics(metrics):
+    """Renders metrics in the Prometheus text exposition format.
+
+    metrics: list of (name, type, help, samples) where samples is either a number
+    or a list of (labels dict, number) tuples.
+    """
+    lines = []
+    for name, metric_type, help_text, samples in metrics:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        if not isinstance(samples, list):
+            samples = [({}, samples)]
+        for labels, value in samples:
+            lines.append(f"{name}{format_labels(labels)} {format_value(value)}")
+    return "\n".join(lines) + "\n"
+
+
+class MetricsServer:
+    """Serves /metrics over HTTP from a background thread.
+
+    collect: callable returning the metrics list understood by render_metrics.
+    """
+
+    def __init__(self, port, collect, host="127.0.0.1"):
+        self.port = port
+        self.host = host
+        self.collect = collect
+        self._server = None
+        self._thread = None
+
+    def start(self):
+        collect = self.collect
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/metrics", "/"):
+                    self.send_error(404)
+                    return
+                try:
+                    body = render_metrics(collect()).encode("utf-8")
+                except Exception as e:
+                    logger.error("Failed to collect metrics: %s", e)
+                    self.send_error(500)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # Scrapes every few seconds would otherwise flood stderr
+                pass
+
+        self._server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, name="metrics-server", daemon=True)
+        self._thread.start()
+        logger.info("Metrics available at http://%s:%d/metrics", self.host, self._server.server_address[1])
+        return self
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
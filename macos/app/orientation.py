@@ -0,0 +1,26 @@
+from PIL import Image
+
+# Transpose that turns an image stored with the given EXIF orientation upright (same as ImageOps.exif_transpose)
+ORIENTATION_TRANSPOSE = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+
+
+def apply_orientation(img, orientation):
+    """Returns the image turned upright for the given EXIF orientation, in a single transpose.
+
+    The original image is returned untouched for orientation 1 or unknown values.
+    """
+    method = ORIENTATION_TRANSPOSE.get(orientation)
+    if method is None:
+        return img
+    transposed = img.transpose(method)
+    # transpose() drops the format, which the encoder falls back to when keeping the input format
+    transposed.format = img.format
+    return transposed
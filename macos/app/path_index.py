@@ -0,0 +1,180 @@
+import array
+import hashlib
+import itertools
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+from bisect import bisect_left
+
+# A path is identified by a 128-bit hash, kept as two signed 64-bit ints (SQLite's INTEGER).
+# Two of ten million paths share a key with a chance of about 1e-25, so a key match counts as a path match.
+KEY = struct.Struct("<qq")
+
+# Index file: a header with the row count, then every column as a packed array in native byte order.
+# Rows are sorted by key; the file is rebuilt from the job store when a run resumes.
+INDEX_MAGIC = b"CSPIDX01"
+INDEX_HEADER = struct.Struct("<8sQ")
+INDEX_COLUMNS = (('key_hi', 'q'), ('key_lo', 'q'), ('size', 'q'), ('state', 'B'))
+INDEX_WRITE_CHUNK_ROWS = 64 * 1024
+
+
+def path_digest(path):
+    return hashlib.blake2b(os.fsencode(path), digest_size=KEY.size).digest()
+
+
+def path_key(path):
+    """The (high, low) key of a path, as the job store and the index keep it."""
+    return KEY.unpack(path_digest(path))
+
+
+def write_index(path, rows):
+    """Writes an index file from rows of (key high, key low, size, state), sorted by key; returns the row count.
+
+    Each column is spilled to its own temporary file while the rows stream in, so building the index
+    of millions of files takes a few chunks of memory, not the whole table.
+    """
+    column_files = [tempfile.TemporaryFile(dir=os.path.dirname(os.path.abspath(path))) for _ in INDEX_COLUMNS]
+    try:
+        count = 0
+        rows = iter(rows)
+        while True:
+            chunk = list(itertools.islice(rows, INDEX_WRITE_CHUNK_ROWS))
+            if not chunk:
+                break
+            for column_file, (_, typecode), values in zip(column_files, INDEX_COLUMNS, zip(*chunk)):
+                column_file.write(array.array(typecode, values).tobytes())
+            count += len(chunk)
+
+        temporary_path = path + ".partial"
+        with open(temporary_path, 'wb') as f:
+            f.write(INDEX_HEADER.pack(INDEX_MAGIC, count))
+            for column_file in column_files:
+                column_file.seek(0)
+                shutil.copyfileobj(column_file, f)
+        os.replace(temporary_path, path)
+        return count
+    finally:
+        for column_file in column_files:
+            column_file.close()
+
+
+class PathIndex:
+    """Read-only set of paths in a memory-mapped index file (see write_index), with a size and state per path.
+
+    Lookups are a binary search over the sorted key column, so they touch a few pages of the file
+    and resuming a job of ten million files doesn't load ten million path strings first.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self._count = INDEX_HEADER.unpack_from(self._map)
+        if magic != INDEX_MAGIC:
+            self._map.close()
+            raise ValueError(f"{path} is not a path index")
+        self._views = []
+        offset = INDEX_HEADER.size
+        for _, typecode in INDEX_COLUMNS:
+            length = self._count * array.array(typecode).itemsize
+            self._views.append(memoryview(self._map)[offset:offset + length].cast(typecode))
+            offset += length
+        self._key_hi, self._key_lo, self._sizes, self._states = self._views
+
+    def __len__(self):
+        return self._count
+
+    def __contains__(self, path):
+        return self.find(path) is not None
+
+    def find(self, path):
+        """Row of the path, or None when it isn't in the index."""
+        return self.find_key(*path_key(path))
+
+    def find_key(self, key_hi, key_lo):
+        row = bisect_left(self._key_hi, key_hi)
+        while row < self._count and self._key_hi[row] == key_hi:
+            if self._key_lo[row] == key_lo:
+                return row
+            row += 1
+        return None
+
+    def size(self, row):
+        return self._sizes[row]
+
+    def state(self, row):
+        return self._states[row]
+
+    def close(self):
+        for view in self._views:
+            view.release()
+        self._views = []
+        self._map.close()
+
+
+class PathSet:
+    """Paths seen so far, without keeping the paths: a PathIndex of earlier runs plus the digests added since."""
+
+    def __init__(self, index=None):
+        self.index = index
+        self._digests = set()
+
+    def add(self, path):
+        self._digests.add(path_digest(path))
+
+    def __contains__(self, path):
+        digest = path_digest(path)
+        return digest in self._digests or (self.index is not None and self.index.find_key(*KEY.unpack(digest)) is not None)
+
+    def close(self):
+        if self.index is not None:
+            self.index.close()
+            self.index = None
+
+
+class PathTable:
+    """Append-only list of paths with interned directory prefixes.
+
+    A path is stored as the id of its directory and its file name, encoded into one shared buffer,
+    so a million files in a few thousand folders cost about 20 bytes each plus the name, instead of
+    a str object apiece. Rows are only complete once appended, so reading while another thread
+    appends sees the earlier rows.
+    """
+
+    def __init__(self, paths=()):
+        self._directories = []
+        self._directory_ids = {}
+        self._row_directories = array.array('I')
+        self._names = bytearray()
+        self._name_ends = array.array('Q')
+        for path in paths:
+            self.append(path)
+
+    def append(self, path):
+        name = os.path.basename(path)
+        directory = path[:len(path) - len(name)]  # With its separator, so the path comes back exactly
+        directory_id = self._directory_ids.get(directory)
+        if directory_id is None:
+            directory_id = self._directory_ids[directory] = len(self._directories)
+            self._directories.append(directory)
+        self._row_directories.append(directory_id)
+        self._names += os.fsencode(name)
+        self._name_ends.append(len(self._names))  # Last, so the row counts only when it is complete
+
+    def __len__(self):
+        return len(self._name_ends)
+
+    def __getitem__(self, row):
+        if row < 0:
+            row += len(self)
+        if not 0 <= row < len(self):
+            raise IndexError(row)
+        start = self._name_ends[row - 1] if row else 0
+        name = os.fsdecode(bytes(self._names[start:self._name_ends[row]]))
+        return self._directories[self._row_directories[row]] + name
+
+    def __iter__(self):
+        for row in range(len(self)):
+            yield self[row]
@@ -0,0 +1,166 @@
+import collections
+import os
+import queue
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from run_logging import logger
+
+# Read-ahead: how many upcoming files may be read, and how many bytes may be held in memory for them
+DEFAULT_PREFETCH_FILES = 8
+DEFAULT_PREFETCH_BYTES = 256 * 1024 * 1024
+DEFAULT_PREFETCH_THREADS = 2
+# Files larger than this are never prefetched, they are read by their consumer as before
+MAX_PREFETCH_FILE_BYTES = 64 * 1024 * 1024
+
+# Write-behind: bytes of encoded output that may wait for the disk before the encoder blocks
+DEFAULT_WRITE_BEHIND_BYTES = 128 * 1024 * 1024
+
+
+def _read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+class Prefetcher:
+    """Iterates over input paths while I/O threads read the next files into memory.
+
+    Yields (path, data) in the original order. data is the file's content when it was
+    prefetched, or None when the consumer has to read the file itself (not wanted by
+    should_prefetch, too large, over the byte budget, or the read failed).
+    """
+
+    def __init__(self, paths, should_prefetch, max_files=DEFAULT_PREFETCH_FILES,
+                 max_bytes=DEFAULT_PREFETCH_BYTES, threads=DEFAULT_PREFETCH_THREADS):
+        self._paths = iter(paths)
+        self._should_prefetch = should_prefetch
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        self._executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="prefetch")
+        self._window = collections.deque()  # [path, size, future or None]
+        self._bytes_in_flight = 0
+        self._exhausted = False
+
+    def _fill(self):
+        """Tops the window up to max_files paths and starts reads while the byte budget allows."""
+        while not self._exhausted and len(self._window) < self.max_files:
+            path = next(self._paths, None)
+            if path is None:
+                self._exhausted = True
+                break
+            size = None
+            if self._should_prefetch(path):
+                try:
+                    size = os.path.getsize(path)
+                except OSError:
+                    pass
+                if size is not None and size > MAX_PREFETCH_FILE_BYTES:
+                    size = None
+            self._window.append([path, size, None])
+
+        for entry in self._window:
+            path, size, future = entry
+            if size is None or future is not None:
+                continue
+            if self._bytes_in_flight + size > self.max_bytes and self._bytes_in_flight > 0:
+                break  # Keep the order, later files wait until earlier ones were consumed
+            entry[2] = self._executor.submit(_read_file, path)
+            self._bytes_in_flight += size
+
+    def __iter__(self):
+        try:
+            self._fill()
+            while self._window:
+                path, size, future = self._window.popleft()
+                data = None
+                if future is not None:
+                    self._bytes_in_flight -= size
+                    try:
+                        data = future.result()
+                    except OSError as e:
+                        logger.debug("Prefetch of %s failed, reading it directly: %s", path, e)
+                self._fill()  # Start the next reads before the caller spends time on this file
+                yield path, data
+        finally:
+            self.close()
+
+    def close(self):
+        for _, _, future in self._window:
+            if future is not None:
+                future.cancel()
+        self._window.clear()
+        self._executor.shutdown(wait=False)
+
+
+class WriteBehind:
+    """Runs output writes and the bookkeeping that depends on them on one background thread.
+
+    Tasks run in submission order, so a file's checkpoint task (queued after its write)
+    only runs once the output is on disk. submit() blocks while more than max_bytes of
+    output are waiting, which bounds memory when the disk is slower than the encoders.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_WRITE_BEHIND_BYTES):
+        self.max_bytes = max_bytes
+        self._tasks = queue.Queue()
+        self._pending_bytes = 0
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+        self._thread.start()
+
+    def submit(self, task, nbytes=0):
+        """Queues task() to run after everything submitted before it."""
+        with self._condition:
+            while self._pending_bytes > 0 and self._pending_bytes + nbytes > self.max_bytes:
+                self._condition.wait()
+            self._pending_bytes += nbytes
+        self._tasks.put((task, nbytes))
+
+    def _run(self):
+        while True:
+            task, nbytes = self._tasks.get()
+            try:
+                if task is None:
+                    return
+                task()
+            except Exception as e:
+                logger.error("Background task failed: %s", e)
+            finally:
+                with self._condition:
+                    self._pending_bytes -= nbytes
+                    self._condition.notify_all()
+                self._tasks.task_done()
+
+    def drain(self):
+        """Waits until every queued task has run."""
+        self._tasks.join()
+
+    def close(self):
+        self.drain()
+        self._tasks.put((None, 0))
+        self._thread.join()
+
+
+def partial_path(path):
+    """Temporary name next to path, unique per write so two writers of the same output never share it.
+
+    The extension stays last, ffmpeg picks the container by it.
+    """
+    root, extension = os.path.splitext(path)
+    return f"{root}.{uuid.uuid4().hex[:12]}.partial{extension}"
+
+
+def write_file_atomic(path, data):
+    """Writes data to a temporary file next to path and renames it into place, so a crash
+    never leaves a truncated output behind."""
+    temporary_path = partial_path(path)
+    try:
+        with open(temporary_path, 'wb') as f:
+            f.write(data)
+        os.replace(temporary_path, path)
+    except BaseException:
+        try:
+            os.remove(temporary_path)
+        except FileNotFoundError:
+            pass
+        raise
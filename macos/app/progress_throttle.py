@@ -0,0 +1,48 @@
+import threading
+import time
+
+# Default rate at which progress reaches the UI (10 Hz)
+DEFAULT_PROGRESS_INTERVAL = 0.1
+
+
+class ProgressThrottle:
+    """Coalesces progress updates so `emit` is called at most once per interval.
+
+    Updates arriving faster than the interval replace each other; only the latest
+    snapshot is delivered, either by a later update(), poll() or flush().
+    """
+
+    def __init__(self, emit, interval=DEFAULT_PROGRESS_INTERVAL, clock=time.monotonic):
+        self.emit = emit
+        self.interval = interval
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._pending = None
+        self._last_emit = None
+
+    def update(self, data):
+        """Queues a snapshot and emits it right away if the interval has passed."""
+        with self._lock:
+            self._pending = data
+        self.poll()
+
+    def poll(self):
+        """Emits the pending snapshot if one is waiting and the interval has passed."""
+        with self._lock:
+            now = self.clock()
+            if self._pending is None:
+                return
+            if self._last_emit is not None and now - self._last_emit < self.interval:
+                return
+            data, self._pending = self._pending, None
+            self._last_emit = now
+        self.emit(data)
+
+    def flush(self):
+        """Emits the pending snapshot regardless of the interval, used at the end of a run."""
+        with self._lock:
+            data, self._pending = self._pending, None
+            if data is not None:
+                self._last_emit = self.clock()
+        if data is not None:
+            self.emit(data)
@@ -0,0 +1,168 @@
+import io
+import statistics
+import threading
+from PIL import Image
+from image_codecs import encode_image
+from exif_filter import parse_essential_exif, ExifParseError
+
+try:
+    import numpy as np
+except ImportError:  # Only needed for the SSIM mode
+    np = None
+
+# Quality modes, selectable with --quality-search
+QUALITY_MODE_FIXED = "fixed"  # Always use the configured image quality
+QUALITY_MODE_SSIM = "ssim"  # Lowest quality that keeps the SSIM at or above the target
+QUALITY_MODE_BPP = "bpp"  # Highest quality that stays at or below the target bits per pixel
+QUALITY_MODES = (QUALITY_MODE_FIXED, QUALITY_MODE_SSIM, QUALITY_MODE_BPP)
+
+DEFAULT_TARGET_SSIM = 0.95
+DEFAULT_TARGET_BPP = 1.0
+MIN_QUALITY = 10
+MAX_QUALITY = 95
+
+# SSIM is computed on a copy whose longest side is at most this many pixels
+SSIM_MAX_SIDE = 512
+SSIM_WINDOW = 8
+
+# After this many searches for the same camera, the median of their results is reused
+CAMERA_CACHE_SAMPLES = 8
+
+# Formats whose quality setting can be searched
+SEARCHABLE_FORMATS = frozenset({'JPEG', 'WEBP', 'AVIF'})
+
+CAMERA_MAKE_TAG = 271
+CAMERA_MODEL_TAG = 272
+
+
+def _box_mean(values, window):
+    """Mean over every window x window block, using an integral image."""
+    integral = np.pad(values, ((1, 0), (1, 0))).cumsum(axis=0).cumsum(axis=1)
+    total = (integral[window:, window:] - integral[:-window, window:]
+             - integral[window:, :-window] + integral[:-window, :-window])
+    return total / (window * window)
+
+
+def ssim(reference, candidate, window=SSIM_WINDOW):
+    """Mean structural similarity of two grayscale images of the same size (1.0 means identical)."""
+    x = np.asarray(reference, dtype=np.float64)
+    y = np.asarray(candidate, dtype=np.float64)
+    window = min(window, x.shape[0], x.shape[1])
+    c1 = (0.01 * 255) ** 2
+    c2 = (0.03 * 255) ** 2
+
+    mu_x = _box_mean(x, window)
+    mu_y = _box_mean(y, window)
+    var_x = _box_mean(x * x, window) - mu_x * mu_x
+    var_y = _box_mean(y * y, window) - mu_y * mu_y
+    cov_xy = _box_mean(x * y, window) - mu_x * mu_y
+
+    score = ((2 * mu_x * mu_y + c1) * (2 * cov_xy + c2)) / ((mu_x * mu_x + mu_y * mu_y + c1) * (var_x + var_y + c2))
+    return float(score.mean())
+
+
+def camera_key_from_exif(exif_data):
+    """Returns 'Make Model' from a raw EXIF blob, or None when unknown."""
+    if not exif_data:
+        return None
+    try:
+        _, ifd0, _, _ = parse_essential_exif(exif_data)
+    except ExifParseError:
+        return None
+    parts = []
+    for tag in (CAMERA_MAKE_TAG, CAMERA_MODEL_TAG):
+        entry = ifd0.get(tag)
+        if entry is not None:
+            parts.append(entry[2].rstrip(b"\x00").decode("ascii", "replace").strip())
+    return " ".join(part for part in parts if part) or None
+
+
+class QualitySearch:
+    """Picks the encoder quality per image, either against an SSIM or a bits-per-pixel target.
+
+    Results are remembered per camera model: once CAMERA_CACHE_SAMPLES images of a camera
+    were searched, later images of that camera reuse the median quality without searching.
+    """
+
+    def __init__(self, mode, target=None, min_quality=MIN_QUALITY, max_quality=MAX_QUALITY):
+        if mode not in QUALITY_MODES:
+            raise ValueError(f"Unknown quality search mode {mode!r}, expected one of {', '.join(QUALITY_MODES)}")
+        if mode == QUALITY_MODE_SSIM and np is None:
+            raise RuntimeError("The SSIM quality search needs NumPy, install it with: python3 -m pip install numpy")
+        self.mode = mode
+        if target is None:
+            target = DEFAULT_TARGET_SSIM if mode == QUALITY_MODE_SSIM else DEFAULT_TARGET_BPP
+        self.target = target
+        self.min_quality = min_quality
+        self.max_quality = max_quality
+        self._camera_qualities = {}
+        self._lock = threading.Lock()
+
+    def cached_quality(self, camera_key):
+        if camera_key is None:
+            return None
+        with self._lock:
+            qualities = self._camera_qualities.get(camera_key, [])
+            if len(qualities) >= CAMERA_CACHE_SAMPLES:
+                return int(statistics.median(qualities))
+        return None
+
+    def _remember(self, camera_key, quality):
+        if camera_key is None:
+            return
+        with self._lock:
+            qualities = self._camera_qualities.setdefault(camera_key, [])
+            if len(qualities) < CAMERA_CACHE_SAMPLES:
+                qualities.append(quality)
+
+    def choose_quality(self, img, output_format, camera_key=None, progressive=False):
+        """Returns (quality, encoded bytes or None). The bytes are returned when the search
+        already produced the final full-size encode, so the caller doesn't encode twice."""
+        if output_format not in SEARCHABLE_FORMATS:
+            return self.max_quality, None
+        cached = self.cached_quality(camera_key)
+        if cached is not None:
+            return cached, None
+
+        if self.mode == QUALITY_MODE_SSIM:
+            quality, data = self._search_ssim(img, output_format, progressive), None
+        else:
+            quality, data = self._search_bpp(img, output_format, progressive)
+        self._remember(camera_key, quality)
+        return quality, data
+
+    def _search_ssim(self, img, output_format, progressive):
+        """Binary search for the lowest quality whose downscaled encode reaches the SSIM target."""
+        reference = img.convert('RGB')
+        reference.thumbnail((SSIM_MAX_SIDE, SSIM_MAX_SIDE))
+        reference_gray = reference.convert('L')
+
+        low, high = self.min_quality, self.max_quality
+        while low < high:
+            middle = (low + high) // 2
+            data = encode_image(reference, output_format, middle, progressive=progressive)
+            decoded = Image.open(io.BytesIO(data)).convert('L')
+            if ssim(reference_gray, decoded) >= self.target:
+                high = middle
+            else:
+                low = middle + 1
+        return low
+
+    def _search_bpp(self, img, output_format, progressive):
+        """Binary search for the highest quality whose full-size encode stays within the bits-per-pixel target."""
+        pixels = max(img.width * img.height, 1)
+        encodes = {}
+
+        def bits_per_pixel(quality):
+            encodes[quality] = encode_image(img, output_format, quality, progressive=progressive)
+            return len(encodes[quality]) * 8 / pixels
+
+        low, high = self.min_quality, self.max_quality
+        while low < high:
+            middle = (low + high + 1) // 2
+            if bits_per_pixel(middle) <= self.target:
+                low = middle
+            else:
+                high = middle - 1
+        # The search encodes without EXIF, so the caller re-encodes when the image carries metadata
+        return low, encodes.get(low)
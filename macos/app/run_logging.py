@@ -0,0 +1,102 @@
+import json
+import logging
+import sys
+import time
+
+# Shared logger for the compression pipeline
+logger = logging.getLogger("compressor")
+
+# ANSI colors used by the console output, per log level
+LEVEL_COLORS = {
+    logging.DEBUG: "",
+    logging.INFO: "\033[32m",
+    logging.WARNING: "\033[33m",
+    logging.ERROR: "\033[31m",
+    logging.CRITICAL: "\033[31m",
+}
+RESET_COLOR = "\033[0m"
+
+
+class ColorFormatter(logging.Formatter):
+    """Console formatter that colors the message by level, like the old print statements."""
+
+    def __init__(self, use_color=True):
+        super().__init__("%(message)s")
+        self.use_color = use_color
+
+    def format(self, record):
+        message = super().format(record)
+        color = LEVEL_COLORS.get(record.levelno, "")
+        if self.use_color and color:
+            return f"{color}{message}{RESET_COLOR}"
+        return message
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """Formats each record as one JSON object per line for machine consumption.
+
+    Structured values passed as ``extra={'fields': {...}}`` are merged into the object.
+    """
+
+    def format(self, record):
+        data = {
+            'time': record.created,
+            'level': record.levelname.lower(),
+            'message': record.getMessage(),
+        }
+        fields = getattr(record, 'fields', None)
+        if fields:
+            data.update(fields)
+        if record.exc_info:
+            data['exception'] = self.formatException(record.exc_info)
+        return json.dumps(data, default=str)
+
+
+class RateLimitedProgress:
+    """Logs a progress line at most once every `interval` seconds."""
+
+    def __init__(self, interval=5.0, clock=time.monotonic):
+        self.interval = interval
+        self.clock = clock
+        self._last = None
+
+    def log(self, message, *args, fields=None, force=False):
+        if not logger.isEnabledFor(logging.INFO):
+            return
+        now = self.clock()
+        if not force and self._last is not None and now - self._last < self.interval:
+            return
+        self._last = now
+        logger.info(message, *args, extra={'fields': fields or {}})
+
+
+def configure_logging(verbose=False, quiet=False, json_path=None):
+    """Sets up console (and optional JSON-lines file) output for the pipeline logger.
+
+    quiet: only warnings and errors reach the console.
+    verbose: per-file details are printed as well.
+    json_path: every record at the active level is also appended to this file as JSON.
+    """
+    if quiet:
+        level = logging.WARNING
+    elif verbose:
+        level = logging.DEBUG
+    else:
+        level = logging.INFO
+
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+        handler.close()
+
+    console = logging.StreamHandler(sys.stdout)
+    console.setFormatter(ColorFormatter(use_color=sys.stdout.isatty()))
+    logger.addHandler(console)
+
+    if json_path:
+        json_handler = logging.FileHandler(json_path)
+        json_handler.setFormatter(JsonLinesFormatter())
+        logger.addHandler(json_handler)
+
+    logger.setLevel(level)
+    logger.propagate = False
+    return logger
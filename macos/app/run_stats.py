@@ -0,0 +1,193 @@
+import threading
+import time
+from path_index import PathSet, PathTable
+
+# Counters that are aggregated during a run
+COUNTER_NAMES = (
+    'processed_images_count',
+    'processed_videos_count',
+    'skipped_videos_count',
+    'unsupported_files_count',
+    'files_discovered_count',  # Files found by the scan so far
+    'files_done_count',  # Files finished (or skipped as already processed) in this run
+    'in_flight_count',  # Files currently being processed
+    'total_original_images_size',
+    'total_final_images_size',
+    'total_original_videos_size',
+    'total_final_videos_size',
+    'total_unsupported_files_size',
+    'total_skipped_videos_size',
+    'already_processed_files_size',  # Input bytes of files finished by previous runs
+    'processed_input_bytes',  # Input bytes of files finished in this run, whatever their category
+    'deferred_files_count',  # Files not started because they wouldn't fit into the run budget
+    'unchanged_files_count',  # Mirror mode: inputs skipped because their output is up to date
+    'orphaned_outputs_count',  # Mirror mode: outputs removed or quarantined because their input is gone
+    'retries_count',  # Attempts that failed with a transient error and were tried again
+    'quarantined_files_count',  # Files that failed every attempt and were left without an output
+    'replaced_in_place_count',  # In-place mode: inputs replaced by their compressed output
+    'reclaimed_bytes',  # In-place mode: bytes freed by those replacements
+    'space_pauses_count',  # Times the run paused because the output volume was (nearly) full
+    'space_deferred_files_count',  # Files not started (or not finished) because the output volume had no room in time
+    # Files copied unchanged, by the method file_copy used
+    'copied_reflink_count',
+    'copied_hardlink_count',
+    'copied_copy_file_range_count',
+    'copied_sendfile_count',
+    'copied_buffered_count',
+)
+
+# Counters that a resumed run continues from
+CHECKPOINT_COUNTER_NAMES = (
+    'processed_images_count',
+    'processed_videos_count',
+    'skipped_videos_count',
+    'unsupported_files_count',
+    'total_original_images_size',
+    'total_final_images_size',
+    'total_original_videos_size',
+    'total_final_videos_size',
+    'total_unsupported_files_size',
+    'total_skipped_videos_size',
+)
+
+
+class RunStats:
+    """Thread-safe counters, sizes and file lists of one compression run.
+
+    Workers call add() with deltas; readers take a snapshot() which is a plain dict copy.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = dict.fromkeys(COUNTER_NAMES, 0)
+        self._failed_files = []
+        self._failure_reasons = {}
+        self._failure_details = {}
+        self._quarantined_files = []
+        self._unsupported_files = PathTable()  # Can be most of a library, so kept compact
+        self.started_at = time.time()
+        self.last_file_finished_at = None
+
+    def add(self, **deltas):
+        """Atomically adds each keyword delta to the counter of the same name."""
+        with self._lock:
+            for name, delta in deltas.items():
+                self._values[name] += delta
+
+    def get(self, name):
+        with self._lock:
+            return self._values[name]
+
+    def record_failed(self, path, reason=None, detail=None):
+        """Records a failed file; detail is optional diagnostic output such as ffmpeg's last lines."""
+        with self._lock:
+            if path not in self._failure_reasons:  # A retried file is listed once
+                self._failed_files.append(path)
+            self._failure_reasons[path] = reason or "failed"
+            if detail:
+                self._failure_details[path] = detail
+
+    def failure_reason(self, path):
+        """Why processing path failed in this run, or None if it didn't."""
+        with self._lock:
+            return self._failure_reasons.get(path)
+
+    def failure_detail(self, path):
+        with self._lock:
+            return self._failure_details.get(path)
+
+    def record_quarantined(self, path):
+        with self._lock:
+            self._quarantined_files.append(path)
+
+    def record_unsupported(self, path):
+        with self._lock:
+            self._unsupported_files.append(path)
+
+    def file_finished(self):
+        """Marks one in-flight file as done."""
+        with self._lock:
+            self._values['in_flight_count'] -= 1
+            self._values['files_done_count'] += 1
+            self.last_file_finished_at = time.time()
+
+    @property
+    def failed_files(self):
+        with self._lock:
+            return list(self._failed_files)
+
+    @property
+    def quarantined_files(self):
+        with self._lock:
+            return list(self._quarantined_files)
+
+    @property
+    def unsupported_files(self):
+        with self._lock:
+            return list(self._unsupported_files)
+
+    def snapshot(self):
+        """Returns a consistent copy of all counters, cheap enough to call per file."""
+        with self._lock:
+            data = dict(self._values)
+            data['failed_files_count'] = len(self._failed_files)
+            data['started_at'] = self.started_at
+            data['last_file_finished_at'] = self.last_file_finished_at
+        return data
+
+    @classmethod
+    def from_checkpoint(cls, data):
+        """Builds a RunStats that continues from the counters of earlier runs (see JobStore.checkpoint)."""
+        stats = cls()
+        for name in CHECKPOINT_COUNTER_NAMES:
+            stats._values[name] = data.get(name, 0)
+        stats._failed_files = list(data.get('failed_files', []))
+        stats._failure_reasons = dict(data.get('failure_reasons', {}))
+        stats._quarantined_files = list(data.get('quarantined_files', []))
+        unsupported_files = data.get('unsupported_files', [])
+        stats._unsupported_files = unsupported_files if isinstance(unsupported_files, PathTable) else PathTable(unsupported_files)
+        return stats
+
+
+class RunContext:
+    """Everything one run needs: folders, settings, the worker, stats and timings."""
+
+    def __init__(self, folder, output_folder, worker, stats, timer,
+                 image_quality=None, video_compression_speed=None,
+                 requested_output_folder=None, total_size=None, progress=None, keep_gps=False,
+                 image_format="keep", copier=None):
+        self.folder = folder
+        self.output_folder = output_folder
+        self.worker = worker
+        self.stats = stats
+        self.timer = timer
+        self.image_quality = image_quality
+        self.video_compression_speed = video_compression_speed
+        self.requested_output_folder = requested_output_folder  # Folder picked by the user, output_folder lives inside it
+        self.total_size = total_size  # Size of the whole input folder, from the analysis, if known
+        self.progress = progress  # ProgressThrottle in front of the worker's progress signal
+        self.keep_gps = keep_gps
+        self.image_format = image_format  # Output format policy for images, see image_codecs
+        self.copier = copier  # FileCopier used for every unchanged copy
+        self.budget_stop_reason = None  # Name of the run budget that stopped the run, if any
+        self.jobs = None  # JobStore with the state of every file
+        self.writer = None  # WriteBehind that writes outputs and checkpoints in the background
+        self.sync_index = None  # SyncIndex in mirror mode
+        self.settings_hash = None  # Hash of run settings stored in the sync index
+        self.quality_search = None  # QualitySearch when the image quality is picked per image
+        self.verifier = None  # OutputVerifier when outputs are verified
+        self.in_place = None  # InPlaceReplacer when inputs are replaced by their outputs
+        self.space = None  # FreeSpaceGate of the output volume
+        self.lease = None  # LeaseKeeper of the work item a queue worker is processing
+        self.raw_previews = False  # Compress the JPEG preview of RAW files instead of copying them
+        self.processed_files = PathSet()  # Files finished by earlier runs (resuming) and by this one
+        self._processed_lock = threading.Lock()
+
+    @property
+    def is_running(self):
+        # A queue worker that lost its item's lease stops the file in flight, another worker owns it now
+        return self.worker._is_running and not (self.lease is not None and self.lease.lost)
+
+    def mark_processed(self, input_file):
+        with self._processed_lock:
+            self.processed_files.add(input_file)
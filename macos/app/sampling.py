@@ -0,0 +1,60 @@
+import math
+import random
+
+# Two-sided 95% critical values of Student's t by degrees of freedom; larger samples use the normal 1.96
+T_95 = {1: 12.71, 2: 4.30, 3: 3.18, 4: 2.78, 5: 2.57, 6: 2.45, 7: 2.36, 8: 2.31, 9: 2.26, 10: 2.23,
+        12: 2.18, 15: 2.13, 20: 2.09, 25: 2.06, 30: 2.04}
+Z_95 = 1.96
+
+
+def t_critical(degrees_of_freedom):
+    """95% critical value, rounded to the next smaller tabulated degrees of freedom (the wider interval)."""
+    if degrees_of_freedom > max(T_95):
+        return Z_95
+    return T_95[max(df for df in T_95 if df <= max(degrees_of_freedom, 1))]
+
+
+def choose_sample(items, size, seed=0):
+    """Simple random sample without replacement, the same one for the same folder and seed."""
+    if len(items) <= size:
+        return list(items)
+    return random.Random(seed).sample(list(items), size)
+
+
+class RatioEstimate:
+    """Estimates a population total of y from a sample of (x, y) pairs and the known total of x.
+
+    E.g. x is a file's input size and y its output size: the total output is the input total times
+    the sample's output/input ratio. The interval is the usual ratio estimator's standard error with
+    the finite population correction, so sampling every file gives an interval of zero width.
+    """
+
+    def __init__(self, xs, ys, population_count, population_total):
+        self.sample_count = len(xs)
+        self.population_count = population_count
+        self.population_total = population_total
+        sum_x, sum_y = sum(xs), sum(ys)
+        self.ratio = sum_y / sum_x if sum_x else 0.0
+        self.estimate = self.ratio * population_total
+        self.half_width = 0.0
+        n = self.sample_count
+        if 1 < n < population_count and sum_x:
+            mean_x = sum_x / n
+            residual_variance = sum((y - self.ratio * x) ** 2 for x, y in zip(xs, ys)) / (n - 1)
+            ratio_variance = (1 - n / population_count) * residual_variance / (n * mean_x ** 2)
+            self.half_width = t_critical(n - 1) * math.sqrt(ratio_variance) * population_total
+
+    @property
+    def low(self):
+        return max(self.estimate - self.half_width, 0.0)
+
+    @property
+    def high(self):
+        return self.estimate + self.half_width
+
+
+def combined_interval(estimates, exact_total=0.0):
+    """Adds up independent estimates (and an exactly known part): (estimate, low, high)."""
+    total = exact_total + sum(estimate.estimate for estimate in estimates)
+    half_width = math.sqrt(sum(estimate.half_width ** 2 for estimate in estimates))
+    return total, max(total - half_width, 0.0), total + half_width
@@ -0,0 +1,317 @@
+import itertools
+import os
+import shutil
+import threading
+import time
+from formats import CATEGORY_IMAGE, CATEGORY_VIDEO
+from run_logging import logger
+
+# Scheduling policies, selectable with --schedule
+SCHEDULE_WALK = "walk"  # Directory walk order, files start processing while the scan is still running
+SCHEDULE_SAVINGS = "savings"  # Most estimated bytes saved per second of work first
+SCHEDULE_SMALLEST = "smallest"  # Smallest files first
+SCHEDULE_IMAGES_FIRST = "images-first"  # All images, then videos, then everything else
+SCHEDULE_ROUND_ROBIN = "round-robin"  # One file per directory in turn
+SCHEDULE_POLICIES = (SCHEDULE_WALK, SCHEDULE_SAVINGS, SCHEDULE_SMALLEST, SCHEDULE_IMAGES_FIRST, SCHEDULE_ROUND_ROBIN)
+
+# Manifest categories are the pipelines from formats plus plain copies, the same names the time estimate uses
+CATEGORY_COPY = "copy"
+
+# Share of the input size a category is expected to save, used to rank by savings
+EXPECTED_SAVINGS = {
+    CATEGORY_IMAGE: 0.6,
+    CATEGORY_VIDEO: 0.5,
+    CATEGORY_COPY: 0.0,
+}
+
+CATEGORY_ORDER = {CATEGORY_IMAGE: 0, CATEGORY_VIDEO: 1, CATEGORY_COPY: 2}
+
+
+class ManifestEntry:
+    """One input file of the run, with what is known about it before it is processed."""
+
+    __slots__ = ("path", "size", "category")
+
+    def __init__(self, path, size, category):
+        self.path = path
+        self.size = size
+        self.category = category
+
+    def __repr__(self):
+        return f"ManifestEntry({self.path!r}, {self.size}, {self.category!r})"
+
+
+def savings_per_second(entry, estimate_seconds):
+    """Estimated bytes saved per second of work for an entry."""
+    saved = entry.size * EXPECTED_SAVINGS[entry.category]
+    return saved / max(estimate_seconds(entry.category, entry.size), 1e-6)
+
+
+def _round_robin(entries):
+    """Interleaves the directories: the first file of each directory, then the second of each, ..."""
+    by_directory = {}
+    for entry in entries:
+        by_directory.setdefault(os.path.dirname(entry.path), []).append(entry)
+    for round_entries in itertools.zip_longest(*by_directory.values()):
+        for entry in round_entries:
+            if entry is not None:
+                yield entry
+
+
+def check_schedule(policy):
+    """Raises ValueError for a policy that isn't one of SCHEDULE_POLICIES."""
+    if policy not in SCHEDULE_POLICIES:
+        raise ValueError(f"Unknown schedule policy {policy!r}, expected one of {', '.join(SCHEDULE_POLICIES)}")
+
+
+def order_manifest(entries, policy, estimate_seconds):
+    """Returns the manifest entries in the order the policy processes them.
+
+    estimate_seconds(category, size) is the time model used by the savings policy.
+    Sorts are stable, so ties keep the walk order.
+    """
+    check_schedule(policy)
+    if policy == SCHEDULE_SAVINGS:
+        # Quick wins break ties between files that save at the same rate
+        return sorted(entries, key=lambda entry: (-savings_per_second(entry, estimate_seconds), entry.size))
+    if policy == SCHEDULE_SMALLEST:
+        return sorted(entries, key=lambda entry: entry.size)
+    if policy == SCHEDULE_IMAGES_FIRST:
+        return sorted(entries, key=lambda entry: CATEGORY_ORDER[entry.category])
+    if policy == SCHEDULE_ROUND_ROBIN:
+        return list(_round_robin(entries))
+    return list(entries)  # SCHEDULE_WALK
+
+
+# Budget names, as reported when a run stops at one
+BUDGET_DURATION = "duration"
+BUDGET_INPUT_BYTES = "input bytes"
+BUDGET_CPU_SECONDS = "CPU time"
+
+# Files of a category must have been observed for this many bytes before their measured rate replaces the model
+MIN_OBSERVED_BYTES = 16 * 1024 * 1024
+# A time budget with less than this left can't fit any file, the run stops there
+MIN_REMAINING_SECONDS = 5.0
+# After this many files in a row didn't fit, the budget counts as used up and the walk stops
+MAX_DEFERRED_IN_A_ROW = 1000
+
+DURATION_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+SIZE_UNITS = {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3, 't': 1024 ** 4}
+
+
+def parse_duration(value):
+    """Parses '90', '90s', '45m', '6h' or '1d' into seconds."""
+    value = value.strip().lower()
+    if value and value[-1] in DURATION_UNITS:
+        return float(value[:-1]) * DURATION_UNITS[value[-1]]
+    return float(value)
+
+
+def parse_size(value):
+    """Parses '1048576', '500M', '2G' or '1.5T' (or with a trailing B) into bytes."""
+    value = value.strip().lower().rstrip('b')
+    unit = value[-1] if value and value[-1] in SIZE_UNITS else ''
+    return int(float(value[:len(value) - len(unit)]) * SIZE_UNITS[unit])
+
+
+def process_cpu_seconds():
+    """CPU time used by this process and its finished children (ffmpeg)."""
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+class RunBudget:
+    """Limits a run by wall time, input bytes and CPU time.
+
+    Before each file the scheduler asks admit(): a file is only started when its estimated
+    time fits into what is left of every budget. Estimates start from the static time model
+    and switch to the rate measured on finished files of the same category. Files that don't
+    fit are left for the next run; once a budget is used up, or nothing has fit for
+    MAX_DEFERRED_IN_A_ROW files, the run stops.
+    """
+
+    def __init__(self, estimate_seconds, max_duration=None, max_input_bytes=None, max_cpu_seconds=None,
+                 clock=time.monotonic, cpu_clock=process_cpu_seconds):
+        self.estimate_seconds = estimate_seconds
+        self.max_duration = max_duration
+        self.max_input_bytes = max_input_bytes
+        self.max_cpu_seconds = max_cpu_seconds
+        self.clock = clock
+        self.cpu_clock = cpu_clock
+        self._started = clock()
+        self._cpu_started = cpu_clock()
+        self._admitted_bytes = 0
+        self._observed = {}  # category -> [seconds, bytes]
+        self._refused_by = None  # The budget the last file didn't fit into, None if it was admitted
+        self._deferred_in_a_row = 0
+
+    @property
+    def limited(self):
+        return any(limit is not None for limit in (self.max_duration, self.max_input_bytes, self.max_cpu_seconds))
+
+    @property
+    def deferring(self):
+        """True while files are being left for the next run, there is no point in reading ahead then."""
+        return self._refused_by is not None
+
+    def observe(self, category, size, seconds):
+        """Records how long a finished file took, to refine later estimates."""
+        observed = self._observed.setdefault(category, [0.0, 0])
+        observed[0] += seconds
+        observed[1] += size
+
+    def estimate(self, category, size):
+        """Estimated seconds to process a file."""
+        seconds, observed_bytes = self._observed.get(category, (0.0, 0))
+        if observed_bytes >= MIN_OBSERVED_BYTES:
+            return size * seconds / observed_bytes
+        return self.estimate_seconds(category, size)
+
+    def exhausted(self):
+        """Returns the name of a budget that is used up, or None."""
+        if self.max_duration is not None and self.clock() - self._started + MIN_REMAINING_SECONDS >= self.max_duration:
+            return BUDGET_DURATION
+        if self.max_input_bytes is not None and self._admitted_bytes >= self.max_input_bytes:
+            return BUDGET_INPUT_BYTES
+        if (self.max_cpu_seconds is not None
+                and self.cpu_clock() - self._cpu_started + MIN_REMAINING_SECONDS >= self.max_cpu_seconds):
+            return BUDGET_CPU_SECONDS
+        if self._deferred_in_a_row >= MAX_DEFERRED_IN_A_ROW:
+            return self._refused_by
+        return None
+
+    def admit(self, category, size):
+        """True if the file is expected to finish within every budget; admitted bytes are counted."""
+        self._refused_by = self._refusing_budget(category, size)
+        if self._refused_by is not None:
+            self._deferred_in_a_row += 1
+            return False
+        self._deferred_in_a_row = 0
+        self._admitted_bytes += size
+        return True
+
+    def _refusing_budget(self, category, size):
+        estimate = self.estimate(category, size)
+        if self.max_duration is not None and self.clock() - self._started + estimate > self.max_duration:
+            return BUDGET_DURATION
+        if self.max_input_bytes is not None and self._admitted_bytes + size > self.max_input_bytes:
+            return BUDGET_INPUT_BYTES
+        if self.max_cpu_seconds is not None and self.cpu_clock() - self._cpu_started + estimate > self.max_cpu_seconds:
+            return BUDGET_CPU_SECONDS
+        return None
+
+
+# Free space the output volume keeps by default, on top of the estimated outputs of the files in flight
+DEFAULT_MIN_FREE_BYTES = 1024 ** 3
+# How often a paused run looks at the free space again
+SPACE_POLL_SECONDS = 10
+# How long a file waits for room before it is left for the next run
+SPACE_MAX_WAIT_SECONDS = 30 * 60
+
+
+def estimated_output_bytes(category, size, in_place=False):
+    """Expected output size of a file; in-place runs write nothing for files that are left as they are."""
+    if in_place and category == CATEGORY_COPY:
+        return 0
+    return int(size * (1 - EXPECTED_SAVINGS[category]))
+
+
+class FreeSpaceGate:
+    """Admits files only while the output volume keeps min_free bytes free after their estimated outputs.
+
+    Admitted files reserve their estimate until their output is written, so files in flight count
+    before they show up in the volume's free space. When a file doesn't fit, admission pauses and
+    the free space is polled until it fits again (outputs finished, files deleted by the user), for
+    at most max_wait seconds. Once a wait ran out, files that don't fit right away aren't waited for
+    until one fits again, so a full volume doesn't cost max_wait per file.
+    """
+
+    def __init__(self, path, min_free=DEFAULT_MIN_FREE_BYTES, poll_seconds=SPACE_POLL_SECONDS,
+                 max_wait=SPACE_MAX_WAIT_SECONDS):
+        self.path = path
+        self.min_free = min_free
+        self.poll_seconds = poll_seconds
+        self.max_wait = max_wait
+        self._reserved = 0
+        self._waiting = 0
+        self._gave_up = False
+        self._lock = threading.Lock()
+
+    def free_bytes(self):
+        """Free space of the output volume minus what the files in flight will still write."""
+        free = shutil.disk_usage(self.path).free
+        with self._lock:
+            return free - self._reserved
+
+    def has_room(self, nbytes):
+        return self.free_bytes() - nbytes >= self.min_free
+
+    def can_ever_fit(self, nbytes):
+        """False if nbytes don't fit above the reserve even on an empty volume."""
+        return shutil.disk_usage(self.path).total - nbytes >= self.min_free
+
+    @property
+    def waiting(self):
+        """True while a file is paused for room."""
+        with self._lock:
+            return self._waiting > 0
+
+    def reserve(self, nbytes):
+        with self._lock:
+            self._reserved += nbytes
+
+    def release(self, nbytes):
+        with self._lock:
+            self._reserved -= nbytes
+
+    def wait_for_room(self, nbytes, is_running, on_pause=None, pause_first=False):
+        """Blocks until nbytes fit above the reserve.
+
+        Returns False if is_running() turns False meanwhile, or if the bytes don't fit within max_wait
+        seconds (or never can); callers tell the two apart by is_running().
+        pause_first: wait one poll interval before looking, after a write already ran out of space.
+        """
+        if not self.can_ever_fit(nbytes):
+            logger.warning("%d MB can't fit on the output volume while keeping %d MB free",
+                           nbytes // (1024 * 1024), self.min_free // (1024 * 1024))
+            return False
+        if not pause_first and self.has_room(nbytes):
+            with self._lock:
+                self._gave_up = False
+            return True
+        with self._lock:
+            if self._gave_up and not pause_first:
+                return False
+            self._waiting += 1
+        try:
+            return self._wait(nbytes, is_running, on_pause, pause_first)
+        finally:
+            with self._lock:
+                self._waiting -= 1
+
+    def _wait(self, nbytes, is_running, on_pause, pause_first):
+        deadline = time.monotonic() + self.max_wait
+        if not is_running():
+            return False
+        if on_pause is not None:
+            on_pause()
+        if pause_first:
+            # The caller already reported the full volume, give it time before looking
+            time.sleep(self.poll_seconds)
+        else:
+            logger.warning("Only %d MB free on the output volume (keeping %d MB free), pausing until space frees up",
+                           max(self.free_bytes(), 0) // (1024 * 1024), self.min_free // (1024 * 1024))
+        while not self.has_room(nbytes):
+            if not is_running():
+                return False
+            if time.monotonic() >= deadline:
+                logger.warning("Still no room on the output volume after %d minutes, giving up",
+                               self.max_wait // 60)
+                with self._lock:
+                    self._gave_up = True
+                return False
+            time.sleep(self.poll_seconds)
+        with self._lock:
+            self._gave_up = False
+        logger.info("Enough free space on the output volume again, continuing")
+        return True
@@ -0,0 +1,120 @@
+import json
+import math
+import random
+import threading
+from bisect import bisect_left
+import time
+from contextlib import contextmanager
+from run_logging import logger
+
+# Stages reported in the run report, in pipeline order
+STAGES = ("scan", "detect", "decode", "exif", "orientation", "quality_search", "encode", "write", "copy", "ffmpeg", "verify", "replace", "checkpoint")
+
+# Upper bounds (seconds) of the histogram buckets, the last bucket is open ended
+HISTOGRAM_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60, 300)
+
+# Samples kept per stage for the percentiles; up to this many files they are exact
+RESERVOIR_SIZE = 1024
+
+
+def percentile(sorted_samples, pct):
+    """Returns the pct-th percentile of an already sorted list (nearest rank)."""
+    if not sorted_samples:
+        return 0.0
+    rank = max(1, math.ceil(pct / 100 * len(sorted_samples)))
+    return sorted_samples[rank - 1]
+
+
+class StageStats:
+    """Running count, total, max and histogram of one stage, plus a fixed-size random sample of its timings.
+
+    The memory is the same for ten files and for ten million; the percentiles come from the sample
+    (reservoir sampling, every timing has the same chance to be in it).
+    """
+
+    def __init__(self, reservoir_size=RESERVOIR_SIZE, seed=0):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * (len(HISTOGRAM_BUCKETS) + 1)
+        self.reservoir = []
+        self.reservoir_size = reservoir_size
+        self._random = random.Random(seed)
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.buckets[bisect_left(HISTOGRAM_BUCKETS, seconds)] += 1  # A bound belongs to its own bucket
+        if len(self.reservoir) < self.reservoir_size:
+            self.reservoir.append(seconds)
+        else:
+            index = self._random.randrange(self.count)
+            if index < self.reservoir_size:
+                self.reservoir[index] = seconds
+
+
+class StageTimer:
+    """Collects how long each processing stage takes per file."""
+
+    def __init__(self):
+        self._stages = {}
+        self._lock = threading.Lock()
+        self.started_at = time.time()
+
+    @contextmanager
+    def stage(self, name):
+        """Times the wrapped block and records it under the given stage name."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def record(self, name, seconds):
+        with self._lock:
+            stats = self._stages.get(name)
+            if stats is None:
+                stats = self._stages[name] = StageStats()
+            stats.add(seconds)
+
+    def stage_report(self, name):
+        """Returns count, total, percentiles (estimated past RESERVOIR_SIZE files) and a bucket histogram for one stage."""
+        with self._lock:
+            stats = self._stages.get(name) or StageStats()
+            count, total, maximum, buckets = stats.count, stats.total, stats.max, list(stats.buckets)
+            samples = sorted(stats.reservoir)
+
+        labels = [f"<={bound}s" for bound in HISTOGRAM_BUCKETS] + [f">{HISTOGRAM_BUCKETS[-1]}s"]
+        return {
+            'count': count,
+            'total_seconds': total,
+            'p50': percentile(samples, 50),
+            'p90': percentile(samples, 90),
+            'p99': percentile(samples, 99),
+            'max': maximum,
+            'histogram': dict(zip(labels, buckets)),
+        }
+
+    def report(self):
+        """Returns the report for every known stage plus any extra recorded ones."""
+        with self._lock:
+            extra = [name for name in self._stages if name not in STAGES]
+        return {name: self.stage_report(name) for name in (*STAGES, *extra)}
+
+    def write_report(self, path, summary=None):
+        """Writes the stage report (and an optional summary dict) as JSON to path."""
+        data = {
+            'started_at': self.started_at,
+            'finished_at': time.time(),
+            'wall_seconds': time.time() - self.started_at,
+            'stages': self.report(),
+        }
+        if summary is not None:
+            data['summary'] = summary
+        try:
+            with open(path, 'w') as f:
+                json.dump(data, f, indent=4)
+            logger.info("Run report written to %s", path)
+        except Exception as e:
+            logger.error("An error occurred while writing the run report: %s", e)
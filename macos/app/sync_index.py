@@ -0,0 +1,198 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from run_logging import logger
+
+SYNC_INDEX_FILE_NAME = "sync-index.json"
+SYNC_INDEX_VERSION = 1
+
+# Files recorded since the index was last saved, one JSON line each, replayed on load
+SYNC_JOURNAL_FILE_NAME = "sync-index.journal"
+# The journal is flushed after this many recorded files, so an interrupted mirror run only
+# redoes the files of the last batch
+SYNC_JOURNAL_FLUSH_INTERVAL = 50
+
+# What happens to outputs whose input is gone
+ORPHANS_DELETE = "delete"
+ORPHANS_QUARANTINE = "quarantine"  # Moved to ORPHANS_FOLDER_NAME inside the output folder
+ORPHANS_KEEP = "keep"
+ORPHAN_POLICIES = (ORPHANS_DELETE, ORPHANS_QUARANTINE, ORPHANS_KEEP)
+ORPHANS_FOLDER_NAME = ".orphans"
+
+
+def settings_hash(settings):
+    """Short, stable hash of the settings that change what gets written for an input."""
+    encoded = json.dumps(settings, sort_keys=True, default=str).encode("utf-8")
+    return hashlib.sha1(encoded).hexdigest()[:16]
+
+
+class SyncIndex:
+    """Index of what the output folder holds for each input file, for mirror mode.
+
+    Maps the input path (relative to the input folder) to the input's size and mtime when it
+    was processed, the hash of the settings it was processed with, and the output path
+    (relative to the output folder). A file whose entry still matches is unchanged and skipped;
+    entries whose input wasn't seen by a complete scan are orphans.
+
+    Recorded files are appended to a journal next to the index, and the index itself is only
+    rewritten by save() (at the end of a run), so recording costs the same for the millionth file
+    as for the first.
+    """
+
+    def __init__(self, output_folder):
+        self.output_folder = output_folder
+        self.path = os.path.join(output_folder, SYNC_INDEX_FILE_NAME)
+        self.journal_path = os.path.join(output_folder, SYNC_JOURNAL_FILE_NAME)
+        self._entries = {}
+        self._seen = set()
+        self._journal = None
+        self._unflushed = 0
+        self._lock = threading.Lock()
+
+    def load(self):
+        self._load_index()
+        self._replay_journal()
+        return self
+
+    def _load_index(self):
+        try:
+            with open(self.path, "r") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            logger.info("No sync index in %s yet, every file will be processed", self.output_folder)
+            return
+        except (OSError, ValueError) as e:
+            logger.warning("Could not read the sync index %s, rebuilding it: %s", self.path, e)
+            return
+        if data.get("version") == SYNC_INDEX_VERSION:
+            self._entries = data.get("files", {})
+
+    def _replay_journal(self):
+        """Applies the files recorded after the last save; a line cut short by a crash is skipped."""
+        try:
+            with open(self.journal_path, "r") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    self._entries[record["path"]] = record["entry"]
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning("Could not read the sync journal %s, its files will be processed again: %s", self.journal_path, e)
+
+    def save(self):
+        """Writes the index atomically, so a crash never leaves a half-written file, and starts a new journal."""
+        with self._lock:
+            data = {"version": SYNC_INDEX_VERSION, "saved_at": time.time(), "files": self._entries}
+            temporary_path = self.path + ".tmp"
+            with open(temporary_path, "w") as f:
+                json.dump(data, f)
+            os.replace(temporary_path, self.path)
+            # Everything in the journal is in the index now; a crash before this just replays it again
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+            self._unflushed = 0
+            try:
+                os.remove(self.journal_path)
+            except FileNotFoundError:
+                pass
+
+    def is_unchanged(self, relative_path, stat_result, settings):
+        """True when the input was processed before with the same size, mtime and settings,
+        and its output is still there. Marks the input as seen either way."""
+        with self._lock:
+            self._seen.add(relative_path)
+            entry = self._entries.get(relative_path)
+        if entry is None:
+            return False
+        return (entry["size"] == stat_result.st_size
+                and entry["mtime_ns"] == stat_result.st_mtime_ns
+                and entry["settings"] == settings
+                and os.path.exists(os.path.join(self.output_folder, entry["output"])))
+
+    def record(self, relative_path, stat_result, settings, output_file):
+        """Remembers what was written for an input. An older output of the same input under
+        another name (e.g. after an output format change) is removed."""
+        output_relative = os.path.relpath(output_file, self.output_folder)
+        entry = {
+            "size": stat_result.st_size,
+            "mtime_ns": stat_result.st_mtime_ns,
+            "settings": settings,
+            "output": output_relative,
+        }
+        with self._lock:
+            previous = self._entries.get(relative_path)
+            self._entries[relative_path] = entry
+            self._seen.add(relative_path)
+            if self._journal is None:
+                self._journal = open(self.journal_path, "a")
+            self._journal.write(json.dumps({"path": relative_path, "entry": entry}) + "\n")
+            self._unflushed += 1
+            if self._unflushed >= SYNC_JOURNAL_FLUSH_INTERVAL:
+                self._journal.flush()
+                self._unflushed = 0
+        if previous is not None and previous["output"] != output_relative:
+            self._remove_output(previous["output"])
+
+    def orphans(self):
+        """Inputs in the index that the scan didn't see. Only meaningful after a complete scan."""
+        with self._lock:
+            return sorted(set(self._entries) - self._seen)
+
+    def remove_orphans(self, policy=ORPHANS_DELETE):
+        """Deletes or quarantines the outputs of inputs that are gone and drops them from the index.
+
+        Returns the number of orphaned outputs handled.
+        """
+        if policy not in ORPHAN_POLICIES:
+            raise ValueError(f"Unknown orphan policy {policy!r}, expected one of {', '.join(ORPHAN_POLICIES)}")
+        if policy == ORPHANS_KEEP:
+            return 0
+        orphans = self.orphans()
+        quarantine_folder = os.path.join(self.output_folder, ORPHANS_FOLDER_NAME, time.strftime("%Y%m%d-%H%M%S"))
+        for relative_path in orphans:
+            with self._lock:
+                entry = self._entries.pop(relative_path)
+            if policy == ORPHANS_QUARANTINE:
+                self._quarantine_output(entry["output"], quarantine_folder)
+            elif policy == ORPHANS_DELETE:
+                self._remove_output(entry["output"])
+        if orphans:
+            logger.info("%s %d orphaned outputs", "Quarantined" if policy == ORPHANS_QUARANTINE else "Removed", len(orphans))
+        return len(orphans)
+
+    def _remove_output(self, output_relative):
+        output_file = os.path.join(self.output_folder, output_relative)
+        try:
+            os.remove(output_file)
+            logger.debug("Removed orphaned output: %s", output_file)
+        except FileNotFoundError:
+            pass
+        self._remove_empty_parents(output_file)
+
+    def _quarantine_output(self, output_relative, quarantine_folder):
+        output_file = os.path.join(self.output_folder, output_relative)
+        if not os.path.exists(output_file):
+            return
+        destination = os.path.join(quarantine_folder, output_relative)
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        shutil.move(output_file, destination)
+        logger.debug("Quarantined orphaned output: %s -> %s", output_file, destination)
+        self._remove_empty_parents(output_file)
+
+    def _remove_empty_parents(self, output_file):
+        """Removes directories left empty by an orphan, up to (not including) the output folder."""
+        directory = os.path.dirname(output_file)
+        root = os.path.abspath(self.output_folder)
+        while os.path.abspath(directory).startswith(root + os.sep):
+            try:
+                os.rmdir(directory)
+            except OSError:
+                break  # Not empty
+            directory = os.path.dirname(directory)
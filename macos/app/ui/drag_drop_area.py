@@ -32,7 +32,7 @@ class DragDropArea(QWidget):
         """Update the label and input folder when a folder is dropped."""
         # self.label.setText(f"Selected folder: {folder_path}")
         self.parent().input_folder_edit.setText(folder_path)  # Update input folder text area
-        self.parent().inputFolder = folder_path  # Update inputFolder variable
+        self.parent().update_input_folder(folder_path)  # Analyze it and start its trial encodes
 
     def label_style(self):
         """Return styling for the label inside drag-and-drop area."""
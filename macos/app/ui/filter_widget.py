@@ -1,11 +1,13 @@
 from PyQt6.QtCore import Qt, pyqtSignal
 from PyQt6.QtWidgets import QWidget, QVBoxLayout, QLabel, QSlider, QComboBox, QHBoxLayout
+from image_codecs import available_output_formats
 
 
 class FilterWidget(QWidget):
     compression_speed_changed = pyqtSignal(str)
     crf_changed = pyqtSignal(int)
     image_quality_changed = pyqtSignal(int)
+    image_format_changed = pyqtSignal(str)
 
     def __init__(self):
         super().__init__()
@@ -96,6 +98,17 @@ class FilterWidget(QWidget):
 
         self.layout.addWidget(self.quality_value_label)
 
+        # Output Format (Photo Filter)
+        self.image_format_label = QLabel("Image Output Format:")
+        self.image_format_label.setStyleSheet("font-size: 13px; font-weight:bold")
+        self.image_format_label.setContentsMargins(0,10,0,0)
+        self.layout.addWidget(self.image_format_label)
+
+        self.image_format_combo = QComboBox()
+        self.image_format_combo.addItems(available_output_formats())  # AVIF only shows up when Pillow can write it
+        self.image_format_combo.currentTextChanged.connect(self.on_image_format_changed)
+        self.layout.addWidget(self.image_format_combo)
+
         # Set the layout for this widget
         self.setLayout(self.layout)
 
@@ -110,3 +123,6 @@ class FilterWidget(QWidget):
     def on_image_quality_changed(self, value):
         self.quality_value_label.setText(f"Current Image Quality: {value}")
         self.image_quality_changed.emit(value)
+
+    def on_image_format_changed(self, value):
+        self.image_format_changed.emit(value)
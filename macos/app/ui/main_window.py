@@ -2,82 +2,20 @@ from PyQt6.QtWidgets import QWidget, QVBoxLayout, QHBoxLayout, QPushButton, QLab
 from PyQt6.QtCore import Qt
 from ui.drag_drop_area import DragDropArea
 from ui.progress_bar_widget import ProgressBarWidget  # Import the progress bar widget
-from compressStuff import analyze_compression_time, process_files
+from compressStuff import process_files
 from publisher import Publisher
 import math 
 from PyQt6.QtCore import QThread
 from file_process_worker import FileProcessingWorker
-import json
+from analysis_worker import CompressionAnalysisWorker
+from job_store import read_saved_job
 from ui.filter_widget import FilterWidget  # Import the FilterWidget
 
-PROGRESS_FILE_NAME = "saved-progress.json"
-
 def readSavedInputFolder():
-    file_path =  PROGRESS_FILE_NAME
-    try:
-        # Open the JSON file and load the data
-        with open(file_path, 'r') as f:
-            data = json.load(f)
-        
-        # Return the progress value if it exists
-        return data.get('inputFolder', "Output Folder not found in the JSON file.")
-    except FileNotFoundError:
-        print(f"The file {file_path} was not found while reading output folder")
-        return ''
-    except json.JSONDecodeError:
-        print("Error decoding the JSON file while reading output folder.")
-        return ''           
-    except Exception as e:
-        print(f"An error occurred while reading output folder: {e}")
-        return ''
+    return read_saved_job()[0]
 
 def readSavedOutputFolder():
-    file_path =  PROGRESS_FILE_NAME
-
-    try:
-        # Open the JSON file and load the data
-        with open(file_path, 'r') as f:
-            data = json.load(f)
-        
-        # Return the progress value if it exists
-        return data.get('outputFolder', "Output Folder not found in the JSON file.")
-    except FileNotFoundError:
-        print(f"The file {file_path} was not found while reading output folder")
-        return ''
-    except json.JSONDecodeError:
-        print("Error decoding the JSON file while reading output folder.")
-        return ''           
-    except Exception as e:
-        print(f"An error occurred while reading output folder: {e}")
-        return ''
-
-# Function to save the progress value
-def saveProgressNumber(progress_value, inputFilePath, outputFilePath, file_path=None):
-    file_path = PROGRESS_FILE_NAME
-    try:
-        # Open the JSON file and load the data
-        with open(file_path, 'r') as f:
-            data = json.load(f)
-        
-        # Update the progress field
-        data['progress'] = progress_value
-
-        # also save input/output path
-        data['inputFolder'] = inputFilePath
-        data['outputFolder'] = outputFilePath
-
-        # Save the updated data back to the JSON file
-        with open(file_path, 'w') as f:
-            json.dump(data, f, indent=4)  # `indent=4` makes the JSON pretty-printed
-        
-        print(f"Progress value {progress_value} saved successfully.")
-    except FileNotFoundError:
-        print(f"The file {file_path} was not found.")
-    except json.JSONDecodeError:
-        print("Error decoding the JSON file.")
-    except Exception as e:
-        print(f"An error occurred while saving progress:{progress_value} :  {e}")
-
+    return read_saved_job()[1]
 
 class MainWindow(QWidget):
     
@@ -96,8 +34,13 @@ class MainWindow(QWidget):
 
         self.worker = None
         self.thread = None
+        self.analysis_worker = None  # Analysis and trial encodes of the picked folder, running in the background
+        self.analysis_thread = None
+        self.trialFolder = None  # Folder of the latest analysis, so leaving the field unchanged doesn't start another
+        self.stoppedAnalyses = []  # Stopped analyses, kept alive until their scans and encodes in flight are done
         self.selected_compression_speed = "fast"
         self.selected_image_quality = 20
+        self.selected_image_format = "keep"
         # Read progress if any
         self.progress = self.readProgressNumber()
 
@@ -141,7 +84,8 @@ class MainWindow(QWidget):
         self.input_folder_edit = QLineEdit(self)
         self.input_folder_edit.setPlaceholderText("Input folder path...")
         self.input_folder_edit.setStyleSheet(self.input_field_style())
-        self.input_folder_edit.textChanged.connect(self.update_input_folder)  
+        self.input_folder_edit.textChanged.connect(self.update_input_folder_text)
+        self.input_folder_edit.editingFinished.connect(self.onInputFolderEditingFinished)  # Not per keystroke, a folder is scanned
         self.main_layout.addWidget(self.input_folder_edit)
 
         ############################################################################### 
@@ -177,6 +121,10 @@ class MainWindow(QWidget):
         self.estimateLabel.setStyleSheet("font-size: 16px; font-weight: bold; padding-bottom: 10px;")
         self.estimatedSection.addWidget(self.estimateLabel)
 
+        self.expectedSizeLabel = QLabel("Expected Output Size: ")
+        self.expectedSizeLabel.setStyleSheet("font-size: 12px; font-weight: light; padding-bottom: 10px;")
+        self.estimatedSection.addWidget(self.expectedSizeLabel)
+
         self.totalFiles = QLabel("Total Files: ")
         self.totalFiles.setStyleSheet("font-size: 12px; font-weight: light; padding-bottom: 10px;")
         self.estimatedSection.addWidget(self.totalFiles)
@@ -252,7 +200,7 @@ class MainWindow(QWidget):
 
         if self.inputFolder:
             self.input_folder_edit.setText(self.inputFolder)
-            self.update_input_folder(self.inputFolder)
+            self.update_input_folder(self.inputFolder, trial=False)  # Trial encodes only once a folder is picked
             self.cancel_button.setEnabled(True)  
             self.setStartButtonContinue()
             self.start_button.setEnabled(True)  
@@ -309,26 +257,13 @@ class MainWindow(QWidget):
 
     
     # Function to read the progress value
-    def readProgressNumber(self, file_path=None):
-        file_path =  PROGRESS_FILE_NAME
+    def readProgressNumber(self):
         print("Reading progress number...")
         try:
-            # Open the JSON file and load the data
-            with open(file_path, 'r') as f:
-                data = json.load(f)
-            
-            # Return the progress value if it exists
-            readNumber = int(math.ceil(data.get('progress', "Progress not found in the JSON file.")))
-            
-            self.previousProgressNumberFound = True
-            print("self.previousProgressNumberFound. {self.previousProgressNumberFound}  +++++++++++++++++",self.previousProgressNumberFound)
+            # Summed up by the job database from the finished files
+            readNumber = int(math.ceil(read_saved_job()[2]))
+            self.previousProgressNumberFound = readNumber > 0
             return readNumber
-        except FileNotFoundError:
-            print(f"The file {file_path} was not found.")
-            return 0
-        except json.JSONDecodeError:
-            print("Error decoding the JSON file.")
-            return 0            
         except Exception as e:
             print(f"An error occurred reading progress: {e}")
             return 0
@@ -336,37 +271,24 @@ class MainWindow(QWidget):
 
     def onStartClicked(self):
         def updateProgressBar(data):
-            current_num_videos = data['processed_videos_count']
-            current_videos_size = data['total_original_videos_size']
-
-            current_images_size = data['total_original_images_size']
-            current_num_images = data['processed_images_count']
-
-            total_count = self.analysisResult['total_files_count']
-            total_size = self.analysisResult['total_size']
-
-            already_processed_size = data['already_processed_files_size']
-
-            analysis_total_size = self.analysisResult['total_size']
-            # if self.previousProgressNumberFound is True:
-            #     print("----------------- Found previous progress")
-            #     progress_value = self.progress
-            # else:
-            #     print("----------------->>>> Found NOOOOO previous progress")
-
-            progress_value = ((( current_images_size + current_videos_size + already_processed_size ) / analysis_total_size) * 100 )
-            
-            
-            print("Update progress" + math.ceil(progress_value).__str__())
+            # The worker computes the percentage and persists it in its checkpoint,
+            # the UI thread only displays it. Events arrive at most ~10 times a second.
+            if data.get('waiting_for_space'):
+                self.progressLoadedLabel.setText("Paused: the output volume is full. Free up space to continue")
+            else:
+                self.progressLoadedLabel.setText("Compression in Progress...")
+            progress_value = data.get('progress')
+            if progress_value is None:
+                return
 
             self.progress_bar_widget.update_progress(math.ceil(progress_value))
-            saveProgressNumber(progress_value, self.inputFolder, self.outputFolder)
             self.progress = progress_value
 
         self.progressLoadedLabel.setText("Compression in Progress...")
+        self.stopTrialAnalysis()  # Leave the CPU to the run, without an analysis the progress comes from the run
 
         #  Add worker and start thread
-        self.worker = FileProcessingWorker(self.inputFolder, self.outputFolder, self.loadPreviousProgress, self.selected_compression_speed, self.selected_image_quality)
+        self.worker = FileProcessingWorker(self.inputFolder, self.outputFolder, self.loadPreviousProgress, self.selected_compression_speed, self.selected_image_quality, self.analysisResult['total_size'] if self.analysisResult else None, self.selected_image_format)
         self.thread = QThread()
         self.worker.moveToThread(self.thread)
 
@@ -389,7 +311,7 @@ class MainWindow(QWidget):
         folder_path = QFileDialog.getExistingDirectory(self, "Select Input Folder")
         if folder_path:
             self.input_folder_edit.setText(folder_path)  # Update input folder text area
-            self.inputFolder = folder_path  # Update inputFolder variable
+            self.update_input_folder(folder_path)
 
     def set_output_folder(self):
         """Open file dialog to select the output folder."""
@@ -399,17 +321,81 @@ class MainWindow(QWidget):
             self.outputFolder = folder_path  # Update outputFolder variable
             self.start_button.setEnabled(True)  # Enable compress button once output folder is set
 
-    def update_input_folder(self, folder):
+    def update_input_folder_text(self, text):
         """Update inputFolder variable when input folder text area changes."""
+        self.inputFolder = text
+
+    def onInputFolderEditingFinished(self):
+        folder = self.input_folder_edit.text()
+        if folder != self.trialFolder:
+            self.update_input_folder(folder)
+
+    def update_input_folder(self, folder, trial=True):
+        """Analyzes a picked input folder in the background and, with trial, trial-encodes its files after that."""
         self.inputFolder = folder
-        self.analysisResult = analyze_compression_time(folder)
+        self.analysisResult = None
+        self.startTrialAnalysis(folder, trial)
 
+    def onFolderAnalyzed(self, analysis):
+        if self.sender() is not self.analysis_worker:
+            return  # A stopped analysis of an earlier folder
+        self.analysisResult = analysis
         self.estimateLabel.setText("Estimated Time Required: " + self.analysisResult['total_estimated_time_str'])
         self.totalFiles.setText("Total Files: " + self.analysisResult['total_files_count'] + ' files (' + self.analysisResult['formatted_total_size'] +' )')
         self.totalImages.setText("Total Images: " + self.analysisResult['image_files_count'] + ' files (' + self.analysisResult['formatted_image_size'] +' )')
         self.totalVideos.setText("Total Videos: " + self.analysisResult['video_files_count'] + ' files (' + self.analysisResult['formatted_video_size'] +' )')
         self.totalUnsupportedFiles.setText("Unsupported Files: " + self.analysisResult['unsupported_files_count'] + ' files (' + self.analysisResult['formatted_unsupported_size'] +' )')
 
+    def startTrialAnalysis(self, folder, trial=True):
+        """Analyzes the folder and, with trial, trial-encodes a sample of it in the background; the labels are filled in as results arrive."""
+        self.stopTrialAnalysis()
+        self.trialFolder = folder
+        self.estimateLabel.setText("Estimated Time Required: analyzing folder...")
+        self.expectedSizeLabel.setText("Expected Output Size: estimating from trial encodes..." if trial else "Expected Output Size: ")
+
+        # The trial samples the files the analysis found, instead of scanning the folder again
+        self.analysis_worker = CompressionAnalysisWorker(folder, self.selected_compression_speed, self.selected_image_quality, self.selected_image_format, trial)
+        self.analysis_thread = QThread()
+        self.analysis_worker.moveToThread(self.analysis_thread)
+        self.analysis_worker.analyzed.connect(self.onFolderAnalyzed)
+        self.analysis_worker.finished.connect(self.onTrialAnalysisFinished)
+        self.analysis_worker.finished.connect(self.analysis_thread.quit)
+        self.analysis_thread.started.connect(self.analysis_worker.run)
+        self.analysis_thread.start()
+
+    def stopTrialAnalysis(self):
+        """Stops the trial without waiting for it: its encodes in flight finish in the background."""
+        if self.analysis_worker:
+            self.analysis_worker.stop()
+            stopped = (self.analysis_worker, self.analysis_thread)
+            self.stoppedAnalyses.append(stopped)
+            self.analysis_thread.finished.connect(lambda: self.forgetStoppedAnalysis(stopped))
+            if not self.analysis_thread.isRunning():
+                self.forgetStoppedAnalysis(stopped)
+            self.analysis_worker = None
+            self.analysis_thread = None
+
+    def forgetStoppedAnalysis(self, stopped):
+        if stopped in self.stoppedAnalyses:
+            self.stoppedAnalyses.remove(stopped)
+
+    def onTrialAnalysisFinished(self, result):
+        if self.sender() is not self.analysis_worker or not result:
+            return  # A stopped trial, a newer one is running or the folder changed
+        if 'expected_output_size_str' not in result:
+            return  # Only analyzed, the labels were filled in by onFolderAnalyzed
+        self.analysisResult.update({key: value for key, value in result.items() if key.startswith(('expected_', 'trial_'))})
+        if result['trial_estimated_time_str']:
+            self.estimateLabel.setText("Estimated Time Required: " + result['trial_estimated_time_str'])
+        expected_size = "Expected Output Size: " + result['expected_output_size_str']
+        if result['expected_savings_str']:
+            expected_size += ', saves ' + result['expected_savings_str']
+        self.expectedSizeLabel.setText(expected_size)
+        if result['expected_image_size_str']:
+            self.totalImages.setText("Total Images: " + result['image_files_count'] + ' files (' + result['formatted_image_size'] + ' -> ' + result['expected_image_size_str'] + ' )')
+        if result['expected_video_size_str']:
+            self.totalVideos.setText("Total Videos: " + result['video_files_count'] + ' files (' + result['formatted_video_size'] + ' -> ' + result['expected_video_size_str'] + ' )')
+
 
 
 
@@ -484,6 +470,7 @@ class MainWindow(QWidget):
         filter_widget.compression_speed_changed.connect(self.on_compression_speed_changed)
         # filter_widget.crf_changed.connect(self.on_crf_changed)
         filter_widget.image_quality_changed.connect(self.on_image_quality_changed)
+        filter_widget.image_format_changed.connect(self.on_image_format_changed)
 
         self.estimatedAndFiltersSection.addWidget(filter_widget);
 
@@ -502,4 +489,9 @@ class MainWindow(QWidget):
     # Slot to handle quality changes
     def on_image_quality_changed(self, value):
         self.selected_image_quality = value
-        print(f"Image Quality changed to: {value}")
\ No newline at end of file
+        print(f"Image Quality changed to: {value}")
+
+    # Slot to handle image output format changes
+    def on_image_format_changed(self, value):
+        self.selected_image_format = value
+        print(f"Image Output Format changed to: {value}")
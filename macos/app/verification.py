@@ -0,0 +1,147 @@
+import hashlib
+import io
+import json
+import os
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+from run_logging import logger
+from failures import VerificationError
+from image_codecs import page_count, bits_per_sample
+
+# Share of outputs that get the more expensive check (full image decode, decoding a video frame)
+DEFAULT_SAMPLE_RATE = 0.1
+DEFAULT_VERIFY_THREADS = 2
+
+# A video output's duration may differ from the source's by this much (containers round differently)
+DURATION_TOLERANCE_SECONDS = 0.5
+DURATION_TOLERANCE_SHARE = 0.01
+FFPROBE_TIMEOUT = 60
+FRAME_DECODE_TIMEOUT = 120
+
+
+def is_sampled(path, sample_rate):
+    """Picks the sampled share of files by a hash of the path, so reruns sample the same files."""
+    if sample_rate >= 1:
+        return True
+    digest = hashlib.blake2b(os.fsencode(path), digest_size=4).digest()
+    return int.from_bytes(digest, 'big') / 2 ** 32 < sample_rate
+
+
+def probe_media(path):
+    """Returns (duration in seconds or None, {stream type: count}) of a media file, using ffprobe."""
+    result = subprocess.run(
+        ['ffprobe', '-v', 'error', '-show_entries', 'format=duration:stream=codec_type', '-of', 'json', path],
+        stdin=subprocess.DEVNULL, capture_output=True, timeout=FFPROBE_TIMEOUT)
+    if result.returncode != 0:
+        raise VerificationError(f"ffprobe failed on {path}: {result.stderr.decode('utf-8', errors='replace').strip()}")
+    data = json.loads(result.stdout or b'{}')
+    streams = {}
+    for stream in data.get('streams', []):
+        streams[stream.get('codec_type')] = streams.get(stream.get('codec_type'), 0) + 1
+    duration = data.get('format', {}).get('duration')
+    return (float(duration) if duration not in (None, 'N/A') else None), streams
+
+
+class OutputVerifier:
+    """Checks outputs right after they are produced, before the file is checkpointed as done.
+
+    Every output gets a cheap check: encoded images are parsed (Image.verify), copies are compared
+    by size, and videos are probed with ffprobe and compared with their source's duration and
+    stream types. A deterministic sample of sample_rate of the files is also decoded: images completely,
+    videos one frame from the middle. The source of a video is probed on a background thread while
+    ffmpeg encodes it, so the comparison costs one probe of the output.
+    """
+
+    def __init__(self, sample_rate=DEFAULT_SAMPLE_RATE, threads=DEFAULT_VERIFY_THREADS):
+        self.sample_rate = sample_rate
+        self._executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="verify")
+        self._ffprobe_missing = False
+
+    def verify_image_data(self, data, output_file, expected_size, expected_pages=1, expected_bits=8):
+        """Checks encoded image bytes before they are written to output_file.
+
+        expected_pages and expected_bits are the source's: an output with fewer pages or bits per sample
+        lost part of the image, whatever its size.
+        """
+        try:
+            with Image.open(io.BytesIO(data)) as img:
+                pages, bits = page_count(img), bits_per_sample(img)
+                img.verify()
+            if pages < expected_pages:
+                raise VerificationError(f"output has {pages} of the source's {expected_pages} pages")
+            if bits < expected_bits:
+                raise VerificationError(f"output has {bits} bits per sample, the source {expected_bits}")
+            if is_sampled(output_file, self.sample_rate):
+                with Image.open(io.BytesIO(data)) as img:
+                    img.load()
+                    size = img.size
+                if size != expected_size:
+                    raise VerificationError(f"output is {size[0]}x{size[1]}, expected {expected_size[0]}x{expected_size[1]}")
+        except VerificationError:
+            raise
+        except Exception as e:
+            raise VerificationError(f"output image does not decode: {e}") from e
+
+    def verify_copy(self, input_file, output_file):
+        input_size, output_size = os.path.getsize(input_file), os.path.getsize(output_file)
+        if input_size != output_size:
+            raise VerificationError(f"copy has {output_size} bytes, the input {input_size}")
+
+    def probe_source(self, input_file):
+        """Starts probing a video's source in the background, pass the result to verify_video."""
+        if self._ffprobe_missing:
+            return None
+        return self._executor.submit(probe_media, input_file)
+
+    def verify_video(self, source_probe, input_file, output_file, sample_path=None):
+        """Compares a video output with its source (see probe_source).
+
+        sample_path: where the output ends up when it is checked under a temporary name, the sample is picked by it.
+        """
+        if self._ffprobe_missing:
+            return
+        try:
+            duration, streams = probe_media(output_file)
+        except FileNotFoundError:
+            logger.warning("ffprobe is not installed, videos are not verified")
+            self._ffprobe_missing = True
+            return
+        except (OSError, ValueError, subprocess.TimeoutExpired) as e:
+            raise VerificationError(f"could not probe the output: {e}") from e
+        if not streams.get('video'):
+            raise VerificationError("output has no video stream")
+        if not duration:
+            raise VerificationError("output has no duration, it is probably truncated")
+
+        try:
+            source_duration, source_streams = source_probe.result() if source_probe else probe_media(input_file)
+        except Exception as e:
+            # The comparison needs the source; the checks of the output alone still passed
+            logger.debug("Could not probe %s, skipping the comparison: %s", input_file, e)
+        else:
+            if source_duration and abs(duration - source_duration) > max(DURATION_TOLERANCE_SECONDS,
+                                                                          source_duration * DURATION_TOLERANCE_SHARE):
+                raise VerificationError(f"output is {duration:.2f}s long, the source {source_duration:.2f}s")
+            # ffmpeg's default mapping keeps one stream of each type
+            for stream_type in ('video', 'audio'):
+                if source_streams.get(stream_type) and not streams.get(stream_type):
+                    raise VerificationError(f"output lost the {stream_type} stream of the source")
+
+        if is_sampled(sample_path or output_file, self.sample_rate):
+            self._decode_frame(output_file, duration / 2)
+
+    def _decode_frame(self, output_file, position):
+        try:
+            result = subprocess.run(
+                ['ffmpeg', '-nostdin', '-v', 'error', '-ss', f"{position:.3f}", '-i', output_file,
+                 '-frames:v', '1', '-f', 'null', '-'],
+                stdin=subprocess.DEVNULL, capture_output=True, timeout=FRAME_DECODE_TIMEOUT)
+        except (OSError, subprocess.TimeoutExpired) as e:
+            raise VerificationError(f"could not decode a frame of the output: {e}") from e
+        if result.returncode != 0:
+            raise VerificationError(f"frame at {position:.1f}s does not decode: "
+                                    f"{result.stderr.decode('utf-8', errors='replace').strip()[-500:]}")
+
+    def close(self):
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,245 @@
+import json
+import os
+import shutil
+import socket
+import threading
+import uuid
+from run_logging import logger
+
+# Folder inside the output folder that holds the shared queue
+WORK_QUEUE_FOLDER_NAME = ".work-queue"
+MANIFEST_FILE_NAME = "manifest.json"
+
+# Work items are cut from the manifest at this many files or bytes, whichever comes first
+ITEM_MAX_FILES = 50
+ITEM_MAX_BYTES = 1024 * 1024 * 1024
+
+# A lease that wasn't renewed for this long belongs to a crashed worker and can be reclaimed
+LEASE_SECONDS = 120
+RENEW_INTERVAL = LEASE_SECONDS / 4
+# How often an idle worker looks for items again (some may be leased by workers that crash)
+IDLE_POLL_SECONDS = 5
+
+
+def _write_json_atomic(path, data):
+    temporary_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(temporary_path, "w") as f:
+        json.dump(data, f)
+    os.replace(temporary_path, path)
+
+
+def split_items(entries, max_files=ITEM_MAX_FILES, max_bytes=ITEM_MAX_BYTES):
+    """Cuts a list of (relative path, size) into work items, keeping their order."""
+    items = []
+    current, current_bytes = [], 0
+    for relative_path, size in entries:
+        if current and (len(current) >= max_files or current_bytes + size > max_bytes):
+            items.append(current)
+            current, current_bytes = [], 0
+        current.append(relative_path)
+        current_bytes += size
+    if current:
+        items.append(current)
+    return items
+
+
+def new_worker_id():
+    return f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+
+
+class WorkQueue:
+    """A queue of work items on shared storage (e.g. the NAS the media is on), coordinated with files only.
+
+    Layout of the queue folder:
+        manifest.json           input folder, settings and the number of items
+        items/<id>.json         the input paths (relative to the input folder) of one item
+        leases/<id>.lease       the worker currently processing the item; its mtime is the heartbeat
+        results/<id>.json       the counters of a finished item, its presence marks the item as done
+        clock/<worker>          touched to read the storage's clock, so hosts with skewed clocks agree on expiry
+
+    Claiming creates the lease with O_EXCL, which only one worker can win. An expired lease is
+    first renamed away (also atomic), so only one worker reclaims it; a lease that turns out to be
+    fresh once renamed was just created by the worker that won, and is put back.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.items_folder = os.path.join(folder, "items")
+        self.leases_folder = os.path.join(folder, "leases")
+        self.results_folder = os.path.join(folder, "results")
+        self.clock_folder = os.path.join(folder, "clock")
+
+    @property
+    def manifest_path(self):
+        return os.path.join(self.folder, MANIFEST_FILE_NAME)
+
+    def exists(self):
+        return os.path.exists(self.manifest_path)
+
+    def create(self, items, manifest):
+        """Writes a new queue with the given items (lists of relative paths), replacing an old one."""
+        if os.path.exists(self.folder):
+            shutil.rmtree(self.folder)
+        for folder in (self.items_folder, self.leases_folder, self.results_folder, self.clock_folder):
+            os.makedirs(folder)
+        for index, paths in enumerate(items):
+            _write_json_atomic(self._item_path(index), paths)
+        # Written last: workers only start once every item is in place
+        _write_json_atomic(self.manifest_path, dict(manifest, item_count=len(items)))
+
+    def manifest(self):
+        with open(self.manifest_path, "r") as f:
+            return json.load(f)
+
+    def _item_path(self, item_id):
+        return os.path.join(self.items_folder, f"{item_id}.json")
+
+    def _lease_path(self, item_id):
+        return os.path.join(self.leases_folder, f"{item_id}.lease")
+
+    def _result_path(self, item_id):
+        return os.path.join(self.results_folder, f"{item_id}.json")
+
+    def item_paths(self, item_id):
+        with open(self._item_path(item_id), "r") as f:
+            return json.load(f)
+
+    def is_done(self, item_id):
+        return os.path.exists(self._result_path(item_id))
+
+    def done_count(self):
+        return len([name for name in os.listdir(self.results_folder) if name.endswith(".json")])
+
+    def storage_now(self, worker_id):
+        """Current time as the shared storage sees it."""
+        clock_path = os.path.join(self.clock_folder, worker_id)
+        with open(clock_path, "a"):
+            os.utime(clock_path)
+        return os.stat(clock_path).st_mtime
+
+    def claim(self, worker_id):
+        """Leases the next item that is neither done nor leased (or whose lease expired).
+
+        Returns the item id, or None when nothing can be claimed right now.
+        """
+        now = None
+        for item_id in range(self.manifest()["item_count"]):
+            if self.is_done(item_id):
+                continue
+            lease_path = self._lease_path(item_id)
+            try:
+                fd = os.open(lease_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                if now is None:
+                    now = self.storage_now(worker_id)
+                if not self._reclaim_expired(lease_path, now, worker_id):
+                    continue
+                try:
+                    fd = os.open(lease_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                except FileExistsError:
+                    continue
+            with os.fdopen(fd, "w") as f:
+                f.write(worker_id)
+            if self.is_done(item_id):
+                # Finished by a slow worker between the check above and the lease
+                self.release(item_id, worker_id)
+                continue
+            return item_id
+        return None
+
+    def _reclaim_expired(self, lease_path, now, worker_id):
+        try:
+            expired = os.stat(lease_path)
+            if now - expired.st_mtime < LEASE_SECONDS:
+                return False
+            with open(lease_path, "r") as f:
+                owner = f.read()
+            expired_path = f"{lease_path}.expired.{worker_id}"
+            os.rename(lease_path, expired_path)  # Only one worker's rename succeeds
+        except FileNotFoundError:
+            return False
+        # Another worker may have reclaimed the item and created a fresh lease between the stat and
+        # the rename; then this worker took that lease away and has to put it back
+        renamed = os.stat(expired_path)
+        with open(expired_path, "r") as f:
+            renamed_owner = f.read()
+        if renamed.st_ino != expired.st_ino or renamed_owner != owner or now - renamed.st_mtime < LEASE_SECONDS:
+            self._restore_lease(expired_path, lease_path)
+            return False
+        logger.warning("Reclaiming %s from %s, its lease expired", os.path.basename(lease_path), owner)
+        os.remove(expired_path)
+        return True
+
+    def _restore_lease(self, expired_path, lease_path):
+        try:
+            os.link(expired_path, lease_path)  # Fails instead of replacing a lease created meanwhile
+        except FileExistsError:
+            pass
+        except OSError:
+            os.rename(expired_path, lease_path)  # Storage without hard links
+            return
+        os.remove(expired_path)
+
+    def holds_lease(self, item_id, worker_id):
+        try:
+            with open(self._lease_path(item_id), "r") as f:
+                return f.read() == worker_id
+        except FileNotFoundError:
+            return False
+
+    def renew(self, item_id, worker_id):
+        """Refreshes the heartbeat of a lease, returns False when the lease was lost to another worker."""
+        if not self.holds_lease(item_id, worker_id):
+            return False
+        os.utime(self._lease_path(item_id))
+        return True
+
+    def complete(self, item_id, worker_id, result):
+        """Stores the item's result, which marks it done, and drops the lease."""
+        _write_json_atomic(self._result_path(item_id), dict(result, worker=worker_id))
+        self.release(item_id, worker_id)
+
+    def release(self, item_id, worker_id):
+        if self.holds_lease(item_id, worker_id):
+            try:
+                os.remove(self._lease_path(item_id))
+            except FileNotFoundError:
+                pass
+
+    def results(self):
+        results = []
+        for name in sorted(os.listdir(self.results_folder)):
+            if name.endswith(".json"):
+                with open(os.path.join(self.results_folder, name), "r") as f:
+                    results.append(json.load(f))
+        return results
+
+
+class LeaseKeeper:
+    """Renews a lease from a background thread while the item is processed."""
+
+    def __init__(self, queue, item_id, worker_id):
+        self.queue = queue
+        self.item_id = item_id
+        self.worker_id = worker_id
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="lease-keeper", daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(RENEW_INTERVAL):
+            try:
+                if not self.queue.renew(self.item_id, self.worker_id):
+                    logger.warning("Lost the lease of item %s to another worker", self.item_id)
+                    self.lost = True
+                    return
+            except OSError as e:
+                logger.warning("Could not renew the lease of item %s: %s", self.item_id, e)